@@ -0,0 +1,147 @@
+"""
+Admission control for requests which use the database. Reads and writes get separate concurrency limits, requests
+over the limit wait in a bounded queue. A full queue is answered with 429 at once and a request which waited too long
+with 503, both with a `Retry-After` header, instead of letting all requests pile up on the database lock.
+
+    ADMISSION_CONTROL=0         disable admission control
+    ADMISSION_READ_LIMIT=16     concurrent reads (GET and search requests)
+    ADMISSION_WRITE_LIMIT=1     concurrent writes, SQLite only has one writer per database anyway
+    ADMISSION_QUEUE_SIZE=64     waiting requests per kind
+    ADMISSION_TIMEOUT_MS=2000   maximum wait in the queue
+    ADMISSION_RETRY_AFTER=1     seconds sent as Retry-After
+"""
+import logging
+import os
+import threading
+import time
+
+from flask import Flask, g, request
+
+from api.batch import BATCH_PATH, is_read_only, is_sub_request
+from api.errors import overloaded_response
+
+logger = logging.getLogger(__name__)
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# long lived requests which would hold a slot for their whole duration
+EXEMPT_ENDPOINTS = {'stream_changes'}
+
+
+class GateFull(Exception):
+    pass
+
+
+class Gate:
+    """
+    Counting semaphore with a bounded number of waiters.
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout: float) -> bool:
+        """
+        :param timeout: Maximum wait in seconds
+        :return: False if no slot got free in time
+        :raise GateFull: If the queue is full
+        """
+        with self._condition:
+            # requests don't overtake waiting ones
+            if self.active < self.limit and self.waiting == 0:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue_size:
+                raise GateFull()
+
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class AdmissionController:
+
+    def __init__(self, read_limit: int, write_limit: int, queue_size: int, timeout_ms: float, retry_after: int):
+        self.reads = Gate('read', read_limit, queue_size)
+        self.writes = Gate('write', write_limit, queue_size)
+        self.timeout = timeout_ms / 1000
+        self.retry_after = retry_after
+
+    @staticmethod
+    def from_env() -> 'AdmissionController':
+        return AdmissionController(int(os.getenv('ADMISSION_READ_LIMIT', '16')),
+                                   int(os.getenv('ADMISSION_WRITE_LIMIT', '1')),
+                                   int(os.getenv('ADMISSION_QUEUE_SIZE', '64')),
+                                   float(os.getenv('ADMISSION_TIMEOUT_MS', '2000')),
+                                   int(os.getenv('ADMISSION_RETRY_AFTER', '1')))
+
+    def gate_for_request(self) -> Gate:
+        if request.method in READ_METHODS:
+            return self.reads
+        # searches are sent as POST but only read
+        if request.method == 'POST' and request.path.rstrip('/').endswith('/search'):
+            return self.reads
+        # batches hold one slot for all their sub-requests, a read slot if all of them are GET requests
+        if request.method == 'POST' and request.path.rstrip('/') == BATCH_PATH:
+            body = request.get_json(silent=True)
+            if isinstance(body, dict) and isinstance(body.get('requests'), list) and body['requests'] \
+                    and is_read_only(body['requests']):
+                return self.reads
+        return self.writes
+
+    def before_request(self):
+        if request.endpoint in EXEMPT_ENDPOINTS or is_sub_request():
+            return None
+
+        gate = self.gate_for_request()
+        try:
+            admitted = gate.acquire(self.timeout)
+        except GateFull:
+            logger.warning('Rejecting %s %s, %s queue is full', request.method, request.path, gate.name)
+            return overloaded_response(429, 'Too many requests, try again later', self.retry_after)
+        if not admitted:
+            logger.warning('Rejecting %s %s, waited %.0f ms for a %s slot', request.method, request.path,
+                           self.timeout * 1000, gate.name)
+            return overloaded_response(503, 'Server is busy, try again later', self.retry_after)
+
+        g.admission_gate = gate
+        return None
+
+    def teardown_request(self, exception=None):
+        # sub-requests of a batch share `g` with the batch, its slot is released when the batch ends
+        if is_sub_request():
+            return
+        gate = g.pop('admission_gate', None)
+        if gate is not None:
+            gate.release()
+
+
+def init_admission_control(app: Flask, controller: AdmissionController = None):
+    if os.getenv('ADMISSION_CONTROL', '1').lower() in ('0', 'false', 'no', 'off'):
+        logger.info('Admission control disabled')
+        return
+
+    controller = controller or AdmissionController.from_env()
+    logger.info('Admission control: %d reads, %d writes, %d waiting, %.0f ms timeout', controller.reads.limit,
+                controller.writes.limit, controller.reads.queue_size, controller.timeout * 1000)
+    app.extensions['admission_control'] = controller
+    app.before_request(controller.before_request)
+    app.teardown_request(controller.teardown_request)
@@ -1,13 +1,20 @@
+import base64
+import binascii
 import functools
-from typing import Type
+import json
+from datetime import date
+from typing import Callable, Dict, List, Type, Tuple
 
 from flask import make_response, request, Response
 from marshmallow import ValidationError, Schema
 from sqlalchemy.exc import IntegrityError
 
 from models.base import RESTModel, logger
-from api.errors import error_response, ErrorType, return_validation_errors
+from api.errors import error_response, ErrorType, return_validation_errors, unexpected_error_response
+from api.validation import compile_schema
+from coalescing import coalesce
 from database import LIMIT, db
+from suggest_index import PrefixIndex
 
 
 def check_pagination(f):
@@ -45,61 +52,203 @@ def check_pagination(f):
     return wrapper
 
 
+def encode_cursor(entity: RESTModel or Dict, sort: Tuple[str, bool]) -> str:
+    sort_field, descending = sort
+    if isinstance(entity, dict):
+        # response dicts use the field names as keys, dates are already ISO formatted
+        value, id = entity[sort_field], entity['id']
+    else:
+        value, id = getattr(entity, sort_field), entity.id
+    if isinstance(value, date):
+        value = value.isoformat()
+
+    cursor = json.dumps({'sort': sort_field, 'desc': descending, 'value': value, 'id': id})
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def next_page_cursor(entities: List[RESTModel] or List[Dict], limit: int, sort: Tuple[str, bool] = None) -> str or None:
+    """
+    Cursor of the page after the given one, None if the page isn't full (and so the last one).
+    """
+    if limit and len(entities) == limit:
+        return encode_cursor(entities[-1], sort or ('id', False))
+    return None
+
+
+def decode_cursor(cursor: str, entity_type: Type[RESTModel]) -> ((str, bool), Tuple):
+    data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    sort_field = data['sort']
+    if sort_field not in entity_type.sort_fields:
+        raise ValueError('Invalid sort field in cursor')
+
+    value = data['value']
+    if entity_type.__table__.c[sort_field].type.python_type is date:
+        value = date.fromisoformat(value)
+
+    return (sort_field, bool(data['desc'])), (value, int(data['id']))
+
+
+def check_search_options(f):
+    """
+    Parses the sort order (`sort=<field>` or `sort=-<field>` for descending order), the keyset pagination cursor
+    (`cursor`, returned as `next_cursor` by the previous page) and the count mode (`count=exact` or `count=none` to
+    skip counting all matching rows) from the request arguments. Must be applied to methods of resources with an
+    `entity_type`.
+    """
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        request_args = request.args
+
+        sort = None
+        if request_args.get('sort'):
+            sort_field = request_args['sort'].lstrip('+-')
+            if sort_field not in self.entity_type.sort_fields:
+                return error_response(400, ErrorType.INPUT_ERROR, 'Invalid value for sort, must be one of: {}'.format(
+                    ', '.join(self.entity_type.sort_fields)))
+            sort = (sort_field, request_args['sort'].startswith('-'))
+
+        after = None
+        if request_args.get('cursor'):
+            try:
+                cursor_sort, after = decode_cursor(request_args['cursor'], self.entity_type)
+            except (binascii.Error, KeyError, TypeError, ValueError) as e:
+                logger.info('Invalid cursor: %s', e)
+                return error_response(400, ErrorType.INPUT_ERROR, 'Invalid value for cursor')
+
+            if sort is not None and sort != cursor_sort:
+                return error_response(400, ErrorType.INPUT_ERROR,
+                                      'Sort order differs from the sort order of the cursor')
+            sort = cursor_sort
+
+        count_mode = request_args.get('count', 'exact')
+        if count_mode not in ('exact', 'none'):
+            return error_response(400, ErrorType.INPUT_ERROR, 'Invalid value for count, must be exact or none')
+
+        return f(self, sort=sort, after=after, with_count=count_mode == 'exact', *args, **kwargs)
+
+    return wrapper
+
+
 class SearchRESTResource:
 
     def __init__(self, entity_type: Type[RESTModel], input_schema: Schema):
         self.entity_type = entity_type
         self.input_schema = input_schema
 
-    def post(self):
+    @check_pagination
+    @check_search_options
+    def post(self, offset: int = 0, limit: int = LIMIT, sort: Tuple[str, bool] = None, after: Tuple = None,
+             with_count: bool = True):
         if not request.is_json:
             return error_response(400, ErrorType.INPUT_ERROR, 'MimeType is not application/json')
 
         try:
-            input_data = self.input_schema.load(request.json)
+            input_data = compile_schema(self.input_schema).load(request.json)
         except ValidationError as e:
             return return_validation_errors(e)
 
-        entities, row_count = self.entity_type.query_by_fields(fields=input_data, offset=0, limit=LIMIT)
+        entities, row_count = self.entity_type.query_by_fields(fields=input_data, offset=offset, limit=limit, sort=sort,
+                                                               after=after, with_count=with_count, as_dicts=True)
         if entities is None:
             return error_response(500, ErrorType.SERVER_ERROR, 'Could not search entities due to an unexpected error')
 
-        return multi_data_response(entities, row_count, 0, LIMIT)
+        return multi_data_response(entities, row_count, offset, limit, next_page_cursor(entities, limit, sort))
+
+
+class SuggestRESTResource:
+    default_limit = 10
+    max_limit = 100
+
+    def __init__(self, index: PrefixIndex):
+        self.index = index
+
+    def get(self):
+        request_args = request.args
+        prefix = request_args.get('q', '')
+        if not prefix:
+            return error_response(400, ErrorType.INPUT_ERROR, 'Prefix (q) required')
+
+        try:
+            limit = min(int(request_args.get('limit', self.default_limit)), self.max_limit)
+            if limit < 0:
+                return error_response(400, ErrorType.INPUT_ERROR, 'limit can\'t be a negative value')
+        except ValueError as e:
+            logger.info('Invalid limit value: %s', e)
+            return error_response(400, ErrorType.INPUT_ERROR, 'Invalid value for limit (not a number?)')
+
+        scope = None
+        if self.index.scope_field and request_args.get(self.index.scope_field):
+            try:
+                scope = int(request_args[self.index.scope_field])
+            except ValueError as e:
+                logger.info('Invalid scope value: %s', e)
+                return error_response(400, ErrorType.INPUT_ERROR,
+                                      'Invalid value for {} (not a number?)'.format(self.index.scope_field))
+
+        try:
+            suggestions = self.index.suggest(prefix, limit, scope)
+        except Exception as e:
+            logger.error(e)
+            return error_response(500, ErrorType.SERVER_ERROR, 'Could not query suggestions due to an unexpected error')
+
+        return make_response({'q': prefix, 'limit': limit, 'data': suggestions}, 200)
 
 
 class BasicEntityRESTResource:
+    # optional additions to the response dicts, requested with `with=<name>[,<name>...]`, each function adds its fields
+    # to all dicts of the response at once
+    expansions: Dict[str, Callable[[List[Dict]], None]] = {}
 
     def __init__(self, entity_type: Type[RESTModel]):
         self.entity_type = entity_type
 
+    @coalesce
     @check_pagination
-    def get(self, id: int = None, offset: int = 0, limit: int = LIMIT):
+    @check_search_options
+    def get(self, id: int = None, offset: int = 0, limit: int = LIMIT, sort: Tuple[str, bool] = None,
+            after: Tuple = None, with_count: bool = True):
+        expansions = [name for name in request.args.get('with', '').split(',') if name]
+        if any(name not in self.expansions for name in expansions):
+            if not self.expansions:
+                return error_response(400, ErrorType.INPUT_ERROR, 'Parameter with is not supported')
+            return error_response(400, ErrorType.INPUT_ERROR, 'Invalid value for with, must be one of: {}'.format(
+                ', '.join(self.expansions)))
+
         if id:
-            entities, row_count = self.entity_type.query_by_id(id=id)
+            entities, row_count = self.entity_type.query_by_id(id=id, as_dicts=True)
         else:
-            entities, row_count = self.entity_type.query_by_id(offset=offset, limit=limit)
+            entities, row_count = self.entity_type.query_by_fields({}, offset=offset, limit=limit, sort=sort,
+                                                                   after=after, with_count=with_count, as_dicts=True)
 
         logger.debug('id: %s, row_count: %s', id, row_count)
         if entities is None:
             return error_response(500, ErrorType.SERVER_ERROR, 'Could not query entities due to an unexpected error')
 
+        try:
+            for name in expansions:
+                self.expansions[name](entities)
+        except Exception as e:
+            logger.error(e)
+            return error_response(500, ErrorType.SERVER_ERROR, 'Could not query {} due to an unexpected error'.format(
+                ', '.join(expansions)))
+
         if id:
             if len(entities) == 0:
                 return error_response(404, ErrorType.NOT_FOUND, 'No entity found with given ID')
             elif len(entities) == 1:
-                return make_response(entities[0].to_dict(), 200)
+                return make_response(entities[0], 200)
             elif len(entities) > 1:
                 return error_response(500, ErrorType.SERVER_ERROR,
                                       'Multiple results found when there should only be one')
         else:
-            return multi_data_response(entities, row_count, offset, limit)
+            return multi_data_response(entities, row_count, offset, limit, next_page_cursor(entities, limit, sort))
 
     def post(self):
         if not request.is_json:
             return error_response(400, ErrorType.INPUT_ERROR, 'MimeType is not application/json')
 
         try:
-            input_data = self.entity_type.schema.load(request.json)
+            input_data = compile_schema(self.entity_type.schema).load(request.json)
         except ValidationError as e:
             return return_validation_errors(e)
 
@@ -117,7 +266,7 @@ class BasicEntityRESTResource:
         except Exception as e:
             logger.error(e)
             db.session.rollback()
-            return error_response(500, ErrorType.SERVER_ERROR, 'Could not create entity due to an unexpected error')
+            return unexpected_error_response(e, 'Could not create entity due to an unexpected error')
 
     def put(self, id: int = None):
         if not request.is_json:
@@ -127,7 +276,7 @@ class BasicEntityRESTResource:
             return error_response(400, ErrorType.INPUT_ERROR, 'ID of entity in URL required')
 
         try:
-            input_data = self.entity_type.schema.load(request.json)
+            input_data = compile_schema(self.entity_type.schema).load(request.json)
         except ValidationError as e:
             return return_validation_errors(e)
 
@@ -145,6 +294,10 @@ class BasicEntityRESTResource:
             entity.update(input_data)
             db.session.commit()
             return make_response(entity.to_dict(), 200)
+        except ValueError as e:
+            logger.info(e)
+            db.session.rollback()
+            return error_response(400, ErrorType.INPUT_ERROR, str(e))
         except IntegrityError as e:
             logger.error(e)
             db.session.rollback()
@@ -153,7 +306,47 @@ class BasicEntityRESTResource:
         except Exception as e:
             logger.error(e)
             db.session.rollback()
-            return error_response(500, ErrorType.SERVER_ERROR, 'Could not update entity due to an unexpected error')
+            return unexpected_error_response(e, 'Could not update entity due to an unexpected error')
+
+    def patch(self, id: int = None):
+        if not request.is_json:
+            return error_response(400, ErrorType.INPUT_ERROR, 'MimeType is not application/json')
+
+        if not id:
+            return error_response(400, ErrorType.INPUT_ERROR, 'ID of entity in URL required')
+
+        try:
+            input_data = compile_schema(self.entity_type.schema).load(request.json, partial=True)
+        except ValidationError as e:
+            return return_validation_errors(e)
+
+        input_data.pop('id', None)
+        if not input_data:
+            return error_response(400, ErrorType.INPUT_ERROR, 'At least one field to update is required')
+
+        try:
+            entity = self.entity_type.patch_by_id(id, input_data)
+            if entity is None:
+                db.session.rollback()
+                return error_response(404, ErrorType.NOT_FOUND, 'No entity found with given ID')
+
+            # serialize before committing, the commit expires the entity
+            data = entity.to_dict()
+            db.session.commit()
+            return make_response(data, 200)
+        except ValueError as e:
+            logger.info(e)
+            db.session.rollback()
+            return error_response(400, ErrorType.INPUT_ERROR, str(e))
+        except IntegrityError as e:
+            logger.error(e)
+            db.session.rollback()
+            return error_response(400, ErrorType.INPUT_ERROR,
+                                  'Integrity error, some constraint might not have been respected')
+        except Exception as e:
+            logger.error(e)
+            db.session.rollback()
+            return unexpected_error_response(e, 'Could not update entity due to an unexpected error')
 
     def delete(self, id: int = None):
         if not id:
@@ -176,7 +369,7 @@ class BasicEntityRESTResource:
         except Exception as e:
             logger.error(e)
             db.session.rollback()
-            return error_response(500, ErrorType.SERVER_ERROR, 'Could not delete entity due to an unexpected error')
+            return unexpected_error_response(e, 'Could not delete entity due to an unexpected error')
 
 
 def message_response(status_code: int, message: str) -> Response:
@@ -187,7 +380,8 @@ def message_response(status_code: int, message: str) -> Response:
     return make_response(data, status_code)
 
 
-def multi_data_response(entity_list: [RESTModel], total_rows: int, offset: int, limit: int):
+def multi_data_response(entity_list: [RESTModel] or [Dict], total_rows: int or None, offset: int, limit: int,
+                        next_cursor: str = None):
     if entity_list is None:
         entity_list = []
 
@@ -198,7 +392,10 @@ def multi_data_response(entity_list: [RESTModel], total_rows: int, offset: int,
         'data': []
     }
 
+    if next_cursor:
+        data['next_cursor'] = next_cursor
+
     for entity in entity_list:
-        data['data'].append(entity.to_dict())
+        data['data'].append(entity if isinstance(entity, dict) else entity.to_dict())
 
     return make_response(data, 200)
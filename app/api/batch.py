@@ -0,0 +1,93 @@
+import json
+import logging
+from typing import Dict, List
+
+from flask import current_app, request
+from marshmallow import Schema, fields
+from marshmallow.validate import Length, OneOf
+from werkzeug.exceptions import HTTPException
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 50
+BATCH_PATH = '/rest/batch'
+# WSGI environ key marking the requests dispatched by a batch
+SUB_REQUEST_KEY = 'character_sheets.batch_sub_request'
+
+
+class SubRequestSchema(Schema):
+    method = fields.Str(required=True, validate=OneOf(['GET', 'POST', 'PUT', 'PATCH', 'DELETE']))
+    path = fields.Str(required=True)
+    body = fields.Raw(allow_none=True)
+
+
+class BatchSchema(Schema):
+    requests = fields.List(fields.Nested(SubRequestSchema), required=True,
+                           validate=Length(min=1, max=MAX_BATCH_SIZE))
+
+
+def _error(status: int, message: str) -> Dict:
+    return {'status': status, 'body': {'status': status, 'error_type': 'input_error', 'message': message}}
+
+
+def _run_sub_request(app, method: str, path: str, body) -> Dict:
+    if not path.startswith('/rest/') or path.split('?')[0].rstrip('/') == BATCH_PATH:
+        return _error(400, 'Path must be a REST path other than the batch endpoint')
+
+    kwargs = {'method': method, 'environ_base': {SUB_REQUEST_KEY: True}}
+    if body is not None:
+        kwargs['json'] = body
+    with app.test_request_context(path, **kwargs):
+        try:
+            rv = app.dispatch_request()
+        except Exception as e:
+            rv = app.handle_user_exception(e)
+        if isinstance(rv, HTTPException):
+            # e.g. unknown paths, which aren't handled by flask_restful
+            return {'status': rv.code, 'body': {'message': rv.description}}
+        response = app.make_response(rv)
+
+        if response.is_streamed:
+            response.close()
+            return _error(400, 'Streaming endpoints can\'t be part of a batch')
+
+        data = response.get_data(as_text=True)
+        if response.is_json:
+            data = json.loads(data) if data else None
+        return {'status': response.status_code, 'body': data}
+
+
+def is_sub_request() -> bool:
+    return bool(request.environ.get(SUB_REQUEST_KEY))
+
+
+def is_read_only(sub_requests: List[Dict]) -> bool:
+    return all(isinstance(sub_request, dict) and sub_request.get('method') == 'GET' for sub_request in sub_requests)
+
+
+def run_batch(sub_requests: List[Dict]) -> List[Dict]:
+    """
+    Dispatches the sub-requests one after another in nested request contexts of the current application context, so
+    they share the scoped session. Batches which only read run in one read transaction and see a consistent
+    snapshot of the data, writes commit on their own like single requests do.
+
+    The `before_request` hooks (admission, cache coherence, profiling) only run for the batch request itself, which
+    covers its sub-requests: the admission slot of the batch is held until the whole batch is done, the teardown of a
+    sub-request must not release it (see `is_sub_request`).
+
+    :param sub_requests: Validated sub-requests (see SubRequestSchema)
+    :return: Status and body of each sub-request
+    """
+    app = current_app._get_current_object()
+    read_only = is_read_only(sub_requests)
+    if read_only:
+        db.begin_read_snapshot()
+
+    try:
+        return [_run_sub_request(app, sub_request['method'], sub_request['path'], sub_request.get('body'))
+                for sub_request in sub_requests]
+    finally:
+        if read_only:
+            db.session.rollback()
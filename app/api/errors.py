@@ -4,6 +4,7 @@ from typing import List
 
 from flask import make_response
 from marshmallow import ValidationError
+from sqlalchemy.exc import OperationalError
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +13,7 @@ class ErrorType(Enum):
     INPUT_ERROR = 'input_error'
     NOT_FOUND = 'not_found'
     SERVER_ERROR = 'server_error'
+    OVERLOADED = 'overloaded'
 
 
 def return_validation_errors(error: ValidationError):
@@ -42,3 +44,27 @@ def error_response(status_code: int, error_type: ErrorType, message: str, detail
             data['details'].append(detail)
 
     return make_response(data, status_code)
+
+
+def overloaded_response(status_code: int, message: str, retry_after: int = 1):
+    response = error_response(status_code, ErrorType.OVERLOADED, message)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def is_database_locked(error: Exception) -> bool:
+    """
+    Whether the error is SQLite's busy error, which means the database lock wasn't released within the busy timeout.
+    """
+    return isinstance(error, OperationalError) and 'locked' in str(error.orig)
+
+
+def unexpected_error_response(error: Exception, message: str):
+    """
+    Response for an unexpected error, 503 with Retry-After if the database was locked by other writers (the request can
+    simply be retried), 500 otherwise.
+    """
+    if is_database_locked(error):
+        logger.warning('Database is locked: %s', error)
+        return overloaded_response(503, 'Database is busy, try again later')
+    return error_response(500, ErrorType.SERVER_ERROR, message)
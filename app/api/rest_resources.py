@@ -1,13 +1,34 @@
-from flask_restful import Resource
+import logging
+from typing import Dict, List, Tuple
 
-from api.api_base import BasicEntityRESTResource, check_pagination, multi_data_response, SearchRESTResource
-from api.errors import error_response, ErrorType
-from database import LIMIT
+from flask import make_response, request
+from flask_restful import Resource
+from marshmallow import ValidationError
+from sqlalchemy import select
+from sqlalchemy.sql.functions import count
+
+from api.api_base import BasicEntityRESTResource, check_pagination, check_search_options, multi_data_response, \
+    next_page_cursor, SearchRESTResource, SuggestRESTResource
+from api.batch import BatchSchema, run_batch
+from api.errors import error_response, ErrorType, overloaded_response, return_validation_errors, \
+    unexpected_error_response
+from api.validation import compile_schema
+from coalescing import coalesce
+from database import LIMIT, db
+import jobs
 from models.character import Character, CharacterSearchSchema
+from models.base import count_grouped
 from models.character_info import CharacterInfo
 from models.entry import Entry, EntrySearchSchema
 from models.entrytype import EntryType, EntryTypeSearchSchema
+from models.job import Job
 from models.series import Series, SeriesSearchSchema
+from relations import relation_cache
+from revisions import changes_since
+from suggest_index import character_index, entry_index, entrytype_index, series_index
+from tools.order_integrity import check_order_in_series, repair_order_in_series
+
+logger = logging.getLogger(__name__)
 
 
 class EntryRESTResource(Resource, BasicEntityRESTResource):
@@ -22,6 +43,12 @@ class EntrySearchRESTResource(Resource, SearchRESTResource):
         super().__init__(Entry, EntrySearchSchema(), *args, **kwargs)
 
 
+class EntrySuggestRESTResource(Resource, SuggestRESTResource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(entry_index, *args, **kwargs)
+
+
 class EntryTypeRESTResource(Resource, BasicEntityRESTResource):
 
     def __init__(self, *args, **kwargs):
@@ -34,7 +61,32 @@ class EntryTypeSearchRESTResource(Resource, SearchRESTResource):
         super().__init__(EntryType, EntryTypeSearchSchema(), *args, **kwargs)
 
 
+class EntryTypeSuggestRESTResource(Resource, SuggestRESTResource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(entrytype_index, *args, **kwargs)
+
+
+def add_series_counts(series_list: List[Dict]):
+    """
+    Adds the number of entries, characters and character infos to each series dict, with one grouped count query per
+    table for the whole page.
+    """
+    series_ids = [series['id'] for series in series_list]
+    entry_counts = count_grouped(Entry.series_id, series_ids)
+    character_counts = count_grouped(Character.series_id, series_ids)
+    # infos are stored on the shard of their entry
+    info_counts = count_grouped(Entry.series_id, series_ids, CharacterInfo.__table__.join(Entry.__table__))
+    for series in series_list:
+        series['counts'] = {
+            'entries': entry_counts[series['id']],
+            'characters': character_counts[series['id']],
+            'infos': info_counts[series['id']]
+        }
+
+
 class SeriesRESTResource(Resource, BasicEntityRESTResource):
+    expansions = {'counts': add_series_counts}
 
     def __init__(self, *args, **kwargs):
         super().__init__(Series, *args, **kwargs)
@@ -46,6 +98,12 @@ class SeriesSearchRESTResource(Resource, SearchRESTResource):
         super().__init__(Series, SeriesSearchSchema(), *args, **kwargs)
 
 
+class SeriesSuggestRESTResource(Resource, SuggestRESTResource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(series_index, *args, **kwargs)
+
+
 class CharacterRESTResource(Resource, BasicEntityRESTResource):
 
     def __init__(self, *args, **kwargs):
@@ -58,6 +116,12 @@ class CharacterSearchRESTResource(Resource, SearchRESTResource):
         super().__init__(Character, CharacterSearchSchema(), *args, **kwargs)
 
 
+class CharacterSuggestRESTResource(Resource, SuggestRESTResource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(character_index, *args, **kwargs)
+
+
 class CharacterInfoRESTResource(Resource, BasicEntityRESTResource):
 
     def __init__(self, *args, **kwargs):
@@ -65,14 +129,18 @@ class CharacterInfoRESTResource(Resource, BasicEntityRESTResource):
 
 
 class EntryTypeEntriesRESTResource(Resource):
+    entity_type = Entry
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    @coalesce
     @check_pagination
-    def get(self, id: int, offset: int = 0, limit: int = LIMIT):
-        entry_types, row_count = EntryType.query_by_id(id=id, offset=offset, limit=limit)
-        if not entry_types:
+    @check_search_options
+    def get(self, id: int, offset: int = 0, limit: int = LIMIT, sort: Tuple[str, bool] = None, after: Tuple = None,
+            with_count: bool = True):
+        entry_types, row_count = EntryType.query_by_id(id=id)
+        if entry_types is None:
             return error_response(500, ErrorType.SERVER_ERROR, 'Could not query entrytypes due to an unexpected error')
 
         if len(entry_types) == 0:
@@ -83,22 +151,27 @@ class EntryTypeEntriesRESTResource(Resource):
 
         entry_type = entry_types[0]
 
-        entries, row_count = Entry.query_by_fields({'type_id': entry_type.id}, offset=offset, limit=limit)
+        entries, row_count = Entry.query_by_fields({'entrytype_id': entry_type.id}, offset=offset, limit=limit,
+                                                     sort=sort, after=after, with_count=with_count, as_dicts=True)
         if entries is None:
             return error_response(500, ErrorType.SERVER_ERROR, 'Could not query entries due to an unexpected error')
 
-        return multi_data_response(entries, row_count, offset, limit)
+        return multi_data_response(entries, row_count, offset, limit, next_page_cursor(entries, limit, sort))
 
 
 class SeriesEntriesRESTResource(Resource):
+    entity_type = Entry
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    @coalesce
     @check_pagination
-    def get(self, id: int, offset: int = 0, limit: int = LIMIT):
-        series, row_count = Series.query_by_id(id=id, offset=offset, limit=limit)
-        if not series:
+    @check_search_options
+    def get(self, id: int, offset: int = 0, limit: int = LIMIT, sort: Tuple[str, bool] = None, after: Tuple = None,
+            with_count: bool = True):
+        series, row_count = Series.query_by_id(id=id)
+        if series is None:
             return error_response(500, ErrorType.SERVER_ERROR, 'Could not query series due to an unexpected error')
 
         if len(series) == 0:
@@ -109,22 +182,29 @@ class SeriesEntriesRESTResource(Resource):
 
         series = series[0]
 
-        entries, row_count = Entry.query_by_fields({'series_id': series.id}, offset=offset, limit=limit)
+        # entries of a series are listed in reading order unless requested otherwise
+        sort = sort or ('order_in_series', False)
+        entries, row_count = Entry.query_by_fields({'series_id': series.id}, offset=offset, limit=limit, sort=sort,
+                                                     after=after, with_count=with_count, as_dicts=True)
         if entries is None:
             return error_response(500, ErrorType.SERVER_ERROR, 'Could not query entries due to an unexpected error')
 
-        return multi_data_response(entries, row_count, offset, limit)
+        return multi_data_response(entries, row_count, offset, limit, next_page_cursor(entries, limit, sort))
 
 
 class SeriesCharactersRESTResource(Resource):
+    entity_type = Character
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    @coalesce
     @check_pagination
-    def get(self, id: int, offset: int = 0, limit: int = LIMIT):
-        series, row_count = Series.query_by_id(id=id, offset=offset, limit=limit)
-        if not series:
+    @check_search_options
+    def get(self, id: int, offset: int = 0, limit: int = LIMIT, sort: Tuple[str, bool] = None, after: Tuple = None,
+            with_count: bool = True):
+        series, row_count = Series.query_by_id(id=id)
+        if series is None:
             return error_response(500, ErrorType.SERVER_ERROR, 'Could not query series due to an unexpected error')
 
         if len(series) == 0:
@@ -135,8 +215,184 @@ class SeriesCharactersRESTResource(Resource):
 
         series = series[0]
 
-        characters, row_count = Character.query_by_fields({'series_id': series.id}, limit=limit, offset=offset)
+        characters, row_count = Character.query_by_fields({'series_id': series.id}, limit=limit, offset=offset,
+                                                             sort=sort, after=after, with_count=with_count,
+                                                             as_dicts=True)
         if characters is None:
             return error_response(500, ErrorType.SERVER_ERROR, 'Could not query characters due to an unexpected error')
 
-        return multi_data_response(characters, row_count, offset, limit)
+        return multi_data_response(characters, row_count, offset, limit, next_page_cursor(characters, limit, sort))
+
+
+class SeriesRelationsRESTResource(Resource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @coalesce
+    @check_pagination
+    def get(self, id: int, offset: int = 0, limit: int = LIMIT):
+        upto = None
+        if request.args.get('upto'):
+            try:
+                upto = int(request.args['upto'])
+            except ValueError as e:
+                logger.info('Invalid upto value: %s', e)
+                return error_response(400, ErrorType.INPUT_ERROR, 'Invalid value for upto (not a number?)')
+
+        series, row_count = Series.query_by_id(id=id)
+        if series is None:
+            return error_response(500, ErrorType.SERVER_ERROR, 'Could not query series due to an unexpected error')
+        if len(series) == 0:
+            return error_response(404, ErrorType.NOT_FOUND, 'No entity found with given ID')
+
+        try:
+            relations = relation_cache.get_relations(id, upto)
+        except Exception as e:
+            logger.error('Could not compute relations: %s', e)
+            return error_response(500, ErrorType.SERVER_ERROR, 'Could not compute relations due to an unexpected error')
+
+        return multi_data_response(relations.page(offset, limit), relations.size, offset, limit)
+
+
+class SeriesSheetRESTResource(Resource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @coalesce
+    @check_pagination
+    def get(self, id: int, offset: int = 0, limit: int = LIMIT):
+        upto = None
+        if request.args.get('upto'):
+            try:
+                upto = int(request.args['upto'])
+            except ValueError as e:
+                logger.info('Invalid upto value: %s', e)
+                return error_response(400, ErrorType.INPUT_ERROR, 'Invalid value for upto (not a number?)')
+
+        series, row_count = Series.query_by_id(id=id)
+        if series is None:
+            return error_response(500, ErrorType.SERVER_ERROR, 'Could not query series due to an unexpected error')
+        if len(series) == 0:
+            return error_response(404, ErrorType.NOT_FOUND, 'No entity found with given ID')
+
+        try:
+            characters, row_count = CharacterInfo.query_sheet(id, upto, offset, limit)
+        except Exception as e:
+            logger.error('Could not query character sheet: %s', e)
+            return error_response(500, ErrorType.SERVER_ERROR,
+                                  'Could not query character sheet due to an unexpected error')
+
+        return make_response({'series_id': id, 'upto': upto, 'size': row_count, 'limit': limit, 'offset': offset,
+                              'data': characters}, 200)
+
+
+class SyncRESTResource(Resource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @check_pagination
+    def get(self, offset: int = 0, limit: int = LIMIT):
+        since = request.args.get('since', '')
+        try:
+            return changes_since(since, limit)
+        except ValueError as e:
+            logger.info('Invalid sync position: %s', e)
+            return error_response(400, ErrorType.INPUT_ERROR, 'Invalid value for since')
+        except Exception as e:
+            logger.error('Could not collect changes: %s', e)
+            return error_response(500, ErrorType.SERVER_ERROR, 'Could not collect changes due to an unexpected error')
+
+
+class BatchRESTResource(Resource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def post(self):
+        if not request.is_json:
+            return error_response(400, ErrorType.INPUT_ERROR, 'MimeType is not application/json')
+
+        try:
+            input_data = BatchSchema().load(request.json)
+        except ValidationError as e:
+            return return_validation_errors(e)
+
+        try:
+            responses = run_batch(input_data['requests'])
+        except Exception as e:
+            logger.error('Could not run batch: %s', e)
+            return unexpected_error_response(e, 'Could not run batch due to an unexpected error')
+
+        return make_response({'responses': responses}, 200)
+
+
+class OrderIntegrityRESTResource(Resource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def get(self):
+        try:
+            return make_response(check_order_in_series(), 200)
+        except Exception as e:
+            logger.error('Could not check order_in_series: %s', e)
+            return error_response(500, ErrorType.SERVER_ERROR, 'Could not check entries due to an unexpected error')
+
+    def post(self):
+        try:
+            return make_response(repair_order_in_series(), 200)
+        except Exception as e:
+            logger.error('Could not repair order_in_series: %s', e)
+            return unexpected_error_response(e, 'Could not repair entries due to an unexpected error')
+
+
+class JobRESTResource(Resource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @check_pagination
+    def get(self, id: int = None, offset: int = 0, limit: int = LIMIT):
+        try:
+            if id:
+                job = db.session.get(Job, id)
+                if job is None:
+                    return error_response(404, ErrorType.NOT_FOUND, 'No job found with given ID')
+                return make_response(job.to_dict(), 200)
+
+            job_list = db.session.execute(select(Job).order_by(Job.id.desc()).offset(offset).limit(limit)) \
+                .scalars().all()
+            row_count = db.session.execute(select(count(Job.id))).scalar()
+            return multi_data_response(job_list, row_count, offset, limit)
+        except Exception as e:
+            logger.error(e)
+            return error_response(500, ErrorType.SERVER_ERROR, 'Could not query jobs due to an unexpected error')
+
+    def post(self, id: int = None):
+        if not request.is_json:
+            return error_response(400, ErrorType.INPUT_ERROR, 'MimeType is not application/json')
+
+        try:
+            input_data = compile_schema(Job.schema).load(request.json)
+            params = jobs.load_params(input_data['type'], input_data['params'])
+        except ValidationError as e:
+            return return_validation_errors(e)
+        except KeyError:
+            return error_response(400, ErrorType.INPUT_ERROR,
+                                  'Unknown job type, use one of {}'.format(', '.join(jobs.job_types())))
+
+        try:
+            job = jobs.job_runner.submit(input_data['type'], params)
+        except jobs.JobQueueFull:
+            return overloaded_response(503, 'Too many queued jobs, try again later', 30)
+        except Exception as e:
+            logger.error(e)
+            db.session.rollback()
+            return unexpected_error_response(e, 'Could not create job due to an unexpected error')
+
+        response = make_response(job.to_dict(), 202)
+        response.headers['Location'] = '/rest/jobs/{}'.format(job.id)
+        return response
@@ -0,0 +1,152 @@
+import logging
+from datetime import date
+from typing import Callable, Dict, List, Tuple
+
+from marshmallow import Schema, ValidationError, fields
+
+logger = logging.getLogger(__name__)
+
+_MISSING_MESSAGE = 'Missing data for required field.'
+_NULL_MESSAGE = 'Field may not be null.'
+_UNKNOWN_MESSAGE = 'Unknown field.'
+_INVALID_INPUT_MESSAGE = 'Invalid input type.'
+
+
+def _fast_int(value):
+    if type(value) is int:
+        return value
+    raise TypeError()
+
+
+def _fast_str(value):
+    if type(value) is str:
+        return value
+    raise TypeError()
+
+
+def _fast_date(value):
+    if type(value) is str and len(value) == 10 and value[4] == '-' and value[7] == '-':
+        return date.fromisoformat(value)
+    raise TypeError()
+
+
+# conversions of the common input types of a field type, other inputs are handed to the marshmallow field
+_FAST_CONVERSIONS = {
+    fields.Integer: _fast_int,
+    fields.String: _fast_str,
+    fields.Date: _fast_date,
+}
+
+
+class CompiledSchema:
+    """
+    Single pass validator for flat marshmallow schemas with the same result and error messages as `Schema.load`.
+    Values of the usual JSON type are converted inline, all other values are deserialized by the marshmallow field so
+    coercions and error messages are identical. Schemas using features which aren't compiled (nested fields, field
+    validators, load hooks...) are loaded by marshmallow.
+
+    The loaded dict is keyed by attribute names, which are the column keys of the models, so it can be used as a
+    parameter row for Core statements as well.
+    """
+
+    def __init__(self, schema: Schema):
+        self.schema = schema
+        # (data key, attribute name, field, fast conversion)
+        self._fields: List[Tuple[str, str, fields.Field, Callable]] = []
+        self._data_keys = set()
+        self._schema_validators: List[str] = []
+        self.compiled = self._compile()
+        if not self.compiled:
+            logger.info('Schema %s is not compiled, using marshmallow', type(schema).__name__)
+
+    def _compile(self) -> bool:
+        schema = self.schema
+        if schema.many or schema.unknown != 'raise':
+            return False
+
+        hooks = getattr(schema, '_hooks', None)
+        if not isinstance(hooks, dict):
+            return False
+        for tag, hook_list in hooks.items():
+            if not hook_list:
+                continue
+            if tag != 'validates_schema':
+                return False
+            for name, many, kwargs in hook_list:
+                if many or kwargs.get('pass_original') or not kwargs.get('skip_on_field_errors', True):
+                    return False
+                self._schema_validators.append(name)
+
+        for attribute, field in schema.fields.items():
+            conversion = _FAST_CONVERSIONS.get(type(field))
+            if conversion is None or field.validators or field.dump_only or field.allow_none:
+                return False
+            data_key = field.data_key if field.data_key is not None else attribute
+            self._fields.append((data_key, field.attribute or attribute, field, conversion))
+            self._data_keys.add(data_key)
+        return True
+
+    def load(self, data, partial: bool = False) -> Dict:
+        """
+        :raise ValidationError: With the same messages as `Schema.load`
+        """
+        if not self.compiled:
+            return self.schema.load(data, partial=partial)
+
+        if not isinstance(data, dict):
+            raise ValidationError({'_schema': [_INVALID_INPUT_MESSAGE]})
+
+        result = {}
+        errors = {}
+        for data_key, attribute, field, conversion in self._fields:
+            value = data.get(data_key, data)
+            if value is data:
+                if field.required and not partial:
+                    errors[data_key] = [_MISSING_MESSAGE]
+                continue
+            if value is None:
+                errors[data_key] = [_NULL_MESSAGE]
+                continue
+
+            try:
+                result[attribute] = conversion(value)
+            except (TypeError, ValueError):
+                try:
+                    result[attribute] = field.deserialize(value, data_key, data)
+                except ValidationError as e:
+                    errors[data_key] = e.messages
+
+        if len(data) > len(result) or errors:
+            for key in data:
+                if key not in self._data_keys:
+                    errors[key] = [_UNKNOWN_MESSAGE]
+
+        if errors:
+            raise ValidationError(errors, data=data, valid_data=result)
+
+        for name in self._schema_validators:
+            try:
+                getattr(self.schema, name)(result, partial=partial, many=False)
+            except ValidationError as e:
+                field_name = e.field_name or '_schema'
+                messages = e.messages if isinstance(e.messages, list) else [e.messages]
+                errors.setdefault(field_name, []).extend(messages)
+        if errors:
+            raise ValidationError(errors, data=data, valid_data=result)
+        return result
+
+
+# (schema class, options changing the loaded fields) -> compiled schema
+_compiled_schemas: Dict[Tuple, CompiledSchema] = {}
+
+
+def compile_schema(schema: Schema) -> CompiledSchema:
+    """
+    :return: Compiled schema, cached per schema class and options (`many`, `unknown`, `only`/`exclude`), so schema
+        instances created per request compile once
+    """
+    key = (type(schema), schema.many, schema.unknown, tuple(schema.fields))
+    compiled = _compiled_schemas.get(key)
+    if compiled is None:
+        compiled = _compiled_schemas.setdefault(key, CompiledSchema(schema))
+    return compiled
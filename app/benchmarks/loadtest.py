@@ -0,0 +1,327 @@
+"""
+Load generator for the REST API. Starts the application (`create_app()`) against a local SQLite file in a threaded
+werkzeug server and lets many concurrent clients replay a weighted mix of operations. Reports throughput, latency
+percentiles, error rates and `database is locked` occurrences per interval and per operation.
+
+Example (run from the app directory):
+
+    python -m benchmarks.loadtest --db /tmp/loadtest.db --clients 32 --duration 30 \\
+        --mix series_entries=40,series_characters=30,search=10,info_write=15,entry_reorder=5 \\
+        --burst-mix info_write=70,entry_reorder=30 --burst-every 10 --burst-length 3
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Sample(NamedTuple):
+    # seconds since start of the run
+    time: float
+    operation: str
+    latency: float
+    status: int
+
+
+class LockedCounter(logging.Handler):
+    """
+    Counts log records of the application mentioning `database is locked`, the REST resources log the exception
+    before returning a generic 500 response.
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.lock = threading.Lock()
+        self.timestamps: List[float] = []
+
+    def emit(self, record: logging.LogRecord):
+        if 'database is locked' in record.getMessage():
+            with self.lock:
+                self.timestamps.append(time.perf_counter())
+
+
+class Dataset(NamedTuple):
+    series_ids: List[int]
+    # series id -> entry ids
+    entry_ids: Dict[int, List[int]]
+    # series id -> character ids
+    character_ids: Dict[int, List[int]]
+    info_ids: List[int]
+
+
+def seed_database(series_count: int, entries_per_series: int, characters_per_series: int,
+                  infos_per_character: int, seed: int) -> Dataset:
+    from database import db
+    from models.character import Character
+    from models.character_info import CharacterInfo
+    from models.entry import Entry
+    from models.series import Series
+    from tools.datagen import generate_data
+
+    if db.session.query(Series.id).first() is None:
+        logger.info('Seeding database with %d series', series_count)
+        generate_data(series_count, entries_per_series, characters_per_series, infos_per_character, seed)
+
+    dataset = Dataset([], {}, {}, [])
+    for series_id, in db.session.query(Series.id):
+        dataset.series_ids.append(series_id)
+    for entry_id, series_id in db.session.query(Entry.id, Entry.series_id):
+        dataset.entry_ids.setdefault(series_id, []).append(entry_id)
+    for character_id, series_id in db.session.query(Character.id, Character.series_id):
+        dataset.character_ids.setdefault(series_id, []).append(character_id)
+    dataset.info_ids.extend(info_id for info_id, in db.session.query(CharacterInfo.id))
+    db.session.remove()
+    return dataset
+
+
+class Client(threading.Thread):
+
+    def __init__(self, number: int, port: int, dataset: Dataset, workload: 'Workload', start_time: float,
+                 deadline: float, seed: int):
+        super().__init__(name='loadtest-client-{}'.format(number), daemon=True)
+        self.port = port
+        self.dataset = dataset
+        self.workload = workload
+        self.start_time = start_time
+        self.deadline = deadline
+        self.rng = random.Random(seed + number)
+        self.samples: List[Sample] = []
+        self.connection: Optional[http.client.HTTPConnection] = None
+
+    def run(self):
+        self.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        while True:
+            now = time.perf_counter()
+            if now >= self.deadline:
+                break
+
+            operation = self.workload.choose(now - self.start_time, self.rng)
+            method, path, body = getattr(self, 'op_' + operation)()
+            status = self.request(method, path, body)
+            self.samples.append(Sample(now - self.start_time, operation, time.perf_counter() - now, status))
+        self.connection.close()
+
+    def request(self, method: str, path: str, body: Dict = None) -> int:
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, path, payload, headers)
+            response = self.connection.getresponse()
+            response.read()
+            return response.status
+        except (http.client.HTTPException, OSError) as e:
+            logger.debug('Request failed: %s', e)
+            self.connection.close()
+            self.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            return 0
+
+    def _series_id(self) -> int:
+        return self.rng.choice(self.dataset.series_ids)
+
+    def op_series_list(self) -> Tuple[str, str, Optional[Dict]]:
+        return 'GET', '/rest/series?limit=50', None
+
+    def op_series_entries(self) -> Tuple[str, str, Optional[Dict]]:
+        return 'GET', '/rest/series/{}/entries?limit=50'.format(self._series_id()), None
+
+    def op_series_characters(self) -> Tuple[str, str, Optional[Dict]]:
+        return 'GET', '/rest/series/{}/characters?limit=50'.format(self._series_id()), None
+
+    def op_search(self) -> Tuple[str, str, Optional[Dict]]:
+        return 'POST', '/rest/characters/search?limit=10&count=none', {'name': str(self.rng.randint(0, 9))}
+
+    def op_info_write(self) -> Tuple[str, str, Optional[Dict]]:
+        series_id = self._series_id()
+        return 'POST', '/rest/characterinfo', {
+            'text': 'Load test info {}'.format(self.rng.random()),
+            'seriesId': self.rng.choice(self.dataset.entry_ids[series_id]),
+            'characterId': self.rng.choice(self.dataset.character_ids[series_id])
+        }
+
+    def op_info_update(self) -> Tuple[str, str, Optional[Dict]]:
+        return 'PATCH', '/rest/characterinfo/{}'.format(self.rng.choice(self.dataset.info_ids)), {
+            'text': 'Updated load test info {}'.format(self.rng.random())
+        }
+
+    def op_entry_reorder(self) -> Tuple[str, str, Optional[Dict]]:
+        entry_ids = self.dataset.entry_ids[self._series_id()]
+        return 'PATCH', '/rest/entries/{}'.format(self.rng.choice(entry_ids)), {
+            'order_in_series': self.rng.randint(1, len(entry_ids))
+        }
+
+
+OPERATIONS = [name[len('op_'):] for name in dir(Client) if name.startswith('op_')]
+
+
+class Workload:
+    """
+    Weighted operation mix, optionally switching to a burst mix for `burst_length` seconds every `burst_every` seconds.
+    """
+
+    def __init__(self, mix: Dict[str, int], burst_mix: Dict[str, int] = None, burst_every: float = 0,
+                 burst_length: float = 0):
+        self.mix = list(mix.keys()), list(mix.values())
+        self.burst_mix = (list(burst_mix.keys()), list(burst_mix.values())) if burst_mix else None
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+
+    def in_burst(self, elapsed: float) -> bool:
+        return bool(self.burst_mix and self.burst_every) and elapsed % self.burst_every < self.burst_length
+
+    def choose(self, elapsed: float, rng: random.Random) -> str:
+        operations, weights = self.burst_mix if self.in_burst(elapsed) else self.mix
+        return rng.choices(operations, weights)[0]
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for part in value.split(','):
+        operation, _, weight = part.partition('=')
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError('Unknown operation {}, must be one of: {}'.format(
+                operation, ', '.join(OPERATIONS)))
+        mix[operation] = int(weight or 1)
+    return mix
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: List[Sample], duration: float, locked: int) -> Dict:
+    latencies = sorted(sample.latency for sample in samples)
+    errors = sum(1 for sample in samples if sample.status == 0 or sample.status >= 500)
+    return {
+        'requests': len(samples),
+        'throughput': len(samples) / duration if duration else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        'error_rate': errors / len(samples) if samples else 0.0,
+        'locked': locked
+    }
+
+
+def report(samples: List[Sample], locked_times: List[float], duration: float, interval: float) -> Dict:
+    intervals = []
+    bucket_count = max(1, int(round(duration / interval)))
+    for bucket in range(bucket_count):
+        # the last interval also covers the requests finishing after the deadline
+        start, end = bucket * interval, (bucket + 1) * interval if bucket < bucket_count - 1 else duration
+        bucket_samples = [sample for sample in samples if start <= sample.time < end]
+        bucket_locked = sum(1 for locked_time in locked_times if start <= locked_time < end)
+        intervals.append({'start': start, **summarize(bucket_samples, end - start, bucket_locked)})
+
+    operations = {}
+    for operation in sorted({sample.operation for sample in samples}):
+        operations[operation] = summarize([sample for sample in samples if sample.operation == operation], duration, 0)
+
+    return {
+        'total': summarize(samples, duration, len(locked_times)),
+        'operations': operations,
+        'intervals': intervals
+    }
+
+
+def print_report(result: Dict):
+    columns = ('requests', 'throughput', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'error_rate', 'locked')
+    header = ''.join('{:>12}'.format(column) for column in columns)
+
+    def row(values: Dict) -> str:
+        return ''.join('{:>12.2f}'.format(values[column]) if isinstance(values[column], float)
+                       else '{:>12}'.format(values[column]) for column in columns)
+
+    print('{:>18}{}'.format('interval start', header))
+    for interval in result['intervals']:
+        print('{:>17.1f}s{}'.format(interval['start'], row(interval)))
+    print()
+    print('{:>18}{}'.format('operation', header))
+    for operation, values in result['operations'].items():
+        print('{:>18}{}'.format(operation, row(values)))
+    print('{:>18}{}'.format('total', row(result['total'])))
+
+
+def run(args: argparse.Namespace) -> Dict:
+    os.environ['DB_CONNECTION_STRING'] = 'sqlite+pysqlite:///{}'.format(os.path.abspath(args.db))
+
+    from werkzeug.serving import make_server
+    from webapp import create_app
+
+    app = create_app()
+    dataset = seed_database(args.series, args.entries, args.characters, args.infos, args.seed)
+    if not dataset.series_ids:
+        raise RuntimeError('Database contains no series')
+
+    locked_counter = LockedCounter()
+    logging.getLogger().addHandler(locked_counter)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, name='loadtest-server', daemon=True)
+    server_thread.start()
+    logger.info('Serving on port %d, starting %d clients for %.1fs', server.server_port, args.clients, args.duration)
+
+    workload = Workload(args.mix, args.burst_mix, args.burst_every, args.burst_length)
+    start_time = time.perf_counter()
+    clients = [Client(number, server.server_port, dataset, workload, start_time, start_time + args.duration, args.seed)
+               for number in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    duration = time.perf_counter() - start_time
+
+    server.shutdown()
+    logging.getLogger().removeHandler(locked_counter)
+
+    samples = sorted((sample for client in clients for sample in client.samples), key=lambda sample: sample.time)
+    locked_times = [locked_time - start_time for locked_time in locked_counter.timestamps]
+    return report(samples, locked_times, duration, args.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mixed read/write load test against a local SQLite database')
+    parser.add_argument('--db', default='loadtest.db', help='SQLite database file, seeded if it contains no series')
+    parser.add_argument('--clients', type=int, default=16, help='Number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=20, help='Duration of the run in seconds')
+    parser.add_argument('--interval', type=float, default=1, help='Length of a reporting interval in seconds')
+    parser.add_argument('--mix', type=parse_mix,
+                        default=parse_mix('series_list=5,series_entries=40,series_characters=30,search=10,'
+                                          'info_write=10,entry_reorder=5'),
+                        help='Comma separated operation=weight list, operations: {}'.format(', '.join(OPERATIONS)))
+    parser.add_argument('--burst-mix', type=parse_mix, default=None, help='Operation mix used during bursts')
+    parser.add_argument('--burst-every', type=float, default=0, help='Seconds between the start of two bursts')
+    parser.add_argument('--burst-length', type=float, default=0, help='Length of a burst in seconds')
+    parser.add_argument('--series', type=int, default=20, help='Number of seeded series')
+    parser.add_argument('--entries', type=int, default=20, help='Number of seeded entries per series')
+    parser.add_argument('--characters', type=int, default=50, help='Number of seeded characters per series')
+    parser.add_argument('--infos', type=int, default=2, help='Number of seeded infos per character')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    parser.add_argument('--json', help='Write the full report as JSON to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    result = run(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Throughput of concurrent entry ordering operations (inserts at a position, moves and deletes within one series) with
+one and with several writer threads. Writers of a series take turns on the write lock (see `Entry._lock_series`), the
+ratio shows how much throughput waiting for the lock costs. The order invariant is checked after each run.
+
+Example (run from the app directory):
+
+    python -m benchmarks.ordering --db /tmp/ordering.db --threads 8 --duration 5
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from datetime import date
+from typing import Dict
+
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import ObjectDeletedError, StaleDataError
+
+
+def hammer(series_id: int, entrytype_id: int, threads: int, seconds: float) -> Dict:
+    from database import db
+    from models.entry import Entry
+
+    done = []
+    conflicts = []
+    timeouts = []
+    deadline = time.monotonic() + seconds
+
+    def worker(seed: int):
+        generator = random.Random(seed)
+        session = db.session
+        try:
+            while time.monotonic() < deadline:
+                ids = session.execute(select(Entry.id).where(Entry.series_id == series_id)).scalars().all()
+                try:
+                    operation = generator.random()
+                    if operation < 0.5 or len(ids) < 5:
+                        session.add(Entry('entry', date(2021, 1, 1), generator.randint(1, len(ids) + 1),
+                                          entrytype_id, series_id))
+                    elif operation < 0.8:
+                        session.get(Entry, generator.choice(ids)).order_in_series = generator.randint(1, len(ids))
+                    else:
+                        session.delete(session.get(Entry, generator.choice(ids)))
+                    session.commit()
+                    done.append(operation)
+                except (ValueError, ObjectDeletedError, StaleDataError):
+                    # positions computed from a count read before a concurrent delete, deleted entries
+                    session.rollback()
+                    conflicts.append(operation)
+                except OperationalError:
+                    session.rollback()
+                    timeouts.append(operation)
+        finally:
+            session.remove()
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    orders = db.session.execute(select(Entry._order_in_series).where(Entry.series_id == series_id)
+                                .order_by(Entry._order_in_series)).scalars().all()
+    db.session.remove()
+    return {
+        'threads': threads,
+        'operations_per_second': round(len(done) / seconds, 1),
+        'conflicts': len(conflicts),
+        'timeouts': len(timeouts),
+        'order_valid': orders == list(range(1, len(orders) + 1))
+    }
+
+
+def run(db_path: str, threads: int, seconds: float) -> Dict:
+    from database import db
+    from models.entrytype import EntryType
+    from models.series import Series
+
+    db.connect_db('sqlite+pysqlite:///{}'.format(os.path.abspath(db_path)))
+    try:
+        series = Series('ordering benchmark {}'.format(time.time()))
+        entrytype = db.session.execute(select(EntryType).limit(1)).scalar() or EntryType('ordering benchmark')
+        db.session.add_all([series, entrytype])
+        db.session.commit()
+        series_id, entrytype_id = series.id, entrytype.id
+        db.session.remove()
+
+        sequential = hammer(series_id, entrytype_id, 1, seconds)
+        parallel = hammer(series_id, entrytype_id, threads, seconds)
+        return {
+            'sequential': sequential,
+            'parallel': parallel,
+            'ratio': round(parallel['operations_per_second'] / max(sequential['operations_per_second'], 0.1), 2)
+        }
+    finally:
+        db.disconnect_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark concurrent entry ordering operations')
+    parser.add_argument('--db', default='ordering.db', help='SQLite database file')
+    parser.add_argument('--threads', type=int, default=8, help='Writer threads of the parallel run')
+    parser.add_argument('--duration', type=float, default=3, help='Seconds per run')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    result = run(args.db, args.threads, args.duration)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print(f'{"threads":>8}{"ops/s":>10}{"conflicts":>11}{"timeouts":>10}{"order valid":>13}')
+    for key in ('sequential', 'parallel'):
+        values = result[key]
+        print(f'{values["threads"]:>8}{values["operations_per_second"]:>10}{values["conflicts"]:>11}'
+              f'{values["timeouts"]:>10}{str(values["order_valid"]):>13}')
+    print(f'parallel / sequential throughput: {result["ratio"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Compares the NumPy and the plain Python implementation of the character co-occurrence computation of `relations` on a
+synthetic series. No database is needed.
+
+Example (run from the app directory):
+
+    python -m benchmarks.relations --characters 5000 --entries 500 --per-entry 40
+"""
+import argparse
+import json
+import random
+import time
+from typing import Dict
+
+from database import LIMIT
+import relations
+from relations import SeriesColumns
+
+
+def synthetic_columns(characters: int, entries: int, per_entry: int, seed: int = 1) -> SeriesColumns:
+    generator = random.Random(seed)
+    entry_ids, orders, character_ids = [], [], []
+    for order in range(1, entries + 1):
+        for character_id in sorted(generator.sample(range(1, characters + 1), min(per_entry, characters))):
+            entry_ids.append(order)
+            orders.append(order)
+            character_ids.append(character_id)
+    return SeriesColumns(entry_ids, orders, character_ids)
+
+
+def run(characters: int, entries: int, per_entry: int) -> Dict:
+    if relations.numpy is None:
+        raise SystemExit('NumPy is not installed')
+
+    columns = synthetic_columns(characters, entries, per_entry)
+    length = columns.prefix_length(None)
+
+    start = time.perf_counter()
+    numpy_result = relations._relations_numpy(columns, length)
+    numpy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    python_result = relations._relations_python(columns, length)
+    python_seconds = time.perf_counter() - start
+
+    # building the response dicts of the first page
+    start = time.perf_counter()
+    numpy_result.page(0, LIMIT)
+    page_seconds = time.perf_counter() - start
+
+    return {
+        'appearances': length,
+        'pairs': numpy_result.size,
+        'numpy_ms': round(numpy_seconds * 1000, 1),
+        'python_ms': round(python_seconds * 1000, 1),
+        'speedup': round(python_seconds / numpy_seconds, 1),
+        'page_ms': round(page_seconds * 1000, 1),
+        'equal': numpy_result.page(0, numpy_result.size) == python_result.page(0, python_result.size)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark character co-occurrence computation')
+    parser.add_argument('--characters', type=int, default=2000, help='Characters of the series')
+    parser.add_argument('--entries', type=int, default=200, help='Entries of the series')
+    parser.add_argument('--per-entry', type=int, default=30, help='Characters with infos per entry')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.characters, args.entries, args.per_entry), indent=2))
+
+
+if __name__ == '__main__':
+    main()
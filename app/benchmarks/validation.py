@@ -0,0 +1,76 @@
+"""
+Compares marshmallow's `Schema.load` with the compiled validators of `api.validation` for typical write and search
+payloads. No database is needed.
+
+Example (run from the app directory):
+
+    python -m benchmarks.validation --iterations 50000
+"""
+import argparse
+import json
+import time
+from typing import Callable, Dict, List, Tuple
+
+from marshmallow import Schema, ValidationError
+
+from api.validation import compile_schema
+from models.character import CharacterSchema
+from models.character_info import CharacterInfoSchema
+from models.entry import EntrySchema, EntrySearchSchema
+from models.series import SeriesSchema
+
+CASES: List[Tuple[str, Schema, Dict, bool]] = [
+    ('series', SeriesSchema(), {'name': 'Riyria Revelations'}, False),
+    ('entry', EntrySchema(), {'name': 'Theft of Swords', 'date': '2011-01-01', 'order_in_series': 1,
+                              'entrytype_id': 1, 'series_id': 1}, False),
+    ('entry_patch', EntrySchema(), {'order_in_series': 3}, True),
+    ('entry_invalid', EntrySchema(), {'name': 1, 'date': 'yesterday', 'series_id': 'x'}, False),
+    ('entry_search', EntrySearchSchema(), {'name': 'Dune', 'series_id': 2}, False),
+    ('character', CharacterSchema(), {'name': 'Hadrian', 'series_id': 1, 'occurs_first_in_entry_id': 1}, False),
+    ('character_info', CharacterInfoSchema(), {'text': 'Mercenary', 'seriesId': 1, 'characterId': 1}, False),
+]
+
+
+def _time(load: Callable, payload: Dict, partial: bool, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        try:
+            load(payload, partial=partial)
+        except ValidationError:
+            pass
+    return time.perf_counter() - start
+
+
+def run(iterations: int) -> List[Dict]:
+    results = []
+    for name, schema, payload, partial in CASES:
+        compiled = compile_schema(schema)
+        marshmallow_seconds = _time(schema.load, payload, partial, iterations)
+        compiled_seconds = _time(compiled.load, payload, partial, iterations)
+        results.append({
+            'case': name,
+            'marshmallow_us': round(marshmallow_seconds / iterations * 1e6, 2),
+            'compiled_us': round(compiled_seconds / iterations * 1e6, 2),
+            'speedup': round(marshmallow_seconds / compiled_seconds, 1)
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark input validation')
+    parser.add_argument('--iterations', type=int, default=20000, help='Loads per case and validator')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f'{"case":<16}{"marshmallow us":>16}{"compiled us":>14}{"speedup":>10}')
+    for result in results:
+        print(f'{result["case"]:<16}{result["marshmallow_us"]:>16}{result["compiled_us"]:>14}{result["speedup"]:>9}x')
+
+
+if __name__ == '__main__':
+    main()
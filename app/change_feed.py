@@ -0,0 +1,344 @@
+import json
+import logging
+import os
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from flask import Response, request
+from sqlalchemy import select
+
+import changes
+from api.errors import ErrorType, error_response
+from changes import Change
+from coherence import read_changes
+from database import db
+from revisions import committed_revision, format_sync_position, parse_sync_position, revision_counter
+from sharding import REPLICATED_TABLES
+
+logger = logging.getLogger(__name__)
+
+# number of change events kept for clients which reconnect with a Last-Event-ID
+BUFFER_SIZE = int(os.getenv('CHANGE_FEED_BUFFER_SIZE', '1000'))
+# seconds between polls of the revision counters, commits of this process are polled right away
+POLL_INTERVAL = float(os.getenv('CHANGE_FEED_POLL_INTERVAL', '1'))
+# seconds between keep-alive comments on an idle stream
+HEARTBEAT_INTERVAL = 15.0
+
+STREAM_ENTITIES = ('series', 'entrytypes', 'entries', 'characters', 'characterinfo')
+STREAM_PATH = '/rest/changes/stream'
+STREAM_HEADERS: Dict[str, str] = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# committed revision of each database, the primary database first
+Position = Tuple[int, ...]
+
+
+def _covers(position: Position, other: Position) -> bool:
+    """
+    :return: True if no revision of the other position is newer than the one of the position
+    """
+    return len(position) == len(other) and all(revision >= other_revision
+                                               for revision, other_revision in zip(position, other))
+
+
+class ChangeFeed:
+    """
+    Append only log of the changes committed by all worker processes sharing the database. A poller thread reads the
+    committed revisions (see `revisions`) every POLL_INTERVAL seconds and right after the commits of this process, and
+    appends the rows changed and deleted since its last poll, read from the revision indexes like the cache coherence
+    checks do. The position of a change is the sync position of its revision, so positions are the same in every
+    process and a client can resume its stream at any worker.
+
+    Subscribers keep their own position in the log and block on a shared condition until a poll appends new changes,
+    so publishing is independent of the number of subscribers and there is no queue per subscriber. Evented servers
+    (see `feed_server`) register a waker instead of blocking a thread. Inserts can't be told apart from updates by
+    their revision, both are published as updates.
+    """
+
+    def __init__(self, buffer_size: int = BUFFER_SIZE, poll_interval: float = POLL_INTERVAL):
+        self._events: Deque[Tuple[Position, Change]] = deque(maxlen=buffer_size)
+        self.poll_interval = poll_interval
+        self._position: Position = ()
+        # position before the oldest buffered change
+        self._first: Position = ()
+        self._closed = True
+        self._condition = threading.Condition()
+        self._poll_lock = threading.Lock()
+        self._poll_requested = threading.Event()
+        self._poller: Optional[threading.Thread] = None
+        # called without lock after changes were appended or the feed was closed
+        self._wakers: List[Callable[[], None]] = []
+
+    @property
+    def position(self) -> Position:
+        return self._position
+
+    def add_waker(self, waker: Callable[[], None]):
+        self._wakers.append(waker)
+
+    def remove_waker(self, waker: Callable[[], None]):
+        if waker in self._wakers:
+            self._wakers.remove(waker)
+
+    def _wake(self):
+        for waker in list(self._wakers):
+            try:
+                waker()
+            except Exception as e:
+                logger.error('Could not wake change feed subscribers: %s', e)
+
+    @staticmethod
+    def _read_position() -> Position:
+        query = select(committed_revision).where(revision_counter.c.id == 1)
+        position = []
+        for engine in db.engines:
+            with engine.connect() as connection:
+                position.append(connection.execute(query).scalar() or 0)
+        return tuple(position)
+
+    def poll(self) -> int:
+        """
+        Appends the changes committed since the last poll.
+
+        :return: Number of appended changes
+        """
+        with self._poll_lock:
+            since = self._position
+            until = self._read_position()
+            if since == until or not _covers(until, since):
+                return 0
+
+            position = list(since)
+            events = []
+            shard_ids = db.router.shard_ids if db.sharded else [None]
+            for index, (engine, shard_id) in enumerate(zip(db.engines, shard_ids)):
+                if until[index] == since[index]:
+                    continue
+                with engine.connect() as connection:
+                    for revision, change in read_changes(connection, since[index], until[index], shard_id):
+                        # replicated tables are changed on every shard, their changes are taken from the primary
+                        if index == 0 or change.entity not in REPLICATED_TABLES:
+                            position[index] = revision
+                            events.append((tuple(position), change))
+                position[index] = until[index]
+
+            with self._condition:
+                for event in events:
+                    if len(self._events) == self._events.maxlen:
+                        self._first = self._events[0][0]
+                    self._events.append(event)
+                self._position = until
+                self._condition.notify_all()
+        self._wake()
+        return len(events)
+
+    def _poll_changes(self):
+        while not self._closed:
+            self._poll_requested.wait(self.poll_interval)
+            self._poll_requested.clear()
+            if self._closed:
+                break
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error('Could not poll the change feed: %s', e)
+
+    def request_poll(self, committed: List[Change] = None):
+        """
+        Lets the poller poll right away, a commit listener.
+        """
+        self._poll_requested.set()
+
+    def start_polling(self):
+        """
+        Starts the poller unless it runs, done by the first subscriber.
+        """
+        if self._poller is None and not self._closed:
+            with self._condition:
+                if self._poller is None:
+                    self._poller = threading.Thread(target=self._poll_changes, name='change-feed-poller', daemon=True)
+                    self._poller.start()
+
+    def reset(self):
+        """
+        Starts the feed at the current position of the databases.
+        """
+        with self._condition:
+            self._events.clear()
+            self._closed = False
+            self._position = self._first = self._read_position()
+
+    def close(self):
+        """
+        Stops the poller, wakes up all subscribers and ends their streams.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._poll_requested.set()
+        poller, self._poller = self._poller, None
+        if poller is not None and poller is not threading.current_thread():
+            poller.join()
+        self._wake()
+
+    def wait_after(self, position: Position, timeout: float) -> Tuple[List[Tuple[Position, Change]], Position, bool]:
+        """
+        Waits until there are changes after the given position.
+
+        :param position: Position of the last change the subscriber has seen
+        :param timeout: Maximum number of seconds to wait
+        :return: Tuple of the new changes (empty on timeout), the position to continue from and a flag which is True
+            if changes after the position are not in the buffer anymore, i.e. the subscriber has to reload its data
+        """
+        self.start_polling()
+        with self._condition:
+            if _covers(self._position, position):
+                self._condition.wait_for(lambda: self._closed or self._position != position, timeout)
+            return self.events_after(position)
+
+    def events_after(self, position: Position) -> Tuple[List[Tuple[Position, Change]], Position, bool]:
+        """
+        Like `wait_after` without waiting.
+        """
+        self.start_polling()
+        with self._condition:
+            if not _covers(self._position, position) or not _covers(position, self._first):
+                # position of another database or older than the buffer
+                return [], self._position, True
+            if self._position == position:
+                return [], position, False
+            return [event for event in self._events if not _covers(position, event[0])], self._position, False
+
+    def covers(self, position: Position) -> bool:
+        """
+        :return: False if the position is newer than the one of the feed
+        """
+        return _covers(self._position, position)
+
+    def catch_up(self, position: Position):
+        """
+        Polls if the position is newer than the one of the feed, a client reconnecting with the position of a worker
+        whose poller is ahead of the one of this process then doesn't have to reload its data.
+        """
+        if not self.covers(position):
+            self.poll()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+
+change_feed = ChangeFeed()
+
+
+def _format_position(position: Position) -> str:
+    return str(format_sync_position(list(position)))
+
+
+def _format_event(position: Optional[Position], change: Change) -> str:
+    data = json.dumps({
+        'entity': change.entity,
+        'id': change.id,
+        'series_id': change.series_id,
+        'operation': change.operation
+    }, separators=(',', ':'))
+    event_id = f'id: {_format_position(position)}\n' if position is not None else ''
+    return f'{event_id}event: change\ndata: {data}\n\n'
+
+
+def _matches(change: Change, entity: Optional[str], series_id: Optional[int]) -> bool:
+    if entity is not None and change.entity != entity:
+        return False
+    # bulk changes and changes of unknown series are sent to all clients, they have to reload
+    if series_id is not None and change.series_id is not None and change.series_id != series_id:
+        return False
+    return True
+
+
+def stream_start(position: Position) -> str:
+    return f'retry: 3000\nid: {_format_position(position)}\n\n'
+
+
+def render_events(events: List[Tuple[Position, Change]], next_position: Position, missed: bool,
+                  entity: Optional[str], series_id: Optional[int]) -> str:
+    """
+    :return: Stream chunk for a result of `wait_after`
+    """
+    if missed:
+        # the client reloads everything, the remaining changes are already included
+        return f'id: {_format_position(next_position)}\nevent: reset\ndata: {{}}\n\n'
+    if not events:
+        return ': keep-alive\n\n'
+
+    chunks = []
+    sent = None
+    for index, (position, change) in enumerate(events):
+        # the changes of a revision share its position, it is sent with the last one so a client which reconnects
+        # within a revision gets all its changes again
+        last_of_revision = index + 1 == len(events) or events[index + 1][0] != position
+        if _matches(change, entity, series_id):
+            chunks.append(_format_event(position if last_of_revision else None, change))
+            if last_of_revision:
+                sent = position
+    if sent != next_position:
+        # lets the client resume after the last change even if it didn't match the filters
+        chunks.append(f'id: {_format_position(next_position)}\n\n')
+    return ''.join(chunks)
+
+
+def _stream(feed: ChangeFeed, position: Position, entity: Optional[str], series_id: Optional[int],
+            heartbeat: float = HEARTBEAT_INTERVAL) -> Iterator[str]:
+    yield stream_start(position)
+    while not feed.closed:
+        events, next_position, missed = feed.wait_after(position, heartbeat)
+        yield render_events(events, next_position, missed, entity, series_id)
+        position = next_position
+
+
+def parse_stream_arguments(args: Mapping[str, str], last_event_id: Optional[str]) -> Tuple[Optional[str],
+                                                                                            Optional[int], Position]:
+    """
+    :param args: Query parameters of the stream request
+    :param last_event_id: Last-Event-ID header
+    :return: Tuple of entity, series id and position to continue after
+    :raise ValueError: With the error message if an argument is invalid
+    """
+    entity = args.get('entity')
+    if entity is not None and entity not in STREAM_ENTITIES:
+        raise ValueError(f'Unknown entity, use one of {", ".join(STREAM_ENTITIES)}')
+
+    try:
+        last_event_id = last_event_id or args.get('last_event_id')
+        position = tuple(parse_sync_position(last_event_id)) if last_event_id else change_feed.position
+    except ValueError:
+        raise ValueError('Invalid Last-Event-ID')
+
+    try:
+        series_id = int(args['series_id']) if args.get('series_id') is not None else None
+    except ValueError:
+        raise ValueError('Invalid series_id')
+    return entity, series_id, position
+
+
+def stream_changes():
+    """
+    Streams committed changes as server-sent events. Clients can resume a stream with the Last-Event-ID header (sent
+    by EventSource automatically) and restrict it with the `entity` and `series_id` query parameters.
+
+    Every open stream holds a worker thread, deployments with many clients serve the streams from the evented feed
+    server instead (see `feed_server`).
+    """
+    try:
+        entity, series_id, position = parse_stream_arguments(request.args, request.headers.get('Last-Event-ID'))
+    except ValueError as e:
+        return error_response(400, ErrorType.INPUT_ERROR, str(e))
+
+    logger.debug('stream_changes(%s, %s, %s)', entity, series_id, position)
+    change_feed.catch_up(position)
+    return Response(_stream(change_feed, position, entity, series_id), mimetype='text/event-stream',
+                    headers=STREAM_HEADERS)
+
+
+def init_change_feed():
+    change_feed.reset()
+    changes.add_commit_listener(change_feed.request_poll)
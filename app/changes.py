@@ -0,0 +1,131 @@
+import logging
+from typing import Callable, List, NamedTuple, Optional
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+SESSION_INFO_KEY = 'pending_changes'
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+class Change(NamedTuple):
+    # name of the table of the changed entity
+    entity: str
+    # ID of the changed entity, None if an unknown set of rows of the table has been changed (bulk statements)
+    id: Optional[int]
+    operation: str
+    # ID of the series the changed entity belongs to, None if unknown or if the entity doesn't belong to a series
+    series_id: Optional[int] = None
+
+
+_commit_listeners: List[Callable[[List[Change]], None]] = []
+
+
+def add_commit_listener(listener: Callable[[List[Change]], None]):
+    """
+    Registers a callable which is called with the list of changes of every committed transaction. Listeners are called
+    after the commit and must not use the session.
+    """
+    if listener not in _commit_listeners:
+        _commit_listeners.append(listener)
+
+
+_cache_listeners: List[Callable[[List[Change]], None]] = []
+
+
+def add_cache_listener(listener: Callable[[List[Change]], None]):
+    """
+    Registers a commit listener of an in-process cache, which is also called with the changes committed by other
+    processes (see `coherence`).
+    """
+    add_commit_listener(listener)
+    if listener not in _cache_listeners:
+        _cache_listeners.append(listener)
+
+
+def publish_external_changes(external_changes: List[Change]):
+    """
+    Publishes changes committed by other processes to the cache listeners.
+    """
+    for listener in _cache_listeners:
+        try:
+            listener(external_changes)
+        except Exception as e:
+            logger.error('Cache listener %s failed: %s', listener, e)
+
+
+def series_id_of(instance) -> Optional[int]:
+    """
+    Returns the ID of the series a model instance belongs to, None if it doesn't belong to a series.
+    """
+    if getattr(instance, '__tablename__', None) == 'series':
+        return instance.id
+
+    try:
+        return getattr(instance, 'series_id', None)
+    except Exception as e:
+        logger.debug('Could not determine series of %s: %s', instance, e)
+        return None
+
+
+def record_change(session, entity: str, id: Optional[int], operation: str, series_id: Optional[int] = None):
+    """
+    Records a change which can't be detected by the flush events (for example Core level `UPDATE` statements). The
+    change is published to the listeners when the session is committed.
+    """
+    logger.debug('record_change(%s, %s, %s, %s)', entity, id, operation, series_id)
+    session.info.setdefault(SESSION_INFO_KEY, []).append(Change(entity, id, operation, series_id))
+
+
+def has_pending_changes(session) -> bool:
+    """
+    :return: True if the session's transaction changed rows which aren't committed yet
+    """
+    return bool(session.new or session.dirty or session.deleted or session.info.get(SESSION_INFO_KEY))
+
+
+def _handle_after_flush(session, flush_context):
+    for operation, instances in ((INSERT, session.new), (UPDATE, session.dirty), (DELETE, session.deleted)):
+        for instance in instances:
+            table_name = getattr(instance, '__tablename__', None)
+            if table_name:
+                record_change(session, table_name, instance.id, operation, series_id_of(instance))
+
+
+def _handle_do_orm_execute(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None:
+        operation = UPDATE if orm_execute_state.is_update else DELETE
+        record_change(orm_execute_state.session, mapper.local_table.name, None, operation)
+
+
+def _handle_after_commit(session):
+    changes = session.info.pop(SESSION_INFO_KEY, None)
+    if not changes:
+        return
+
+    # deduplicate while keeping the order of the changes
+    changes = list(dict.fromkeys(changes))
+    for listener in _commit_listeners:
+        try:
+            listener(changes)
+        except Exception as e:
+            logger.error('Change listener %s failed: %s', listener, e)
+
+
+def _handle_after_rollback(session):
+    session.info.pop(SESSION_INFO_KEY, None)
+
+
+def init_change_tracking(session):
+    event.listen(session, 'after_flush', _handle_after_flush)
+    event.listen(session, 'do_orm_execute', _handle_do_orm_execute)
+    event.listen(session, 'after_commit', _handle_after_commit)
+    event.listen(session, 'after_rollback', _handle_after_rollback)
@@ -0,0 +1,133 @@
+"""
+Request coalescing (single flight) for the GET handlers: concurrent identical requests (same path and arguments) wait
+for the one which arrived first and get a copy of its response, instead of each running the same queries and
+serialization. Only requests which are in flight at the same time are coalesced, nothing is cached afterwards.
+
+A committed change starts a new generation, requests arriving after it don't join a computation which may have read
+the data before the change, so a client always sees its own writes.
+
+Waiting requests release their admission slot (see `admission`), only the request computing the response holds one.
+Sub-requests of batches aren't coalesced, they share the slot of their batch.
+
+    REQUEST_COALESCING=0        disable request coalescing
+"""
+import functools
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from flask import Response, current_app, g, request
+
+import changes
+from api.batch import is_sub_request
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException or None = None
+        self.followers = 0
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self.enabled = False
+        self._flights: Dict[Tuple, Flight] = {}
+        self._lock = threading.Lock()
+        # incremented on every committed change, part of the key of the flights
+        self._generation = 0
+
+    def do(self, key: Tuple, function: Callable, on_follow: Callable = None):
+        """
+        Runs the function, or waits for the running call with the same key and returns its result (or raises its
+        exception).
+
+        :param on_follow: Called before waiting for a running call
+        """
+        with self._lock:
+            key = (self._generation,) + key
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            else:
+                flight.followers += 1
+
+        if not leader:
+            if on_follow is not None:
+                on_follow()
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+            if flight.followers:
+                logger.debug('Coalesced %d requests with %s', flight.followers, key[1:])
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+    def handle_changes(self, committed_changes: List[changes.Change]):
+        if committed_changes:
+            with self._lock:
+                self._generation += 1
+
+
+single_flight = SingleFlight()
+
+
+def _release_admission_slot():
+    gate = g.pop('admission_gate', None)
+    if gate is not None:
+        gate.release()
+
+
+def coalesce(f):
+    """
+    Coalesces concurrent identical requests of a GET handler, see module documentation. Profiled requests and
+    sub-requests of batches (they share the admission slot of their batch, which must not be released while it runs
+    further sub-requests) always run on their own.
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if not single_flight.enabled or request.method != 'GET' or 'profiler' in g or is_sub_request():
+            return f(*args, **kwargs)
+
+        def render() -> Tuple[bytes, int, List]:
+            response = current_app.make_response(f(*args, **kwargs))
+            return response.get_data(), response.status_code, list(response.headers.items())
+
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        # every request gets its own response object, after_request handlers modify it
+        data, status, headers = single_flight.do(key, render, _release_admission_slot)
+        return Response(data, status, headers)
+
+    return wrapper
+
+
+def init_request_coalescing():
+    if os.getenv('REQUEST_COALESCING', '1').lower() in ('0', 'false', 'no', 'off'):
+        logger.info('Request coalescing disabled')
+        single_flight.enabled = False
+        return
+
+    changes.add_cache_listener(single_flight.handle_changes)
+    single_flight.enabled = True
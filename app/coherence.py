@@ -0,0 +1,178 @@
+"""
+Coherence of the in-process caches (reference caches, suggest indexes, relations, request coalescing) across worker
+processes sharing the database. The caches are maintained from the commits of their own process, commits of other
+processes are detected with the revision counter, which the revision triggers bump in the first write of every
+transaction (see `revisions`).
+
+At the start of every request the counter of each database is read (a primary key lookup). If it moved since the last
+check, the rows with a newer revision and the new tombstones are read from the revision indexes and published to the
+cache listeners as changes, so only the stale entries are dropped. Revisions committed by this process are skipped,
+its caches already got their changes at the commit (see `revisions.take_own_revisions`). More than MAX_CHANGES changed
+rows of a table invalidate the whole table.
+
+    CACHE_COHERENCE=0           disable the checks, for deployments with a single worker process
+"""
+import logging
+import os
+import threading
+from typing import Dict, List, Set, Tuple
+
+from flask import Flask
+from sqlalchemy import null, select
+
+import changes
+from changes import Change
+from database import db
+from revisions import committed_revision, revision_counter, take_own_revisions, tombstones
+
+logger = logging.getLogger(__name__)
+
+# changed rows of a table read per check, above that the whole table is invalidated
+MAX_CHANGES = 10000
+
+
+def _bind_arguments() -> List[Dict]:
+    if db.sharded:
+        return [{'shard_id': shard_id} for shard_id in db.router.shard_ids]
+    return [{}]
+
+
+def _changed_rows_queries() -> Dict:
+    """
+    :return: Table name -> query of the (id, series id) of its rows, without revision condition
+    """
+    from models.series import Series
+    from models.entrytype import EntryType
+    from models.entry import Entry
+    from models.character import Character
+    from models.character_info import CharacterInfo
+
+    series = Series.__table__
+    entrytypes = EntryType.__table__
+    entries = Entry.__table__
+    characters = Character.__table__
+    infos = CharacterInfo.__table__
+    return {
+        series.name: (series, select(series.c.id, series.c.id)),
+        entrytypes.name: (entrytypes, select(entrytypes.c.id, null())),
+        entries.name: (entries, select(entries.c.id, entries.c.series_id)),
+        characters.name: (characters, select(characters.c.id, characters.c.series_id)),
+        infos.name: (infos, select(infos.c.id, entries.c.series_id)
+                     .join_from(infos, entries, infos.c.entry_id == entries.c.id, isouter=True))
+    }
+
+
+def read_changes(connection, since: int, until: int, shard_id: str = None,
+                 skip: Set[int] = frozenset()) -> List[Tuple[int, Change]]:
+    """
+    Reads the rows changed and deleted in a range of revisions from the revision indexes of one database.
+
+    :param connection: Connection to the database
+    :param until: Last revision to read
+    :param shard_id: Shard of the database in sharded mode
+    :param skip: Revisions which are skipped
+    :return: Sorted list of (revision, change). A table with more than MAX_CHANGES changes gets a single change of
+        an unknown set of its rows instead, with the revision `until`
+    """
+    found = []
+    for table_name, (table, query) in _changed_rows_queries().items():
+        if shard_id is not None and shard_id not in db.router.shards_for_table(table_name):
+            continue
+        query = query.add_columns(table.c.revision).where(table.c.revision > since, table.c.revision <= until)
+        rows = connection.execute(query.limit(MAX_CHANGES + 1)).all()
+        if len(rows) > MAX_CHANGES:
+            logger.info('More than %d rows of %s changed, invalidating all', MAX_CHANGES, table_name)
+            found.append((until, Change(table_name, None, changes.DELETE)))
+        else:
+            found.extend((revision, Change(table_name, id, changes.UPDATE, series_id))
+                         for id, series_id, revision in rows if revision not in skip)
+
+    query = select(tombstones.c.entity, tombstones.c.entity_id, tombstones.c.series_id, tombstones.c.revision) \
+        .where(tombstones.c.revision > since, tombstones.c.revision <= until)
+    rows = connection.execute(query.limit(MAX_CHANGES + 1)).all()
+    if len(rows) > MAX_CHANGES:
+        found.extend((until, Change(table_name, None, changes.DELETE))
+                     for table_name in sorted({row[0] for row in rows}))
+    else:
+        found.extend((revision, Change(entity, id, changes.DELETE, series_id))
+                     for entity, id, series_id, revision in rows if revision not in skip)
+    found.sort(key=lambda change: change[0])
+    return found
+
+
+class CacheCoherence:
+
+    def __init__(self):
+        # last seen revision per database, None until reset
+        self._revisions: List[int] or None = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read_revisions() -> List[int]:
+        query = select(committed_revision).where(revision_counter.c.id == 1)
+        return [db.session.execute(query, bind_arguments=bind_arguments).scalar() or 0
+                for bind_arguments in _bind_arguments()]
+
+    def reset(self):
+        """
+        Takes the current revisions as seen, must be called before the caches are filled.
+        """
+        with self._lock:
+            self._revisions = self._read_revisions()
+
+    def check(self) -> int:
+        """
+        Publishes the changes committed by other processes since the last check to the cache listeners.
+
+        :return: Number of published changes
+        """
+        current = self._read_revisions()
+        if current == self._revisions:
+            return 0
+
+        with self._lock:
+            known = self._revisions
+            if known is None:
+                self._revisions = current
+                return 0
+            if all(revision <= since for revision, since in zip(current, known)):
+                # another request already published the changes
+                return 0
+
+            external = []
+            for since, revision, bind_arguments, engine in zip(known, current, _bind_arguments(), db.engines):
+                own = take_own_revisions(str(engine.url), revision)
+                # nothing to read if all new revisions were committed by this process
+                if revision > since and sum(1 for own_revision in own if own_revision > since) < revision - since:
+                    with engine.connect() as connection:
+                        external.extend(change for _, change in read_changes(
+                            connection, since, revision, bind_arguments.get('shard_id'), own))
+            # replicated tables are changed on every shard
+            external = list(dict.fromkeys(external))
+            logger.debug('Revisions %s -> %s, publishing %d changes', known, current, len(external))
+            changes.publish_external_changes(external)
+            self._revisions = [max(revision, since) for revision, since in zip(current, known)]
+            return len(external)
+
+
+cache_coherence = CacheCoherence()
+
+
+def check_cache_coherence():
+    try:
+        cache_coherence.check()
+    except Exception as e:
+        # the request is served from possibly stale caches instead of failing
+        logger.error('Could not check cache coherence: %s', e)
+
+
+def init_cache_coherence():
+    cache_coherence.reset()
+
+
+def init_coherence_checks(app: Flask):
+    if os.getenv('CACHE_COHERENCE', '1').lower() in ('0', 'false', 'no', 'off'):
+        logger.info('Cache coherence checks disabled')
+        return
+
+    app.before_request(check_cache_coherence)
@@ -1,19 +1,32 @@
 import logging
 import sqlite3
-from datetime import date
+import threading
+from contextlib import contextmanager
+from typing import Dict, List
 
-from flask import Response, make_response
 from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.horizontal_shard import ShardedSession
 from sqlalchemy.orm import sessionmaker, scoped_session
 
+from sharding import ShardRouter, PRIMARY_SHARD
+
 logger = logging.getLogger(__name__)
 
 LIMIT = 1000
+# seconds to wait for the write lock of the process, SQLite's default busy timeout
+WRITE_LOCK_TIMEOUT = 5
 
 
 class ScopedDBConnection:
+    # primary engine, in sharded mode the engine of the primary shard
     _engine = None
+    # shard id -> engine, only set in sharded mode
+    _shard_engines: Dict = None
+    _router: ShardRouter = None
     _scoped_session = None
+    # shard id (None if not sharded) -> lock of the write transactions of this process, see begin_write_transaction
+    _write_locks: Dict = {}
 
     @property
     def session(self):
@@ -25,9 +38,136 @@ class ScopedDBConnection:
                 raise RuntimeError(
                     'Can\'t create session, please connect to a database first')
 
-            self._scoped_session = scoped_session(sessionmaker(bind=self._engine, autocommit=False, autoflush=False))
+            if self._router:
+                session_factory = sessionmaker(class_=ShardedSession, autocommit=False, autoflush=False,
+                                               shards=self._shard_engines,
+                                               shard_chooser=self._router.shard_chooser,
+                                               id_chooser=self._router.id_chooser,
+                                               execute_chooser=self._router.execute_chooser)
+            else:
+                session_factory = sessionmaker(bind=self._engine, autocommit=False, autoflush=False)
+            self._scoped_session = scoped_session(session_factory)
             return self._scoped_session
 
+    @property
+    def sharded(self) -> bool:
+        return self._router is not None
+
+    @property
+    def router(self) -> ShardRouter or None:
+        return self._router
+
+    @property
+    def engines(self) -> List:
+        """
+        All engines, the primary engine first.
+        """
+        if self._shard_engines:
+            return list(self._shard_engines.values())
+        return [self._engine] if self._engine else []
+
+    def bind_arguments_for_table(self, table_name: str) -> List[Dict]:
+        """
+        `bind_arguments` for `session.execute` of a Core statement, one per shard holding rows of the given table (a
+        single empty dict if not sharded).
+        """
+        if not self._router:
+            return [{}]
+        return [{'shard_id': shard_id} for shard_id in self._router.shards_for_table(table_name)]
+
+    def bind_arguments_for_id(self, table_name: str, id: int) -> Dict:
+        """
+        `bind_arguments` for `session.execute` of a statement on the row with the given id.
+        """
+        if not self._router:
+            return {}
+        return {'shard_id': self._router.shard_for_id(table_name, id)}
+
+    def bind_arguments_for_series(self, series_id: int) -> Dict:
+        """
+        `bind_arguments` for `session.execute` of a statement on the entries, characters or character infos of a series.
+        """
+        if not self._router:
+            return {}
+        return {'shard_id': self._router.shard_for_series(series_id)}
+
+    @property
+    def supports_update_returning(self) -> bool:
+        """
+        Whether the connected database can execute `UPDATE ... RETURNING` (SQLite >= 3.35 or PostgreSQL).
+        """
+        if not self._engine:
+            raise RuntimeError('Not connected to a database')
+
+        dialect_name = self._engine.dialect.name
+        if dialect_name == 'sqlite':
+            return sqlite3.sqlite_version_info >= (3, 35, 0)
+        return dialect_name == 'postgresql'
+
+    def begin_read_snapshot(self):
+        """
+        Starts a transaction on every database of the session right away, so all following reads of the session see
+        the same snapshot until it is committed or rolled back (pysqlite only begins transactions before writes).
+        """
+        for shard_id in (self._router.shard_ids if self._router else [None]):
+            bind_arguments = {'shard_id': shard_id} if shard_id is not None else {}
+            connection = self.session.connection(bind_arguments=bind_arguments)
+            if not connection.connection.dbapi_connection.in_transaction:
+                connection.exec_driver_sql('BEGIN')
+
+    def begin_write_transaction(self, bind_arguments: Dict = None):
+        """
+        Starts a write transaction right away (`BEGIN IMMEDIATE`), so the write lock of the database is held from the
+        first read on and no other writer can change the read rows before they are updated.
+
+        Write transactions of this process first take a lock of the process (released when the session's transaction
+        ends), so concurrent writers wait in turn instead of polling in SQLite's busy handler, whose growing sleeps
+        let throughput collapse under contention.
+
+        :param bind_arguments: Shard of the transaction in sharded mode (see `bind_arguments_for_*`)
+        :raise OperationalError: If the lock isn't free within WRITE_LOCK_TIMEOUT (like SQLite's busy error)
+        """
+        bind_arguments = bind_arguments or {}
+        connection = self.session.connection(bind_arguments=bind_arguments)
+        if connection.connection.dbapi_connection.in_transaction:
+            return
+
+        lock = self._write_locks.setdefault(bind_arguments.get('shard_id'), threading.Lock())
+        if not lock.acquire(timeout=WRITE_LOCK_TIMEOUT):
+            raise OperationalError('BEGIN IMMEDIATE', None, sqlite3.OperationalError('database is locked'))
+        self.session.info.setdefault('write_locks', []).append(lock)
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    @staticmethod
+    def _release_write_locks(session, transaction):
+        if transaction.parent is None:
+            for lock in session.info.pop('write_locks', []):
+                lock.release()
+
+    @contextmanager
+    def raw_connection(self, shard_id: str = None):
+        """
+        Context manager providing a DBAPI connection of the engine in autocommit mode (transactions are handled
+        explicitly by the caller), for example for bulk operations with `executemany`.
+
+        :param shard_id: Shard of the connection, required in sharded mode
+        """
+        if not self._engine:
+            raise RuntimeError('Not connected to a database')
+        if self._router and shard_id is None:
+            raise RuntimeError('Raw connections need a shard in sharded mode')
+
+        engine = self._shard_engines[shard_id] if self._router else self._engine
+        raw_connection = engine.raw_connection()
+        connection = raw_connection.connection
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        try:
+            yield connection
+        finally:
+            connection.isolation_level = isolation_level
+            raw_connection.close()
+
     def _fk_pragma_on_connect(connection, cursor, con_record):
         logger.debug('engine connect event: %s, %s, %s', connection, cursor, con_record)
         if isinstance(cursor, sqlite3.Connection):
@@ -39,63 +179,92 @@ class ScopedDBConnection:
         from models.entry import Entry
         from models.character import Character
         from models.character_info import CharacterInfo
+        from models.job import Job
+        from tools.maintenance import prepare_database
+
+        for engine in self.engines:
+            prepare_database(engine)
 
         Series.init_entity(self.session, self._engine)
         EntryType.init_entity(self.session, self._engine)
         Entry.init_entity(self.session, self._engine)
         Character.init_entity(self.session, self._engine)
         CharacterInfo.init_entity(self.session, self._engine)
+        Job.init_entity(self.session, self._engine)
 
-    def connect_db(self, db_connection_string: str):
-        logger.info('Connecting to database %s', db_connection_string)
-        if self._engine:
-            raise RuntimeError('Already connected to database')
-
-        self._engine = create_engine(db_connection_string)
-        self._init_db()
-
-        event.listen(self._engine, 'connect', self._fk_pragma_on_connect)
-        #event.listen(Pool, 'connect', self._fk_pragma_on_connect)
+        if self._router:
+            for engine in self.engines[1:]:
+                for entity_type in (Series, EntryType, Entry, Character, CharacterInfo):
+                    entity_type.metadata.create_all(bind=engine)
 
+        from revisions import init_revision_tracking
+        for engine in self.engines:
+            init_revision_tracking(engine)
+            # create_all only creates the indexes of new tables, add indexes defined later to existing databases
+            for entity_type in (Series, EntryType, Entry, Character, CharacterInfo):
+                for index in entity_type.__table__.indexes:
+                    index.create(bind=engine, checkfirst=True)
 
-db = ScopedDBConnection()
+        event.listen(self.session, 'after_transaction_end', self._release_write_locks)
+        if self._router:
+            event.listen(self.session, 'before_flush', self._router.handle_before_flush)
+            event.listen(self.session, 'after_flush', self._router.handle_after_flush)
 
+        import changes
+        from reference_cache import init_reference_caches
+        from suggest_index import init_suggest_indexes
+        from change_feed import init_change_feed
+        from relations import init_relation_cache
+        from coherence import init_cache_coherence
 
-def _add_and_commit(obj):
-    db.session.add(obj)
-    db.session.commit()
+        changes.init_change_tracking(self.session)
+        # the revisions seen by the caches are taken before they are filled
+        init_cache_coherence()
+        init_reference_caches(self.session)
+        init_suggest_indexes()
+        init_change_feed()
+        init_relation_cache()
+        self.session.remove()
 
-    return obj
+    def connect_db(self, db_connection_string: str, shard_count: int = 1):
+        """
+        Connects to the database. With a shard count > 1 the data is sharded by series across multiple databases, the
+        connection string must then contain a `{shard}` placeholder which is replaced by the shard index.
+        """
+        logger.info('Connecting to database %s (%d shards)', db_connection_string, shard_count)
+        if self._engine:
+            raise RuntimeError('Already connected to database')
 
+        if shard_count > 1:
+            if '{shard}' not in db_connection_string:
+                raise RuntimeError('Connection string must contain a {shard} placeholder in sharded mode')
 
-def generate_test_data() -> Response:
-    from models.entrytype import EntryType
-    from models.character import Character
-    from models.entry import Entry
-    from models.series import Series
-    from models.character_info import CharacterInfo
+            self._router = ShardRouter(shard_count)
+            self._shard_engines = {shard_id: create_engine(db_connection_string.format(shard=shard_id))
+                                   for shard_id in self._router.shard_ids}
+            self._engine = self._shard_engines[PRIMARY_SHARD]
+        else:
+            self._engine = create_engine(db_connection_string)
+        self._init_db()
 
-    book_type = _add_and_commit(EntryType('Book'))
-    episode_type = _add_and_commit(EntryType('Episode'))
-    movie_type = _add_and_commit(EntryType('Movie'))
+        for engine in self.engines:
+            event.listen(engine, 'connect', self._fk_pragma_on_connect)
+        #event.listen(Pool, 'connect', self._fk_pragma_on_connect)
 
-    riyria_series = _add_and_commit(Series('Riyria Revelations'))
-    dune_series = _add_and_commit(Series('Dune'))
+    def disconnect_db(self):
+        from change_feed import change_feed
+        change_feed.close()
 
-    theft_of_swords_entry = _add_and_commit(
-        Entry('Theft of Swords', date(2011, 1, 1), 1, book_type.id, riyria_series.id))
-    rise_of_empire_entry = _add_and_commit(Entry('Rise of Empire', date(2011, 1, 1), 2, book_type.id, riyria_series.id))
-    heir_of_novron_entry = _add_and_commit(Entry('Heir of Novron', date(2012, 1, 1), 3, book_type.id, riyria_series.id))
-    dune_entry = _add_and_commit(Entry('Dune', date(1965, 1, 1), book_type.id, 1, dune_series.id))
-    dune_messiah_entry = _add_and_commit(Entry('Dune Messiah', date(1969, 1, 1), 2, book_type.id, dune_series.id))
-    children_of_dune_entry = _add_and_commit(
-        Entry('Children of Dune', date(1676, 1, 1), 3, book_type.id, dune_series.id))
+        if self._scoped_session:
+            self._scoped_session.remove()
+        for engine in self.engines:
+            engine.dispose()
 
-    hadrian_char = _add_and_commit(Character('Hadrian', riyria_series.id, theft_of_swords_entry.id))
-    royce_char = _add_and_commit(Character('Royce', riyria_series.id, theft_of_swords_entry.id))
+        self._engine = None
+        self._shard_engines = None
+        self._router = None
+        self._scoped_session = None
+        self._write_locks = {}
 
-    hadrian_info1 = _add_and_commit(CharacterInfo('Swordmaster, friend of Royce (part of Riyria)', theft_of_swords_entry.id, hadrian_char.id))
-    hadrian_info2 = _add_and_commit(CharacterInfo('Guardian of Novron\'s Heir', heir_of_novron_entry.id, hadrian_char.id))
-    royce_info1 = _add_and_commit(CharacterInfo('Thief, friend of Hadrian (part of Riyria)', theft_of_swords_entry.id, royce_char.id))
 
-    return make_response('', 201)
+db = ScopedDBConnection()
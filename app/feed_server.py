@@ -0,0 +1,224 @@
+"""
+Evented server for the change feed (see `change_feed`). All streams are served by one thread running an asyncio event
+loop, the feed wakes it up when its poller found new changes, so open streams don't hold a worker thread of the app
+each.
+Requests to the stream endpoint of the app are redirected to it.
+
+    CHANGE_FEED_PORT=8001       port of the feed server, if unset the app serves the streams itself (a thread each)
+    CHANGE_FEED_HOST=127.0.0.1  interface of the feed server, e.g. 0.0.0.0 to serve it without a reverse proxy
+    CHANGE_FEED_URL=            public URL of the stream endpoint of the feed server, e.g. behind a reverse proxy
+                                (default: CHANGE_FEED_PORT on the host of the request)
+
+The port is bound with SO_REUSEPORT, so every worker process of the app runs a feed server. The feeds of all workers
+stream the changes of all workers, a client can reconnect to any of them.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from flask import Flask, redirect, request
+
+from change_feed import HEARTBEAT_INTERVAL, STREAM_HEADERS, STREAM_PATH, ChangeFeed, Position, \
+    change_feed, parse_stream_arguments, render_events, stream_changes, stream_start
+
+logger = logging.getLogger(__name__)
+
+# seconds a client may take to send its request head
+REQUEST_TIMEOUT = 10
+MAX_HEADERS = 100
+
+_CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET',
+    'Access-Control-Allow-Headers': 'Last-Event-ID',
+}
+
+
+def _response_head(status: str, headers: Dict[str, str]) -> bytes:
+    lines = [f'HTTP/1.1 {status}'] + [f'{name}: {value}' for name, value in dict(_CORS_HEADERS, **headers).items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+
+def _error(status_code: int, status: str, error_type: str, message: str) -> bytes:
+    body = json.dumps({'status': status_code, 'error_type': error_type, 'message': message}).encode()
+    return _response_head(f'{status_code} {status}', {'Content-Type': 'application/json',
+                                                      'Content-Length': str(len(body)),
+                                                      'Connection': 'close'}) + body
+
+
+async def _read_head(reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, str]]:
+    """
+    :return: Method, target and headers (lower case names) of the request
+    :raise ValueError: If the request is malformed
+    """
+    method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+    headers = {}
+    for _ in range(MAX_HEADERS):
+        line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+        if not line:
+            return method, target, headers
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    raise ValueError('Too many headers')
+
+
+class FeedServer:
+
+    def __init__(self, feed: ChangeFeed, host: str, port: int, heartbeat: float = HEARTBEAT_INTERVAL):
+        self.feed = feed
+        self.host = host
+        self.port = port
+        self.heartbeat = heartbeat
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # replaced on every wake up, streams wait for the one current when they last read the feed
+        self._changed: Optional[asyncio.Event] = None
+        self._started = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._changed = asyncio.Event()
+            server = self._loop.run_until_complete(asyncio.start_server(
+                self._handle, self.host, self.port, reuse_port=hasattr(socket, 'SO_REUSEPORT')))
+            self.port = server.sockets[0].getsockname()[1]
+        except BaseException as e:
+            self._error = e
+            self._started.set()
+            self._loop.close()
+            return
+
+        self._started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            server.close()
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self._loop.close()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def wake(self):
+        """
+        Wakes up the streams, called by the feed from its poller thread.
+        """
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._notify)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                method, target, headers = await asyncio.wait_for(_read_head(reader), REQUEST_TIMEOUT)
+            except (ValueError, UnicodeDecodeError, asyncio.TimeoutError, asyncio.LimitOverrunError):
+                writer.write(_error(400, 'Bad Request', 'input_error', 'Malformed request'))
+                return
+
+            url = urlsplit(target)
+            if method == 'OPTIONS':
+                writer.write(_response_head('204 No Content', {'Connection': 'close'}))
+                return
+            if method != 'GET' or url.path.rstrip('/') != STREAM_PATH:
+                writer.write(_error(404, 'Not Found', 'not_found', 'Not found'))
+                return
+
+            try:
+                entity, series_id, position = parse_stream_arguments(dict(parse_qsl(url.query)),
+                                                                    headers.get('last-event-id'))
+            except ValueError as e:
+                writer.write(_error(400, 'Bad Request', 'input_error', str(e)))
+                return
+
+            logger.debug('stream_changes(%s, %s, %s)', entity, series_id, position)
+            if not self.feed.covers(position):
+                # a Last-Event-ID of a worker whose poller is ahead, polled without blocking the other streams
+                await asyncio.get_running_loop().run_in_executor(None, self.feed.catch_up, position)
+            writer.write(_response_head('200 OK', dict(STREAM_HEADERS, **{'Content-Type': 'text/event-stream',
+                                                                          'Connection': 'close'})))
+            writer.write(stream_start(position).encode())
+            await writer.drain()
+            await self._stream(writer, position, entity, series_id)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _stream(self, writer: asyncio.StreamWriter, position: Position, entity: Optional[str],
+                      series_id: Optional[int]):
+        while not self.feed.closed:
+            changed = self._changed
+            events, next_position, missed = self.feed.events_after(position)
+            if not events and not missed:
+                try:
+                    await asyncio.wait_for(changed.wait(), self.heartbeat)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            writer.write(render_events(events, next_position, missed, entity, series_id).encode())
+            await writer.drain()
+            position = next_position
+
+    def start(self):
+        """
+        :raise OSError: If the port can't be bound
+        """
+        self._thread.start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+        self.feed.add_waker(self.wake)
+        self.feed.start_polling()
+        logger.info('Change feed served on %s:%d', self.host, self.port)
+
+    def stop(self):
+        self.feed.remove_waker(self.wake)
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+feed_server: FeedServer or None = None
+
+
+def redirect_to_feed_server():
+    """
+    Redirects stream requests of the app to the feed server, with the Last-Event-ID of reconnecting clients as
+    parameter (headers aren't repeated for the redirected request).
+    """
+    url = os.getenv('CHANGE_FEED_URL') or '{}://{}:{}{}'.format(request.scheme, request.host.rsplit(':', 1)[0],
+                                                                  feed_server.port, STREAM_PATH)
+    args = request.args.to_dict()
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id:
+        args['last_event_id'] = last_event_id
+    return redirect(url + ('?' + urlencode(args) if args else ''), 307)
+
+
+def init_feed_server(app: Flask):
+    """
+    Adds the stream endpoint to the app, served by the feed server if CHANGE_FEED_PORT is set.
+    """
+    global feed_server
+    if feed_server is not None:
+        feed_server.stop()
+        feed_server = None
+
+    port = os.getenv('CHANGE_FEED_PORT')
+    if not port:
+        app.add_url_rule(STREAM_PATH, view_func=stream_changes)
+        return
+
+    feed_server = FeedServer(change_feed, os.getenv('CHANGE_FEED_HOST', '127.0.0.1'), int(port))
+    feed_server.start()
+    app.add_url_rule(STREAM_PATH, endpoint='stream_changes', view_func=redirect_to_feed_server)
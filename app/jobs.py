@@ -0,0 +1,315 @@
+"""
+Background jobs for operations which take longer than a request should (imports, exports, whole-series reorders and
+cascade deletes). Jobs are persisted in the `jobs` table and run on a bounded thread pool, request handlers only
+create the job and return its id.
+
+A job runs in the worker process which queued it. Every worker refreshes the heartbeat of its unfinished jobs each
+HEARTBEAT_INTERVAL seconds and marks the unfinished jobs without heartbeat for STALE_AFTER seconds as failed, these
+were interrupted by a stopped worker.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Tuple
+from uuid import uuid4
+
+from marshmallow import Schema, fields
+from marshmallow.validate import OneOf, Regexp
+from sqlalchemy import bindparam, delete, select, update
+
+import changes
+from database import db
+from models.character import Character
+from models.character_info import CharacterInfo
+from models.entry import Entry
+from models.job import FAILED, RUNNING, SUCCEEDED, Job
+from models.series import Series
+
+logger = logging.getLogger(__name__)
+
+# rows deleted per transaction by cascade deletes
+DELETE_BATCH_SIZE = 1000
+# seconds between heartbeats of the unfinished jobs of a worker
+HEARTBEAT_INTERVAL = 30
+# seconds without heartbeat after which an unfinished job was interrupted
+STALE_AFTER = 4 * HEARTBEAT_INTERVAL
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobContext:
+
+    def __init__(self, job_id: int, files_dir: str):
+        self.job_id = job_id
+        self.files_dir = files_dir
+
+    def progress(self, progress: float, message: str = None):
+        """
+        Stores the progress of the job. Commits the current transaction of the session, call it between units of
+        work which may be committed on their own.
+
+        :param progress: Done fraction of the job, 0 to 1
+        """
+        db.session.execute(update(Job).where(Job.id == self.job_id)
+                           .values(progress=min(max(progress, 0.0), 1.0), message=message)
+                           .execution_options(synchronize_session=False))
+        db.session.commit()
+
+    def file_path(self, file_name: str) -> str:
+        return os.path.join(self.files_dir, file_name)
+
+
+JobFunction = Callable[[JobContext, Dict], Dict]
+
+_job_types: Dict[str, Tuple[Schema, JobFunction]] = {}
+
+
+def job_type(name: str, params_schema: Schema):
+    """
+    Registers a function as job type. The function is called with the job context and the loaded parameters and
+    returns the result of the job as JSON serializable dict.
+    """
+    def decorator(f: JobFunction) -> JobFunction:
+        _job_types[name] = (params_schema, f)
+        return f
+    return decorator
+
+
+def job_types() -> List[str]:
+    return sorted(_job_types)
+
+
+def load_params(type: str, params: Dict) -> Dict:
+    """
+    :raise KeyError: If the job type is unknown
+    :raise ValidationError: If the parameters are invalid
+    """
+    schema, _ = _job_types[type]
+    return schema.load(params)
+
+
+class JobRunner:
+
+    def __init__(self, workers: int, queue_size: int, files_dir: str):
+        self.files_dir = files_dir
+        self.worker = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid4().hex[:8])
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        # queued and running jobs
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._stop = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True)
+        self._heartbeat_thread.start()
+
+    def submit(self, type: str, params: Dict) -> Job:
+        """
+        Creates a job with already loaded parameters (see load_params) and queues it.
+
+        :raise JobQueueFull: If too many jobs are queued or running
+        """
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull()
+
+        try:
+            job = Job(type, params)
+            job.worker = self.worker
+            job.heartbeat_at = datetime.utcnow()
+            db.session.add(job)
+            db.session.commit()
+            self._executor.submit(self._run, job.id)
+        except Exception:
+            self._slots.release()
+            raise
+        logger.info('Queued job %d (%s)', job.id, type)
+        return job
+
+    def _set_state(self, job_id: int, **values):
+        db.session.execute(update(Job).where(Job.id == job_id).values(**values)
+                           .execution_options(synchronize_session=False))
+        db.session.commit()
+
+    def _run(self, job_id: int):
+        try:
+            job = db.session.get(Job, job_id)
+            params = json.loads(job.params)
+            _, function = _job_types[job.type]
+            self._set_state(job_id, status=RUNNING, started_at=datetime.utcnow())
+
+            logger.info('Running job %d (%s)', job_id, job.type)
+            result = function(JobContext(job_id, self.files_dir), params)
+            db.session.commit()
+            self._set_state(job_id, status=SUCCEEDED, progress=1.0, result=json.dumps(result),
+                            finished_at=datetime.utcnow())
+            logger.info('Job %d succeeded', job_id)
+        except Exception as e:
+            logger.error('Job %d failed: %s', job_id, e)
+            db.session.rollback()
+            try:
+                self._set_state(job_id, status=FAILED, error=str(e) or type(e).__name__, finished_at=datetime.utcnow())
+            except Exception as e:
+                logger.error('Could not store failure of job %d: %s', job_id, e)
+                db.session.rollback()
+        finally:
+            db.session.remove()
+            self._slots.release()
+
+    def heartbeat(self):
+        """
+        Refreshes the heartbeat of the jobs of this worker and fails the jobs of stopped workers.
+        """
+        try:
+            Job.heartbeat(db.session, self.worker)
+            Job.fail_stale(db.session, datetime.utcnow() - timedelta(seconds=STALE_AFTER))
+            db.session.commit()
+        except Exception as e:
+            logger.error('Could not refresh job heartbeats: %s', e)
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            self.heartbeat()
+
+    def shutdown(self, wait: bool = True):
+        self._stop.set()
+        self._executor.shutdown(wait=wait)
+
+
+job_runner: JobRunner or None = None
+
+
+def init_job_runner() -> JobRunner:
+    global job_runner
+    if job_runner is not None:
+        job_runner.shutdown(wait=False)
+
+    job_runner = JobRunner(int(os.getenv('JOB_WORKERS', '2')), int(os.getenv('JOB_QUEUE_SIZE', '100')),
+                           os.getenv('JOB_FILES_DIR', 'job_files'))
+    job_runner.heartbeat()
+    return job_runner
+
+
+# job types
+
+class SeriesParamsSchema(Schema):
+    series_id = fields.Int(required=True)
+
+
+class ReorderSeriesParamsSchema(SeriesParamsSchema):
+    by = fields.Str(load_default='date', validate=OneOf(['date', 'name', 'id']))
+
+
+class SnapshotParamsSchema(Schema):
+    # plain file name in JOB_FILES_DIR
+    file = fields.Str(required=True, validate=Regexp(r'^[\w][\w.-]*$'))
+
+
+class ImportSnapshotParamsSchema(SnapshotParamsSchema):
+    replace = fields.Bool(load_default=False)
+
+
+def _get_series(series_id: int) -> Series:
+    series = db.session.get(Series, series_id)
+    if series is None:
+        raise ValueError(f'No series with id {series_id}')
+    return series
+
+
+@job_type('reorder_series', ReorderSeriesParamsSchema())
+def reorder_series(context: JobContext, params: Dict) -> Dict:
+    """
+    Renumbers order_in_series of all entries of a series by date, name or id in one transaction, which holds the write
+    lock of the series' database from the read of the entries on, so concurrent order changes wait for it.
+    """
+    bind_arguments = db.bind_arguments_for_series(params['series_id'])
+    db.begin_write_transaction(bind_arguments)
+    series = _get_series(params['series_id'])
+    table = Entry.__table__
+    ids = db.session.execute(select(table.c.id).where(table.c.series_id == series.id)
+                             .order_by(table.c[params['by']], table.c.id), bind_arguments=bind_arguments) \
+        .scalars().all()
+
+    if ids:
+        statement = update(table).where(table.c.id == bindparam('entry_id')) \
+            .values(order_in_series=bindparam('order'))
+        db.session.execute(statement, [{'entry_id': id, 'order': index + 1} for index, id in enumerate(ids)],
+                           bind_arguments=bind_arguments)
+        for id in ids:
+            changes.record_change(db.session, table.name, id, changes.UPDATE, series.id)
+    # commits the transaction
+    context.progress(0.9, f'Reordered {len(ids)} entries')
+    return {'entries': len(ids)}
+
+
+@job_type('delete_series', SeriesParamsSchema())
+def delete_series(context: JobContext, params: Dict) -> Dict:
+    """
+    Deletes a series with its entries, characters and character infos, in batches of DELETE_BATCH_SIZE rows per
+    transaction.
+    """
+    series = _get_series(params['series_id'])
+    bind_arguments = db.bind_arguments_for_series(series.id)
+    entries = Entry.__table__
+    characters = Character.__table__
+    infos = CharacterInfo.__table__
+    entry_ids = select(entries.c.id).where(entries.c.series_id == series.id)
+    character_ids = select(characters.c.id).where(characters.c.series_id == series.id)
+
+    steps = [
+        (infos, select(infos.c.id).where(infos.c.entry_id.in_(entry_ids) | infos.c.character_id.in_(character_ids))),
+        (characters, character_ids),
+        (entries, entry_ids),
+    ]
+    counts = {}
+    for index, (table, id_query) in enumerate(steps):
+        counts[table.name] = 0
+        while True:
+            ids = db.session.execute(id_query.limit(DELETE_BATCH_SIZE), bind_arguments=bind_arguments).scalars().all()
+            if not ids:
+                break
+
+            db.session.execute(delete(table).where(table.c.id.in_(ids)), bind_arguments=bind_arguments)
+            for id in ids:
+                changes.record_change(db.session, table.name, id, changes.DELETE, series.id)
+            counts[table.name] += len(ids)
+            context.progress((index + 0.5) / (len(steps) + 1), f'Deleted {counts[table.name]} rows of {table.name}')
+
+    db.session.delete(series)
+    db.session.flush()
+    counts[Series.__tablename__] = 1
+    return counts
+
+
+@job_type('export_snapshot', SnapshotParamsSchema())
+def export_snapshot_job(context: JobContext, params: Dict) -> Dict:
+    from tools.snapshot import export_snapshot, require_single_database, sqlite_database_path
+
+    require_single_database()
+    path = context.file_path(params['file'])
+    os.makedirs(context.files_dir, exist_ok=True)
+    counts = export_snapshot(sqlite_database_path(db.engines[0]), path)
+    return {'file': params['file'], 'bytes': os.path.getsize(path), 'rows': counts}
+
+
+@job_type('import_snapshot', ImportSnapshotParamsSchema())
+def import_snapshot_job(context: JobContext, params: Dict) -> Dict:
+    from tools.snapshot import TABLES, import_snapshot, require_single_database
+
+    require_single_database()
+    path = context.file_path(params['file'])
+    if not os.path.isfile(path):
+        raise ValueError(f'No file {params["file"]}')
+
+    with db.raw_connection() as connection:
+        counts = import_snapshot(connection, path, params['replace'])
+
+    # the import bypasses the session, tell the caches and clients that the tables have been replaced
+    for table in TABLES:
+        changes.record_change(db.session, table, None, changes.DELETE)
+    return {'rows': counts}
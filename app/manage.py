@@ -0,0 +1,13 @@
+import logging
+
+from flask.cli import FlaskGroup
+
+from webapp import create_app
+
+# Management commands, for example `python manage.py generate-data --help`. The database is configured with
+# DB_CONNECTION_STRING as for the web application.
+cli = FlaskGroup(create_app=create_app)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    cli()
@@ -1,19 +1,42 @@
 import logging
-from typing import Dict
+from typing import Dict, List, Tuple, Type
 
 from marshmallow import Schema
+from sqlalchemy import Column, Integer, select, text, bindparam, update, and_, or_
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.functions import count
 
-from database import LIMIT
+import changes
+from database import LIMIT, db
+from sharding import REPLICATED_TABLES
 
 logger = logging.getLogger(__name__)
 
 
 class RESTModel:
     schema: Schema
+    # fields which can be used to sort search results
+    sort_fields: Tuple[str, ...] = ('id',)
+    # maintained by database triggers on every insert and update, see revisions.py
+    revision = Column(Integer, nullable=False, server_default='0', index=True)
 
     def to_dict(self):
         raise NotImplementedError()
 
+    @classmethod
+    def read_query(cls) -> Select:
+        """
+        Core select of the columns needed by `row_to_dict`, used by read only requests which don't need entities.
+        """
+        return select(*[column for column in cls.__table__.c if column.name != 'revision'])
+
+    @staticmethod
+    def row_to_dict(row) -> Dict:
+        """
+        Response dict of a row of `read_query`, equal to the `to_dict` of the entity.
+        """
+        raise NotImplementedError()
+
     @staticmethod
     def from_dict(data: Dict) -> 'RESTModel':
         raise NotImplementedError()
@@ -21,12 +44,156 @@ class RESTModel:
     def update(self, data: Dict) -> 'RESTModel':
         raise NotImplementedError()
 
+    @classmethod
+    def patch_by_id(cls, id: int, data: Dict) -> 'RESTModel' or None:
+        """
+        Applies the given subset of fields to the entity with the given id in a single `UPDATE ... RETURNING`
+        statement, the returned row is loaded as entity without querying it again. Models with fields that need
+        additional logic when changed (for example Entry.order_in_series) override this method.
+
+        :param id: ID of the entity to update
+        :param data: Validated partial input data (keys are column keys of the entity's table)
+        :return: Updated entity or None if there is no entity with the given id
+        :raise ValueError: If the data would move the entity to another shard
+        """
+        logger.debug('%s.patch_by_id(%s, %s)', cls.__name__, id, data)
+        table = cls.__table__
+
+        if db.sharded and table.name in REPLICATED_TABLES:
+            # the ORM path replicates the change to all shards
+            entity = db.session.get(cls, id)
+            if entity is not None:
+                for key, value in data.items():
+                    setattr(entity, key, value)
+                db.session.flush()
+            return entity
+
+        if db.sharded:
+            db.router.check_shard_key(table.name, id, data)
+        bind_arguments = db.bind_arguments_for_id(table.name, id)
+        if not db.supports_update_returning:
+            db.session.execute(update(table).where(table.c.id == id).values(data), bind_arguments=bind_arguments)
+            entity = db.session.get(cls, id, populate_existing=True)
+            if entity is not None:
+                changes.record_change(db.session, table.name, id, changes.UPDATE, changes.series_id_of(entity))
+            return entity
+
+        preparer = db.session.get_bind().dialect.identifier_preparer
+        assignments = ', '.join(f'{preparer.quote(table.c[key].name)} = :{key}' for key in data)
+        returning = ', '.join(preparer.quote(column.name) for column in table.c)
+        statement = text(f'UPDATE {preparer.format_table(table)} SET {assignments} '
+                         f'WHERE {preparer.quote(table.c.id.name)} = :id RETURNING {returning}') \
+            .bindparams(*[bindparam(key, type_=table.c[key].type) for key in data]) \
+            .columns(*table.c)
+        logger.debug('query: %s', statement)
+
+        query = select(cls).from_statement(statement).execution_options(populate_existing=True)
+        entity = db.session.execute(query, {'id': id, **data}, bind_arguments=bind_arguments).scalars().first()
+        if entity is not None:
+            changes.record_change(db.session, table.name, id, changes.UPDATE, changes.series_id_of(entity))
+        return entity
+
     @staticmethod
-    def query_by_id(id: int = None, offset: int = 0, limit: int = LIMIT):
+    def query_by_id(id: int = None, offset: int = 0, limit: int = LIMIT, as_dicts: bool = False):
         raise NotImplementedError()
 
     @staticmethod
-    def query_by_fields(fields: Dict, offset: int = 0, limit: int = LIMIT):
+    def query_by_fields(fields: Dict, offset: int = 0, limit: int = LIMIT, sort: Tuple[str, bool] = None,
+                        after: Tuple = None, with_count: bool = True, as_dicts: bool = False):
         raise NotImplementedError()
 
 
+def drop_indexes(engine, names: Tuple[str, ...]):
+    """
+    Drops indexes of earlier versions from an existing database.
+    """
+    with engine.begin() as connection:
+        for name in names:
+            connection.exec_driver_sql('DROP INDEX IF EXISTS {}'.format(name))
+
+
+def query_page(entity_type: Type[RESTModel], filter_list: List, offset: int = 0, limit: int = LIMIT,
+               sort: Tuple[str, bool] = None, after: Tuple = None, with_count: bool = True, as_dicts: bool = False) \
+        -> (List[RESTModel] or List[Dict], int or None):
+    """
+    Queries one page of entities matching the given filters. The rows are ordered by the sort field (and id as tie
+    breaker) so the database stops reading as soon as the page is full. In sharded mode a query which can't be routed to
+    a single shard reads the first `offset + limit` rows of every shard and merges them.
+
+    :param entity_type: Type of the queried entities
+    :param filter_list: SQLAlchemy filter expressions
+    :param offset: Number of rows to skip, ignored if `after` is set
+    :param limit: Maximum number of returned rows
+    :param sort: Tuple of sort field name (one of `entity_type.sort_fields`) and descending flag, defaults to id
+    :param after: Tuple of sort field value and id of the last row of the previous page (keyset pagination)
+    :param with_count: Whether to count all matching rows, if False None is returned as row count
+    :param as_dicts: Return response dicts read with a Core query instead of entities (for read only requests, skips
+        the ORM object materialization and the identity map)
+    :return: Tuple of entities (or dicts) and row count
+    """
+    sort_field, descending = sort or ('id', False)
+    table = entity_type.__table__
+    sort_column = table.c[sort_field]
+    id_column = table.c.id
+
+    order_by = [sort_column] if sort_field == 'id' else [sort_column, id_column]
+    if descending:
+        order_by = [column.desc() for column in order_by]
+
+    scatter = False
+    if db.sharded:
+        whereclause = and_(*filter_list) if filter_list else None
+        scatter = len(db.router.shards_for_criteria(table.name, whereclause)) > 1
+
+    query = (entity_type.read_query() if as_dicts else select(entity_type)).filter(*filter_list)
+    if after is not None:
+        value, last_id = after
+        if sort_field == 'id':
+            query = query.filter(id_column < value if descending else id_column > value)
+        elif descending:
+            query = query.filter(or_(sort_column < value, and_(sort_column == value, id_column < last_id)))
+        else:
+            query = query.filter(or_(sort_column > value, and_(sort_column == value, id_column > last_id)))
+    elif not scatter:
+        query = query.offset(offset)
+    query = query.order_by(*order_by).limit(limit if after is not None or not scatter else offset + limit)
+    logger.debug('query: %s', query)
+
+    result = db.session.execute(query)
+    entities = result.all() if as_dicts else result.scalars().all()
+    if scatter:
+        entities.sort(key=lambda entity: (getattr(entity, sort_field), entity.id), reverse=descending)
+        entities = entities[:limit] if after is not None else entities[offset:offset + limit]
+    if as_dicts:
+        entities = [entity_type.row_to_dict(row) for row in entities]
+
+    row_count = None
+    if with_count:
+        # one count row per queried shard
+        row_count = sum(row[0] for row in db.session.execute(select(count(id_column)).filter(*filter_list)))
+
+    return entities, row_count
+
+
+def count_grouped(group_column, keys: List, from_clause=None) -> Dict:
+    """
+    Counts the rows per value of `group_column` for the given values in one grouped query. In sharded mode each queried
+    shard returns its own counts, they are summed.
+
+    :param group_column: Column to group by, for example `Entry.series_id` (in sharded mode the query is routed by the
+        entity of the column)
+    :param keys: Values of the column to count, values without rows are counted as 0
+    :param from_clause: Table or join to count the rows of, defaults to the table of the column
+    :return: Dict of value to row count
+    """
+    counts = {key: 0 for key in keys}
+    if not counts:
+        return counts
+
+    query = select(group_column, count()).where(group_column.in_(list(counts))).group_by(group_column)
+    if from_clause is not None:
+        query = query.select_from(from_clause)
+    logger.debug('query: %s', query)
+    for key, row_count in db.session.execute(query):
+        counts[key] += row_count
+    return counts
@@ -1,15 +1,15 @@
 import logging
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 from marshmallow import Schema, fields, validates_schema, ValidationError
-from sqlalchemy import ForeignKey, Column, Integer, String, select
-from sqlalchemy.orm import Query, relationship, declarative_base
-from sqlalchemy.sql.functions import count
+from sqlalchemy import ForeignKey, Column, Index, Integer, String
+from sqlalchemy.orm import relationship, declarative_base
 
-from database import LIMIT, db
-from models.base import RESTModel
+from database import LIMIT
+from models.base import RESTModel, drop_indexes, query_page
 from models.entry import Entry
 from models.series import Series
+from reference_cache import series_cache
 
 logger = logging.getLogger(__name__)
 
@@ -26,7 +26,7 @@ class CharacterSchema(Schema):
 class CharacterSearchSchema(Schema):
     id = fields.Int()
     name = fields.Str()
-    series_id = fields.Date()
+    series_id = fields.Int()
     occurs_first_in_entry_id = fields.Int()
 
     @validates_schema
@@ -45,7 +45,15 @@ class Character(RESTModel, base):
     series = relationship(Series, foreign_keys='Character.series_id')
     occurs_first_in_entry = relationship(Entry, foreign_keys='Character.occurs_first_in_entry_id')
 
+    __table_args__ = (
+        Index('ix_characters_series_id_name', series_id, name),
+        Index('ix_characters_name', name),
+    )
+    # indexes of earlier versions, dropped from existing databases
+    obsolete_indexes = ('ix_characters_series_id',)
+
     schema = CharacterSchema()
+    sort_fields = ('id', 'name')
 
     def __init__(self, name: str, series_id: int, occurs_first_in_entry_id: int, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -59,9 +67,11 @@ class Character(RESTModel, base):
     @staticmethod
     def init_entity(session, engine):
         base.metadata.create_all(bind=engine)
+        drop_indexes(engine, Character.obsolete_indexes)
 
     @staticmethod
-    def query_by_id(id: int = None, offset: int = 0, limit: int = LIMIT) -> (List['Character'], int) or (None, None):
+    def query_by_id(id: int = None, offset: int = 0, limit: int = LIMIT, as_dicts: bool = False) \
+            -> (List['Character'], int) or (None, None):
         logger.debug('Character.query(%s, %d)', id, offset)
 
         if limit > LIMIT:
@@ -70,26 +80,20 @@ class Character(RESTModel, base):
 
         try:
             if id:
-                row_count_query = Query(count(Character.id)).filter_by(id=id)
-                query = Query(Character).limit(limit).filter_by(id=id)
-            else:
-                row_count_query = Query(count(Character.id))
-                query = Query(Character).limit(limit).offset(offset)
-
-            result_rows = db.session.execute(query).all()
-            result_row_count = db.session.execute(row_count_query).first()
-            return [row['Character'] for row in result_rows], result_row_count[0]
+                return query_page(Character, [Character.id == id], 0, limit, as_dicts=as_dicts)
+            return query_page(Character, [], offset, limit, as_dicts=as_dicts)
         except Exception as e:
             logger.error('Could not query characters %s', e)
             return None, None
 
     @staticmethod
-    def query_by_fields(fields: Dict, offset: int = 0, limit: int = LIMIT) -> (List['Character'], int) or (
-    None, None):
-        logger.debug('Character.query_by_fields(%s, %d, %d)', fields, offset, limit)
+    def query_by_fields(fields: Dict, offset: int = 0, limit: int = LIMIT, sort: Tuple[str, bool] = None,
+                        after: Tuple = None, with_count: bool = True, as_dicts: bool = False) \
+            -> (List['Character'], int) or (None, None):
+        logger.debug('Character.query_by_fields(%s, %d, %d, %s, %s)', fields, offset, limit, sort, after)
 
         if 'id' in fields:
-            return Character.query_by_id(fields['id'], offset, limit)
+            return Character.query_by_id(fields['id'], offset, limit, as_dicts)
 
         filter_list = []
         for key, value in fields.items():
@@ -103,23 +107,22 @@ class Character(RESTModel, base):
                 logger.warning('Invalid filter parameter')
                 return None, None
 
-        row_count_query = select(count(Character.id)).filter(*filter_list)
-        query = select(Character).limit(limit).offset(offset).filter(*filter_list)
-
         try:
-            result_rows = db.session.execute(query).all()
-            result_row_count = db.session.execute(row_count_query).first()
-            return [row['Character'] for row in result_rows], result_row_count[0]
+            return query_page(Character, filter_list, offset, limit, sort, after, with_count, as_dicts)
         except Exception as e:
             logger.error('Could not query characters %s', e)
             return None, None
 
     def to_dict(self) -> Dict:
+        return Character.row_to_dict(self)
+
+    @staticmethod
+    def row_to_dict(row) -> Dict:
         return {
-            'id': self.id,
-            'name': self.name,
-            'series': self.series.to_dict(),
-            'occursFirstInEntryId': self.occurs_first_in_entry_id
+            'id': row.id,
+            'name': row.name,
+            'series': series_cache.get_dict(row.series_id),
+            'occursFirstInEntryId': row.occurs_first_in_entry_id
         }
 
     @staticmethod
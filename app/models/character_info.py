@@ -1,13 +1,13 @@
 import logging
-from typing import Dict, List
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
 
 from marshmallow import Schema, fields
-from sqlalchemy import ForeignKey, Column, Integer, String
-from sqlalchemy.orm import Query, relationship, declarative_base
-from sqlalchemy.sql.functions import count
+from sqlalchemy import ForeignKey, Column, Integer, String, func, select
+from sqlalchemy.orm import relationship, declarative_base, object_session
 
 from database import LIMIT, db
-from models.base import RESTModel
+from models.base import RESTModel, query_page
 from models.character import Character
 from models.entry import Entry
 
@@ -28,7 +28,7 @@ class CharacterInfo(RESTModel, base):
     id = Column(Integer, primary_key=True)
     text = Column(String(240), nullable=False)
     entry_id = Column(Integer, ForeignKey(Entry.id), nullable=False)
-    character_id = Column(Integer, ForeignKey(Character.id), nullable=False)
+    character_id = Column(Integer, ForeignKey(Character.id), nullable=False, index=True)
 
     entry = relationship(Entry, foreign_keys='CharacterInfo.entry_id')
     character = relationship(Character, foreign_keys='CharacterInfo.character_id')
@@ -41,6 +41,17 @@ class CharacterInfo(RESTModel, base):
         self.entry_id = entry_id
         self.character_id = character_id
 
+    @property
+    def series_id(self) -> int or None:
+        """
+        ID of the series of the character, also works for pending instances whose relationships aren't loaded yet.
+        """
+        character = self.character
+        session = object_session(self)
+        if character is None and self.character_id is not None and session is not None:
+            character = session.get(Character, self.character_id)
+        return character.series_id if character is not None else None
+
     def __str__(self):
         return f'CharacterInfo ({self.id}): {self.name}'
 
@@ -49,7 +60,8 @@ class CharacterInfo(RESTModel, base):
         base.metadata.create_all(bind=engine)
 
     @staticmethod
-    def query_by_id(id: int = None, offset: int = 0, limit: int = LIMIT) -> (List['Character'], int) or None:
+    def query_by_id(id: int = None, offset: int = 0, limit: int = LIMIT, as_dicts: bool = False) \
+            -> (List['Character'], int) or None:
         logger.debug('CharacterInfo.query(%s, %d)', id, offset)
 
         if limit > LIMIT:
@@ -58,18 +70,36 @@ class CharacterInfo(RESTModel, base):
 
         try:
             if id:
-                row_count_query = Query(count(CharacterInfo.id)).filter_by(id=id)
-                query = Query(CharacterInfo).limit(limit).filter_by(id=id)
+                return query_page(CharacterInfo, [CharacterInfo.id == id], 0, limit, as_dicts=as_dicts)
+            return query_page(CharacterInfo, [], offset, limit, as_dicts=as_dicts)
+        except Exception as e:
+            logger.error('Could not query characterinfo %s', e)
+            return None, None
+
+    @staticmethod
+    def query_by_fields(fields: Dict, offset: int = 0, limit: int = LIMIT, sort: Tuple[str, bool] = None,
+                        after: Tuple = None, with_count: bool = True, as_dicts: bool = False) \
+            -> (List['CharacterInfo'], int) or (None, None):
+        logger.debug('CharacterInfo.query_by_fields(%s, %d, %d, %s, %s)', fields, offset, limit, sort, after)
+
+        if 'id' in fields:
+            return CharacterInfo.query_by_id(fields['id'], offset, limit, as_dicts)
+
+        filter_list = []
+        for key, value in fields.items():
+            if key == CharacterInfo.entry_id.key:
+                filter_list.append(CharacterInfo.entry_id == value)
+            elif key == CharacterInfo.character_id.key:
+                filter_list.append(CharacterInfo.character_id == value)
             else:
-                row_count_query = Query(count(CharacterInfo.id))
-                query = Query(CharacterInfo).limit(limit).offset(offset)
+                logger.warning('Invalid filter parameter')
+                return None, None
 
-            result_rows = db.session.execute(query).all()
-            result_row_count = db.session.execute(row_count_query).first()
-            return [row['CharacterInfo'] for row in result_rows], result_row_count[0]
+        try:
+            return query_page(CharacterInfo, filter_list, offset, limit, sort, after, with_count, as_dicts)
         except Exception as e:
             logger.error('Could not query characterinfo %s', e)
-            return None
+            return None, None
 
     def to_dict(self) -> Dict:
         return {
@@ -79,6 +109,86 @@ class CharacterInfo(RESTModel, base):
             'character': self.character.to_dict()
         }
 
+    @classmethod
+    def read_query(cls):
+        table = cls.__table__
+        entries = Entry.__table__
+        characters = Character.__table__
+        return select(table.c.id, table.c.text,
+                      *[column.label('entry_' + column.name) for column in Entry.read_query().selected_columns],
+                      *[column.label('character_' + column.name)
+                        for column in Character.read_query().selected_columns]) \
+            .join_from(table, entries, table.c.entry_id == entries.c.id) \
+            .join(characters, table.c.character_id == characters.c.id)
+
+    @staticmethod
+    def row_to_dict(row) -> Dict:
+        entry = {}
+        character = {}
+        for key, value in row._mapping.items():
+            if key.startswith('entry_'):
+                entry[key[len('entry_'):]] = value
+            elif key.startswith('character_'):
+                character[key[len('character_'):]] = value
+
+        return {
+            'id': row.id,
+            'text': row.text,
+            'entry': Entry.row_to_dict(SimpleNamespace(**entry)),
+            'character': Character.row_to_dict(SimpleNamespace(**character))
+        }
+
+    @staticmethod
+    def query_sheet(series_id: int, upto: int = None, offset: int = 0, limit: int = None) -> Tuple[List[Dict], int]:
+        """
+        Spoiler free character sheet of a series: the characters which occurred in the entries up to the given one,
+        each with its infos from these entries in reading order.
+
+        :param series_id: ID of the series
+        :param upto: order_in_series of the last entry read, all entries if None
+        :param offset: Characters to skip
+        :param limit: Maximum number of characters, all if None
+        :return: Character dicts with an additional `infos` list, ordered by first occurrence, and the number of
+            characters of the whole sheet
+        """
+        entries = Entry.__table__
+        characters = Character.__table__
+        infos = CharacterInfo.__table__
+        bind_arguments = db.bind_arguments_for_series(series_id)
+
+        character_query = Character.read_query() \
+            .join_from(characters, entries, characters.c.occurs_first_in_entry_id == entries.c.id) \
+            .where(characters.c.series_id == series_id) \
+            .order_by(entries.c.order_in_series, characters.c.id)
+        info_query = select(infos.c.id, infos.c.text, infos.c.character_id, entries.c.id.label('entry_id'),
+                            entries.c.order_in_series) \
+            .join_from(infos, entries, infos.c.entry_id == entries.c.id) \
+            .where(entries.c.series_id == series_id) \
+            .order_by(entries.c.order_in_series, infos.c.id)
+        if upto is not None:
+            character_query = character_query.where(entries.c.order_in_series <= upto)
+            info_query = info_query.where(entries.c.order_in_series <= upto)
+        count_query = select(func.count()).select_from(character_query.subquery())
+
+        sheet = {}
+        page_query = character_query.offset(offset).limit(limit)
+        for row in db.session.execute(page_query, bind_arguments=bind_arguments):
+            sheet[row.id] = {**Character.row_to_dict(row), 'infos': []}
+        if not sheet:
+            return [], db.session.execute(count_query, bind_arguments=bind_arguments).scalar()
+        # infos of the characters of the page
+        info_query = info_query.where(infos.c.character_id.in_(list(sheet)))
+        for row in db.session.execute(info_query, bind_arguments=bind_arguments):
+            character = sheet.get(row.character_id)
+            if character is not None:
+                character['infos'].append({
+                    'id': row.id,
+                    'text': row.text,
+                    'entry_id': row.entry_id,
+                    'order_in_series': row.order_in_series
+                })
+        return list(sheet.values()), db.session.execute(count_query, bind_arguments=bind_arguments).scalar()
+
     @staticmethod
     def from_dict(data: Dict) -> 'CharacterInfo':
         try:
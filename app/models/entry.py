@@ -1,15 +1,19 @@
 import logging
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 from marshmallow import Schema, fields, validates_schema, ValidationError
-from sqlalchemy import select, ForeignKey, Column, Integer, String, Date, and_, update, event
+from sqlalchemy import select, ForeignKey, Column, Index, Integer, String, Date, and_, update, event, inspect
 from sqlalchemy.orm import relationship, declarative_base, validates
-from sqlalchemy.sql.functions import count, func
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import ObjectDeletedError
+from sqlalchemy.sql.functions import func
 
+import changes
 from database import db, LIMIT
-from models.base import RESTModel
+from models.base import RESTModel, drop_indexes, query_page
 from models.entrytype import EntryType
 from models.series import Series
+from reference_cache import entrytype_cache, series_cache
 
 logger = logging.getLogger(__name__)
 
@@ -29,14 +33,24 @@ class EntrySearchSchema(Schema):
     id = fields.Int()
     name = fields.Str()
     date = fields.Date()
+    # inclusive date range
+    date_from = fields.Date()
+    date_to = fields.Date()
     order_in_series = fields.Int()
     entrytype_id = fields.Int()
     series_id = fields.Int()
 
     @validates_schema
     def check_presence(self, data, **kwargs):
-        if not any(key in data for key in ('id', 'name', 'date', 'order_in_series', 'entrytype_id', 'series_id')):
-            raise ValidationError('Either id, name, date, order_in_series, entrytype_id or series_id must be set')
+        if not any(key in data for key in ('id', 'name', 'date', 'date_from', 'date_to', 'order_in_series',
+                                           'entrytype_id', 'series_id')):
+            raise ValidationError('Either id, name, date, date_from, date_to, order_in_series, entrytype_id or '
+                                  'series_id must be set')
+
+    @validates_schema
+    def check_date_range(self, data, **kwargs):
+        if 'date_from' in data and 'date_to' in data and data['date_from'] > data['date_to']:
+            raise ValidationError('date_from must not be after date_to', 'date_from')
 
 
 class Entry(RESTModel, base):
@@ -51,7 +65,22 @@ class Entry(RESTModel, base):
     entrytype = relationship(EntryType, foreign_keys='Entry.entrytype_id')
     series = relationship(Series, foreign_keys='Entry.series_id')
 
+    # every sort field is backed by an index, so sorted pages of all entries are read in index order (the id tie
+    # breaker is the rowid, which is part of every index). Within a series only the reading order is indexed, it also
+    # serves the order shifts, counts and foreign key checks of the series, the few entries of a series are sorted by
+    # other fields without index.
+    __table_args__ = (
+        Index('ix_entries_series_id_order_in_series', series_id, _order_in_series),
+        Index('ix_entries_order_in_series', _order_in_series),
+        Index('ix_entries_date', date),
+        Index('ix_entries_name', name),
+        Index('ix_entries_entrytype_id', entrytype_id),
+    )
+    # indexes of earlier versions, dropped from existing databases
+    obsolete_indexes = ('ix_entries_series_id', 'ix_entries_series_id_date', 'ix_entries_series_id_name')
+
     schema = EntrySchema()
+    sort_fields = ('id', 'name', 'date', 'order_in_series')
 
     def __init__(self, name: str, date: date, order_in_series: int, entrytype_id: int, series_id: int, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -65,6 +94,7 @@ class Entry(RESTModel, base):
     @staticmethod
     def init_entity(session, engine):
         base.metadata.create_all(bind=engine)
+        drop_indexes(engine, Entry.obsolete_indexes)
 
         event.listen(session, 'before_flush', Entry.handle_before_flush)
 
@@ -75,6 +105,7 @@ class Entry(RESTModel, base):
         for obj in session.deleted:
             if isinstance(obj, Entry):
                 logger.info('Deleting entry, update other entries order_in_series values')
+                obj._lock_series()
                 query = update(Entry) \
                     .where(
                     and_(
@@ -104,6 +135,26 @@ class Entry(RESTModel, base):
     def __gt__(self, other: 'Entry'):
         return self.order_in_series > other.order_in_series
 
+    def _lock_series(self):
+        """
+        Starts the write transaction of the series' database before its order is read, so concurrent writers (other
+        threads or processes) can't both compute a position from the same state and claim it twice or leave a gap.
+        The position of a persistent entry is reloaded under the lock, unless it was changed in this session, since a
+        concurrent writer may have shifted it.
+
+        :raise ObjectDeletedError: If the entry was deleted concurrently
+        """
+        bind_arguments = db.bind_arguments_for_series(self.series_id)
+        db.begin_write_transaction(bind_arguments)
+
+        state = inspect(self)
+        if state.persistent and not state.attrs._order_in_series.history.has_changes():
+            query = select(Entry._order_in_series).where(Entry.id == self.id)
+            order_in_series = db.session.execute(query, bind_arguments=bind_arguments).scalar()
+            if order_in_series is None:
+                raise ObjectDeletedError(state)
+            set_committed_value(self, '_order_in_series', order_in_series)
+
     @property
     def order_in_series(self):
         return self._order_in_series
@@ -124,11 +175,14 @@ class Entry(RESTModel, base):
         The following conditions apply:
         - If value is None a ValueError is thrown
         - If the value is <= 0 a ValueError is thrown
-        - If the value is > `max(order_in_series) + 1` among Entries belonging to the same series a ValueError is thrown.
+        - If the value is > the number of other Entries belonging to the same series + 1 a ValueError is thrown.
         This also applies if the Entry is the first Entry belonging to a series and it's order_in_series is not 1.
-        - If the value is `0 < value <= max(order_in_series) + 1` the order_in_series values of the other Entries
+        - If the value is `0 < value <= number of other Entries + 1` the order_in_series values of the other Entries
         belonging to the same series are adjusted accordingly (i.E. + 1 or - 1)
 
+        The write lock of the series' database is taken before the order is read and held until the session's
+        transaction ends, see `_lock_series`.
+
         :param key: Key of updated field
         :param value: Value of 'order_in_series'
         :return: value or ValueError in case of invalid given value
@@ -139,19 +193,19 @@ class Entry(RESTModel, base):
         if value <= 0:
             raise ValueError('order_in_series can\'t be <= 0')
 
-        query = select(func.max(Entry._order_in_series)) \
+        self._lock_series()
+
+        # the order is gapless, the highest position of the other entries is their count (a moved entry which isn't
+        # the last one would otherwise be allowed to leave a gap behind the last one)
+        query = select(func.count(Entry.id)) \
             .where(
             and_(
                 Entry.id != self.id,
                 Entry.series_id == self.series_id
             )
         )
-        logger.debug('max query: %s', query)
-        res = db.session.execute(query).first()
-        max_order_in_series = res[0]
-        logger.debug('max_order_in_series: %s', max_order_in_series)
-        if not max_order_in_series:
-            max_order_in_series = 0
+        logger.debug('count query: %s', query)
+        max_order_in_series = db.session.execute(query).scalar() or 0
         logger.debug('max_order_in_series: %s', max_order_in_series)
 
         if value > max_order_in_series + 1:
@@ -218,13 +272,57 @@ class Entry(RESTModel, base):
             self._order_in_series = value
             return
 
+    def _move_to_series(self, series_id: int):
+        """
+        Moves the entry to the end of another series and closes the gap it leaves in its series, both under the write
+        lock of the series. The entry can then be moved within the new series with the order_in_series setter.
+
+        :raise ValueError: If the series is on another shard
+        :raise ObjectDeletedError: If the entry was deleted concurrently
+        """
+        if db.sharded:
+            db.router.check_shard_key(Entry.__table__.name, self.id, {'series_id': series_id})
+        self._lock_series()
+        query = update(Entry) \
+            .where(
+            and_(
+                Entry.id != self.id,
+                Entry.series_id == self.series_id,
+                Entry._order_in_series > self._order_in_series
+            )
+        ) \
+            .values(
+            {
+                Entry._order_in_series: Entry._order_in_series - 1
+            }
+        )
+        logger.debug('query: %s', query)
+        db.session.execute(query)
+        # the flush only reports the entry to the clients of the new series
+        changes.record_change(db.session, Entry.__table__.name, self.id, changes.UPDATE, self.series_id)
+
+        bind_arguments = db.bind_arguments_for_series(series_id)
+        db.begin_write_transaction(bind_arguments)
+        query = select(func.count(Entry.id)) \
+            .where(
+            and_(
+                Entry.id != self.id,
+                Entry.series_id == series_id
+            )
+        )
+        logger.debug('count query: %s', query)
+        with db.session.no_autoflush:
+            self.series_id = series_id
+            self._order_in_series = (db.session.execute(query, bind_arguments=bind_arguments).scalar() or 0) + 1
+
     @validates('_order_in_series', include_removes=True)
     def validate_order_in_series(self, key, value, is_remove):
         logger.debug('validate_order_in_series key: %s, value: %s, is_remove: %s', key, value, is_remove)
         return value
 
     @staticmethod
-    def query_by_id(id: int = None, offset: int = 0, limit: int = LIMIT) -> (List['Entry'], int) or (None, None):
+    def query_by_id(id: int = None, offset: int = 0, limit: int = LIMIT, as_dicts: bool = False) \
+            -> (List['Entry'], int) or (None, None):
         logger.debug('Entry.query(%s, %d)', id, offset)
 
         if limit > LIMIT:
@@ -233,25 +331,20 @@ class Entry(RESTModel, base):
 
         try:
             if id:
-                row_count_query = select(count(Entry.id)).filter_by(id=id)
-                query = select(Entry).limit(limit).filter_by(id=id)
-            else:
-                row_count_query = select(count(Entry.id))
-                query = select(Entry).limit(limit).offset(offset)
-
-            result_rows = db.session.execute(query).all()
-            result_row_count = db.session.execute(row_count_query).first()
-            return [row['Entry'] for row in result_rows], result_row_count[0]
+                return query_page(Entry, [Entry.id == id], 0, limit, as_dicts=as_dicts)
+            return query_page(Entry, [], offset, limit, as_dicts=as_dicts)
         except Exception as e:
             logger.error('Could not query entries %s', e)
             return None, None
 
     @staticmethod
-    def query_by_fields(fields: Dict, offset: int = 0, limit: int = LIMIT) -> (List['Entry'], int) or (None, None):
-        logger.debug('Entry.query_by_fields(%s, %d, %d)', fields, offset, limit)
+    def query_by_fields(fields: Dict, offset: int = 0, limit: int = LIMIT, sort: Tuple[str, bool] = None,
+                        after: Tuple = None, with_count: bool = True, as_dicts: bool = False) \
+            -> (List['Entry'], int) or (None, None):
+        logger.debug('Entry.query_by_fields(%s, %d, %d, %s, %s)', fields, offset, limit, sort, after)
 
         if 'id' in fields:
-            return Entry.query_by_id(fields['id'], offset, limit)
+            return Entry.query_by_id(fields['id'], offset, limit, as_dicts)
 
         filter_list = []
         for key, value in fields.items():
@@ -259,6 +352,12 @@ class Entry(RESTModel, base):
                 filter_list.append(Entry.name.contains(value))
             elif key == Entry.date.key:
                 filter_list.append(Entry.date == value)
+            elif key == 'date_from':
+                filter_list.append(Entry.date >= value)
+            elif key == 'date_to':
+                filter_list.append(Entry.date <= value)
+            elif key == 'order_in_series':
+                filter_list.append(Entry._order_in_series == value)
             elif key == Entry.entrytype_id.key:
                 filter_list.append(Entry.entrytype_id == value)
             elif key == Entry.series_id.key:
@@ -267,25 +366,24 @@ class Entry(RESTModel, base):
                 logger.warning('Invalid filter parameter')
                 return None, None
 
-        row_count_query = select(count(Entry.id)).filter(*filter_list)
-        query = select(Entry).limit(limit).offset(offset).filter(*filter_list)
-
         try:
-            result_rows = db.session.execute(query).all()
-            result_row_count = db.session.execute(row_count_query).first()
-            return [row['Entry'] for row in result_rows], result_row_count[0]
+            return query_page(Entry, filter_list, offset, limit, sort, after, with_count, as_dicts)
         except Exception as e:
             logger.error('Could not query entries %s', e)
             return None, None
 
     def to_dict(self) -> Dict:
+        return Entry.row_to_dict(self)
+
+    @staticmethod
+    def row_to_dict(row) -> Dict:
         return {
-            'id': self.id,
-            'name': self.name,
-            'date': self.date.strftime('%Y-%m-%d'),
-            'order_in_series': self.order_in_series,
-            'entrytype': self.entrytype.to_dict(),
-            'series': self.series.to_dict()
+            'id': row.id,
+            'name': row.name,
+            'date': row.date.strftime('%Y-%m-%d'),
+            'order_in_series': row.order_in_series,
+            'entrytype': entrytype_cache.get_dict(row.entrytype_id),
+            'series': series_cache.get_dict(row.series_id)
         }
 
     @staticmethod
@@ -301,10 +399,32 @@ class Entry(RESTModel, base):
         try:
             self.name = data['name']
             self.date = data['date']
-            self.order_in_series = data['order_in_series']
             self.entrytype_id = data['entrytype_id']
-            self.series_id = data['series_id']
+            if data['series_id'] != self.series_id:
+                self._move_to_series(data['series_id'])
+            self.order_in_series = data['order_in_series']
             return self
         except KeyError as e:
             logger.error('Key error when trying to update entry', e)
             return None
+
+    @classmethod
+    def patch_by_id(cls, id: int, data: Dict) -> 'Entry' or None:
+        if 'order_in_series' not in data and 'series_id' not in data:
+            return super().patch_by_id(id, data)
+
+        # changing the order or the series needs to adjust the other entries of the series, use the ORM path
+        entry = db.session.get(Entry, id)
+        if entry is None:
+            return None
+
+        for key, value in data.items():
+            if key not in ('order_in_series', 'series_id'):
+                setattr(entry, key, value)
+        if 'series_id' in data and data['series_id'] != entry.series_id:
+            # appended to the new series, unless a position is given
+            entry._move_to_series(data['series_id'])
+        if 'order_in_series' in data:
+            entry.order_in_series = data['order_in_series']
+        db.session.flush()
+        return entry
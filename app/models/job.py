@@ -0,0 +1,104 @@
+import json
+import logging
+from datetime import datetime
+from typing import Dict
+
+from marshmallow import Schema, fields
+from sqlalchemy import Column, DateTime, Float, Integer, String, Text, inspect, or_, update
+from sqlalchemy.orm import declarative_base
+
+logger = logging.getLogger(__name__)
+
+base = declarative_base()
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class JobSchema(Schema):
+    type = fields.Str(required=True)
+    params = fields.Dict(load_default=dict)
+
+
+class Job(base):
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    type = Column(String(40), nullable=False)
+    status = Column(String(20), nullable=False, default=QUEUED)
+    # 0 to 1
+    progress = Column(Float, nullable=False, default=0.0)
+    message = Column(String(240))
+    params = Column(Text, nullable=False, default='{}')
+    result = Column(Text)
+    error = Column(Text)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    # process which queued the job and runs it, it refreshes the heartbeat of its unfinished jobs periodically
+    worker = Column(String(80))
+    heartbeat_at = Column(DateTime)
+
+    schema = JobSchema()
+
+    def __init__(self, type: str, params: Dict, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.type = type
+        self.params = json.dumps(params)
+        self.status = QUEUED
+        self.progress = 0.0
+
+    def __str__(self):
+        return f'Job ({self.id}): {self.type} {self.status}'
+
+    @staticmethod
+    def init_entity(session, engine):
+        base.metadata.create_all(bind=engine)
+        # create_all doesn't add columns to existing tables
+        columns = {column['name'] for column in inspect(engine).get_columns(Job.__tablename__)}
+        with engine.begin() as connection:
+            for column in (Job.__table__.c.worker, Job.__table__.c.heartbeat_at):
+                if column.name not in columns:
+                    connection.exec_driver_sql('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        Job.__tablename__, column.name, column.type.compile(engine.dialect)))
+
+    @staticmethod
+    def heartbeat(session, worker: str):
+        """
+        Refreshes the heartbeat of the unfinished jobs of the worker.
+        """
+        session.execute(update(Job)
+                        .where(Job.worker == worker, Job.status.in_([QUEUED, RUNNING]))
+                        .values(heartbeat_at=datetime.utcnow())
+                        .execution_options(synchronize_session=False))
+
+    @staticmethod
+    def fail_stale(session, stale_before: datetime):
+        """
+        Marks queued or running jobs whose worker stopped (no heartbeat since the given time) as failed, they can't be
+        resumed. Jobs of running workers, also of other processes, are not touched.
+        """
+        result = session.execute(update(Job)
+                                 .where(Job.status.in_([QUEUED, RUNNING]),
+                                        or_(Job.heartbeat_at.is_(None), Job.heartbeat_at < stale_before))
+                                 .values(status=FAILED, error='Interrupted, the worker process stopped',
+                                         finished_at=datetime.utcnow())
+                                 .execution_options(synchronize_session=False))
+        if result.rowcount:
+            logger.info('Marked %d interrupted jobs as failed', result.rowcount)
+
+    def to_dict(self) -> Dict:
+        return {
+            'id': self.id,
+            'type': self.type,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'params': json.loads(self.params),
+            'result': json.loads(self.result) if self.result is not None else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
@@ -1,13 +1,12 @@
 import logging
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 from marshmallow import Schema, fields, validates_schema, ValidationError
-from sqlalchemy import select, Column, Integer, String
+from sqlalchemy import Column, Integer, String
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.sql.functions import count
 
-from database import LIMIT, db
-from models.base import RESTModel
+from database import LIMIT
+from models.base import RESTModel, query_page
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +34,7 @@ class Series(RESTModel, base):
     name = Column(String(240), nullable=False, unique=True)
 
     schema = SeriesSchema()
+    sort_fields = ('id', 'name')
 
     def __init__(self, name: str = None, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -48,7 +48,8 @@ class Series(RESTModel, base):
         base.metadata.create_all(bind=engine)
 
     @staticmethod
-    def query_by_id(id: int = None, offset: int = 0, limit: int = LIMIT) -> (List['Series'], int) or (None, None):
+    def query_by_id(id: int = None, offset: int = 0, limit: int = LIMIT, as_dicts: bool = False) \
+            -> (List['Series'], int) or (None, None):
         logger.debug('Series.query(%s, %d)', id, offset)
 
         if limit > LIMIT:
@@ -57,25 +58,20 @@ class Series(RESTModel, base):
 
         try:
             if id:
-                row_count_query = select(count(Series.id)).filter_by(id=id)
-                query = select(Series).limit(limit).filter_by(id=id)
-            else:
-                row_count_query = select(count(Series.id))
-                query = select(Series).limit(limit).offset(offset)
-
-            result = db.session.execute(query).all()
-            result_row_count = db.session.execute(row_count_query).first()
-            return [row['Series'] for row in result], result_row_count[0]
+                return query_page(Series, [Series.id == id], 0, limit, as_dicts=as_dicts)
+            return query_page(Series, [], offset, limit, as_dicts=as_dicts)
         except Exception as e:
             logger.error('Could not query series %s', e)
             return None, None
 
     @staticmethod
-    def query_by_fields(fields: Dict, offset: int = 0, limit: int = LIMIT) -> (List['Series'], int) or (None, None):
-        logger.debug('Series.query_by_fields(%s, %d, %d)', fields, offset, limit)
+    def query_by_fields(fields: Dict, offset: int = 0, limit: int = LIMIT, sort: Tuple[str, bool] = None,
+                        after: Tuple = None, with_count: bool = True, as_dicts: bool = False) \
+            -> (List['Series'], int) or (None, None):
+        logger.debug('Series.query_by_fields(%s, %d, %d, %s, %s)', fields, offset, limit, sort, after)
 
         if 'id' in fields:
-            return Series.query_by_id(fields['id'], offset, limit)
+            return Series.query_by_id(fields['id'], offset, limit, as_dicts)
 
         filter_list = []
         for key, value in fields.items():
@@ -85,21 +81,20 @@ class Series(RESTModel, base):
                 logger.warning('Invalid filter parameter')
                 return None, None
 
-        row_count_query = select(count(Series.id)).filter(*filter_list)
-        query = select(Series).limit(limit).offset(offset).filter(*filter_list)
-
         try:
-            result_rows = db.session.execute(query).all()
-            result_row_count = db.session.execute(row_count_query).first()
-            return [row['Series'] for row in result_rows], result_row_count[0]
+            return query_page(Series, filter_list, offset, limit, sort, after, with_count, as_dicts)
         except Exception as e:
             logger.error('Could not query series %s', e)
             return None, None
 
     def to_dict(self) -> Dict:
+        return Series.row_to_dict(self)
+
+    @staticmethod
+    def row_to_dict(row) -> Dict:
         return {
-            'id': self.id,
-            'name': self.name
+            'id': row.id,
+            'name': row.name
         }
 
     @staticmethod
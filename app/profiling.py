@@ -0,0 +1,162 @@
+"""
+Diagnostics which can be switched on in production without a redeploy.
+
+Request profiling (cProfile, one `.prof` file per request in PROFILE_DIR):
+    PROFILE_REQUESTS=1          profile every request
+    PROFILE_SAMPLE_RATE=0.01    profile a random fraction of the requests
+    PROFILE_TOKEN=<secret>      profile requests sent with the header `X-Profile: <secret>`
+
+Slow query log (logger `slow_queries`, one JSON object per statement):
+    SLOW_QUERY_MS=100           log statements which take longer, with their parameters, the endpoint and the
+                                `EXPLAIN QUERY PLAN` of the statement
+"""
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import time
+from typing import Dict, List
+
+from flask import Flask, g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('slow_queries')
+
+PROFILE_HEADER = 'X-Profile'
+
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|REPLACE)\b', re.IGNORECASE)
+
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+class RequestProfiler:
+
+    def __init__(self, output_dir: str, profile_all: bool = False, sample_rate: float = 0.0, token: str = None):
+        self.output_dir = output_dir
+        self.profile_all = profile_all
+        self.sample_rate = sample_rate
+        self.token = token
+
+    @staticmethod
+    def from_env() -> 'RequestProfiler':
+        return RequestProfiler(os.getenv('PROFILE_DIR', 'profiles'),
+                               _env_flag('PROFILE_REQUESTS'),
+                               float(os.getenv('PROFILE_SAMPLE_RATE', '0')),
+                               os.getenv('PROFILE_TOKEN') or None)
+
+    @property
+    def enabled(self) -> bool:
+        return self.profile_all or self.sample_rate > 0 or self.token is not None
+
+    def _should_profile(self) -> bool:
+        if self.profile_all:
+            return True
+        header = request.headers.get(PROFILE_HEADER)
+        if self.token is not None and header is not None and hmac.compare_digest(header, self.token):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def before_request(self):
+        if self._should_profile():
+            g.profiler = cProfile.Profile()
+            g.profile_start = time.perf_counter()
+            g.profiler.enable()
+
+    def after_request(self, response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+
+        profiler.disable()
+        duration_ms = (time.perf_counter() - g.pop('profile_start')) * 1000
+        endpoint = (request.endpoint or 'unknown').replace('/', '_')
+        file_name = f'{time.strftime("%Y%m%d-%H%M%S")}-{int(time.time() * 1000) % 1000:03d}-' \
+                    f'{request.method}-{endpoint}-{duration_ms:.0f}ms.prof'
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.output_dir, file_name))
+            logger.info('Profiled %s %s (%.1f ms): %s', request.method, request.path, duration_ms, file_name)
+            response.headers['X-Profile-File'] = file_name
+        except OSError as e:
+            logger.error('Could not write profile %s: %s', file_name, e)
+        return response
+
+
+def init_request_profiling(app: Flask, profiler: RequestProfiler = None):
+    profiler = profiler or RequestProfiler.from_env()
+    if not profiler.enabled:
+        return
+
+    logger.info('Request profiling enabled, writing profiles to %s', profiler.output_dir)
+    app.before_request(profiler.before_request)
+    app.after_request(profiler.after_request)
+
+
+class SlowQueryLog:
+
+    def __init__(self, threshold_ms: float):
+        self.threshold_ms = threshold_ms
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # kept by the execution context of the statement, a failing statement doesn't leave it behind
+        context.slow_query_start_time = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration_ms = (time.perf_counter() - context.slow_query_start_time) * 1000
+        if duration_ms < self.threshold_ms:
+            return
+
+        record = {
+            'duration_ms': round(duration_ms, 2),
+            'statement': statement,
+            'parameters': _loggable_parameters(parameters, executemany),
+            'executemany': executemany,
+            'endpoint': f'{request.method} {request.endpoint}' if has_request_context() else None,
+            'plan': None if executemany else _explain(cursor, statement, parameters)
+        }
+        slow_query_logger.warning(json.dumps(record, default=str))
+
+    def install(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+
+def _loggable_parameters(parameters, executemany: bool):
+    if executemany:
+        # only a sample of the rows of a bulk statement
+        return {'rows': len(parameters), 'first': parameters[0] if parameters else None}
+    return parameters
+
+
+def _explain(cursor, statement: str, parameters) -> List[Dict] or None:
+    """
+    Runs `EXPLAIN QUERY PLAN` for the statement on the connection which executed it.
+    """
+    if not _EXPLAINABLE.match(statement):
+        return None
+    try:
+        rows = cursor.connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    except Exception as e:
+        logger.debug('Could not explain statement: %s', e)
+        return None
+    # rows are (id, parent, notused, detail)
+    return [{'id': row[0], 'parent': row[1], 'detail': row[3]} for row in rows]
+
+
+def init_slow_query_log(engines: List, threshold_ms: float = None):
+    if threshold_ms is None:
+        threshold = os.getenv('SLOW_QUERY_MS')
+        if not threshold:
+            return
+        threshold_ms = float(threshold)
+
+    logger.info('Logging queries slower than %.1f ms', threshold_ms)
+    slow_query_log = SlowQueryLog(threshold_ms)
+    for engine in engines:
+        slow_query_log.install(engine)
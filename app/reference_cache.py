@@ -0,0 +1,87 @@
+import logging
+import threading
+from typing import Dict, List, Type
+
+from sqlalchemy import select
+
+import changes
+from database import db
+from models.base import RESTModel
+from models.entrytype import EntryType
+from models.series import Series
+
+logger = logging.getLogger(__name__)
+
+
+class ReferenceCache:
+    """
+    Process wide read-through cache of the serialized rows of a small, rarely changing table. Entries are dropped when
+    a committed transaction changed them. Callers get copies of the cached dicts.
+    """
+
+    def __init__(self, entity_type: Type[RESTModel]):
+        self.entity_type = entity_type
+        self._dicts: Dict[int, Dict] = {}
+        self._lock = threading.Lock()
+        # incremented on every invalidation, rows read before an invalidation must not be cached afterwards
+        self._generation = 0
+
+    @property
+    def table_name(self) -> str:
+        return self.entity_type.__tablename__
+
+    def preload(self, session):
+        with self._lock:
+            generation = self._generation
+
+        entities = session.execute(select(self.entity_type)).scalars().all()
+        logger.info('Preloading %d rows of %s', len(entities), self.table_name)
+        self._store({entity.id: entity.to_dict() for entity in entities}, generation)
+
+    def get_dict(self, id: int) -> Dict or None:
+        data = self._dicts.get(id)
+        if data is not None:
+            return dict(data)
+
+        with self._lock:
+            generation = self._generation
+
+        entity = db.session.get(self.entity_type, id)
+        if entity is None:
+            return None
+
+        data = entity.to_dict()
+        # a transaction which changed rows may read its own uncommitted rows, they are served without caching them
+        if not changes.has_pending_changes(db.session):
+            self._store({id: data}, generation)
+        return dict(data)
+
+    def invalidate(self, id: int = None):
+        with self._lock:
+            self._generation += 1
+            if id is None:
+                self._dicts.clear()
+            else:
+                self._dicts.pop(id, None)
+
+    def handle_changes(self, committed_changes: List[changes.Change]):
+        for change in committed_changes:
+            if change.entity == self.table_name:
+                logger.debug('Invalidating %s (%s)', self.table_name, change.id)
+                self.invalidate(change.id)
+
+    def _store(self, dicts: Dict[int, Dict], generation: int):
+        with self._lock:
+            if generation == self._generation:
+                self._dicts.update(dicts)
+
+
+series_cache = ReferenceCache(Series)
+entrytype_cache = ReferenceCache(EntryType)
+
+
+def init_reference_caches(session):
+    for cache in (series_cache, entrytype_cache):
+        cache.invalidate()
+        changes.add_cache_listener(cache.handle_changes)
+        cache.preload(session)
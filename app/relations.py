@@ -0,0 +1,213 @@
+"""
+Character co-occurrence per series: for each pair of characters of a series, the number of entries both have infos in
+and the first of these entries. The (entry, character) pairs of a series are exported once into columns ordered by
+order_in_series and cached until a committed change touches the series, relations up to an entry are then computed
+from a prefix of the columns.
+
+The co-occurrence counts are the sparse product B·Bᵀ of the character × entry incidence matrix B, computed as a self
+join of the columns on the entry. NumPy is used for it when it is installed, otherwise a plain Python implementation
+with the same results.
+"""
+import itertools
+import logging
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Sequence
+
+from sqlalchemy import select
+
+import changes
+from database import db
+from models.character import Character
+from models.character_info import CharacterInfo
+from models.entry import Entry
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# computed results kept per series, keyed by `upto`
+RESULTS_PER_SERIES = 16
+
+TRACKED_TABLES = (Entry.__tablename__, Character.__tablename__, CharacterInfo.__tablename__)
+
+
+class SeriesColumns(NamedTuple):
+    """
+    Distinct (entry, character) pairs of a series, ordered by order_in_series, entry id and character id.
+    """
+    entry_ids: List[int]
+    orders: List[int]
+    character_ids: List[int]
+
+    def prefix_length(self, upto: int or None) -> int:
+        """
+        Number of pairs of the entries with an order_in_series up to the given one.
+        """
+        return len(self.orders) if upto is None else bisect_right(self.orders, upto)
+
+
+def export_columns(series_id: int) -> SeriesColumns:
+    query = select(Entry.id, Entry._order_in_series, CharacterInfo.character_id) \
+        .join_from(Entry, CharacterInfo, CharacterInfo.entry_id == Entry.id) \
+        .where(Entry.series_id == series_id) \
+        .distinct() \
+        .order_by(Entry._order_in_series, Entry.id, CharacterInfo.character_id)
+    rows = db.session.execute(query).all()
+    return SeriesColumns([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+
+
+class Relations(NamedTuple):
+    """
+    Character pairs with the number of shared entries and their first shared entry, as columns (NumPy arrays or lists)
+    ordered by the number of shared entries (descending) and character ids. Response dicts are only built for the
+    requested page.
+    """
+    first_character_ids: Sequence[int]
+    second_character_ids: Sequence[int]
+    shared_entries: Sequence[int]
+    first_entry_ids: Sequence[int]
+    first_orders: Sequence[int]
+
+    @property
+    def size(self) -> int:
+        return len(self.shared_entries)
+
+    def page(self, offset: int, limit: int) -> List[Dict]:
+        columns = [column[offset:offset + limit] for column in self]
+        columns = [column.tolist() if numpy is not None and isinstance(column, numpy.ndarray) else column
+                   for column in columns]
+        return [{
+            'character_ids': [first_character_id, second_character_id],
+            'shared_entries': shared_entries,
+            'first_entry_id': first_entry_id,
+            'first_order_in_series': first_order
+        } for first_character_id, second_character_id, shared_entries, first_entry_id, first_order in zip(*columns)]
+
+
+EMPTY_RELATIONS = Relations([], [], [], [], [])
+
+
+def _relations_numpy(columns: SeriesColumns, length: int) -> Relations:
+    entry_ids = numpy.asarray(columns.entry_ids[:length], dtype=numpy.int64)
+    character_ids = numpy.asarray(columns.character_ids[:length], dtype=numpy.int64)
+    orders = numpy.asarray(columns.orders[:length], dtype=numpy.int64)
+
+    # the rows of an entry are consecutive, pair every row with the following rows of its entry
+    group_starts = numpy.flatnonzero(numpy.concatenate(([True], entry_ids[1:] != entry_ids[:-1])))
+    group_ends = numpy.append(group_starts[1:], length)
+    partners = numpy.repeat(group_ends, group_ends - group_starts) - numpy.arange(length) - 1
+    left = numpy.repeat(numpy.arange(length), partners)
+    right = left + 1 + numpy.arange(len(left)) - numpy.repeat(numpy.cumsum(partners) - partners, partners)
+
+    # characters are sorted within an entry, so each pair is keyed by (smaller id, larger id)
+    characters, codes = numpy.unique(character_ids, return_inverse=True)
+    keys = codes[left] * len(characters) + codes[right]
+    # pairs are generated in entry order, the first occurrence of a key is its first shared entry
+    keys, first, counts = numpy.unique(keys, return_index=True, return_counts=True)
+
+    ranking = numpy.lexsort((keys, -counts))
+    keys = keys[ranking]
+    first_rows = left[first[ranking]]
+    return Relations(characters[keys // len(characters)], characters[keys % len(characters)], counts[ranking],
+                     entry_ids[first_rows], orders[first_rows])
+
+
+def _relations_python(columns: SeriesColumns, length: int) -> Relations:
+    pairs: Dict = {}
+    rows = zip(columns.entry_ids[:length], columns.orders[:length], columns.character_ids[:length])
+    for (entry_id, order), entry_rows in itertools.groupby(rows, key=lambda row: row[:2]):
+        for pair in itertools.combinations([row[2] for row in entry_rows], 2):
+            relation = pairs.get(pair)
+            if relation is None:
+                pairs[pair] = [1, entry_id, order]
+            else:
+                relation[0] += 1
+
+    ranked = sorted(pairs.items(), key=lambda item: (-item[1][0], item[0]))
+    return Relations([pair[0] for pair, _ in ranked], [pair[1] for pair, _ in ranked],
+                     [relation[0] for _, relation in ranked], [relation[1] for _, relation in ranked],
+                     [relation[2] for _, relation in ranked])
+
+
+def compute_relations(columns: SeriesColumns, upto: int = None) -> Relations:
+    """
+    :param columns: Exported pairs of the series
+    :param upto: Only count entries with an order_in_series up to this one, all entries if None
+    """
+    length = columns.prefix_length(upto)
+    if length == 0:
+        return EMPTY_RELATIONS
+    if numpy is not None:
+        return _relations_numpy(columns, length)
+    return _relations_python(columns, length)
+
+
+class RelationCache:
+    """
+    Process wide cache of the exported columns and computed relations of series. The data of a series is dropped when
+    a committed transaction changed one of its entries, characters or character infos.
+    """
+
+    def __init__(self):
+        self._columns: Dict[int, SeriesColumns] = {}
+        self._results: Dict[int, OrderedDict] = {}
+        self._lock = threading.Lock()
+        # incremented on every invalidation of a series, data read before an invalidation must not be cached afterwards
+        self._generations: Dict[int, int] = {}
+        self._generation = 0
+
+    def _current_generation(self, series_id: int) -> (int, int):
+        return self._generation, self._generations.get(series_id, 0)
+
+    def get_relations(self, series_id: int, upto: int = None) -> Relations:
+        with self._lock:
+            results = self._results.get(series_id)
+            if results is not None and upto in results:
+                results.move_to_end(upto)
+                return results[upto]
+            columns = self._columns.get(series_id)
+            generation = self._current_generation(series_id)
+
+        if columns is None:
+            columns = export_columns(series_id)
+            logger.debug('Exported %d character appearances of series %d', len(columns.entry_ids), series_id)
+        relations = compute_relations(columns, upto)
+
+        with self._lock:
+            if generation == self._current_generation(series_id):
+                self._columns[series_id] = columns
+                results = self._results.setdefault(series_id, OrderedDict())
+                results[upto] = relations
+                if len(results) > RESULTS_PER_SERIES:
+                    results.popitem(last=False)
+        return relations
+
+    def invalidate(self, series_id: int = None):
+        with self._lock:
+            if series_id is None:
+                self._generation += 1
+                self._columns.clear()
+                self._results.clear()
+            else:
+                self._generations[series_id] = self._generations.get(series_id, 0) + 1
+                self._columns.pop(series_id, None)
+                self._results.pop(series_id, None)
+
+    def handle_changes(self, committed_changes: List[changes.Change]):
+        for change in committed_changes:
+            if change.entity in TRACKED_TABLES:
+                # changes without series (e.g. replaced tables) invalidate all series
+                self.invalidate(change.series_id)
+
+
+relation_cache = RelationCache()
+
+
+def init_relation_cache():
+    relation_cache.invalidate()
+    changes.add_cache_listener(relation_cache.handle_changes)
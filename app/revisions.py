@@ -0,0 +1,395 @@
+"""
+Per row revision numbers for incremental synchronisation.
+
+Every tracked table has a `revision` column which is set from a database wide counter by triggers whenever a row is
+inserted or updated, deletes leave a tombstone with the revision of the delete. Triggers also cover Core statements and
+the bulk tools, which bypass the ORM. In sharded mode every shard has its own counter.
+
+All rows written by a transaction get the same revision: the first write of a transaction bumps the counter and marks
+the revision as open, the following writes reuse it and the revision is closed when the transaction commits (an engine
+event, writers using raw connections execute CLOSE_REVISION before their commit). Sync pages never end within a
+revision.
+
+Tombstones are kept for TOMBSTONE_RETENTION_DAYS and removed by the `tombstones` maintenance task
+(`compact_tombstones`), clients whose sync position is older than the removed tombstones are told to reload all data.
+"""
+import logging
+import threading
+import time
+from datetime import date
+from typing import Dict, List, Set, Tuple
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, event, inspect, select, text
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+TRACKED_TABLES = ('series', 'entrytypes', 'entries', 'characters', 'characterinfo')
+
+metadata = MetaData()
+
+# days tombstones are kept, clients which didn't sync for longer have to reload all data
+TOMBSTONE_RETENTION_DAYS = 30
+
+revision_counter = Table(
+    'revision_counter', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('value', Integer, nullable=False),
+    # 1 while the revision `value` is used by an uncommitted transaction
+    Column('open', Integer, nullable=False, server_default='0'),
+    # revision up to which tombstones have been removed
+    Column('compacted', Integer, nullable=False, server_default='0')
+)
+
+tombstones = Table(
+    'tombstones', metadata,
+    Column('entity', String(40), primary_key=True),
+    Column('entity_id', Integer, primary_key=True),
+    Column('revision', Integer, nullable=False, index=True),
+    # unix time
+    Column('deleted_at', Integer),
+    # series of the deleted row, NULL if unknown or the row doesn't belong to a series
+    Column('series_id', Integer)
+)
+
+# last revision of which all rows are committed, the open revision of a writer which didn't close it is excluded
+committed_revision = revision_counter.c.value - revision_counter.c.open
+
+# a no-op if the transaction already has a revision
+_OPEN_REVISION = 'UPDATE revision_counter SET value = value + 1, open = 1 WHERE id = 1 AND open = 0;'
+_CURRENT_REVISION = '(SELECT value FROM revision_counter WHERE id = 1)'
+CLOSE_REVISION = 'UPDATE revision_counter SET open = 0 WHERE id = 1 AND open = 1'
+
+# series of a deleted row, `{row}` is OLD in the triggers and the table name in bulk statements
+_SERIES_OF_ROW = {
+    'series': '{row}.id',
+    'entries': '{row}.series_id',
+    'characters': '{row}.series_id',
+    'characterinfo': '(SELECT series_id FROM entries WHERE entries.id = {row}.entry_id)',
+}
+
+# database URL -> revisions committed by this process, see `take_own_revisions`
+_own_revisions: Dict[str, Set[int]] = {}
+_own_revisions_lock = threading.Lock()
+
+
+def _series_of_row(table: str, row: str) -> str:
+    return _SERIES_OF_ROW.get(table, 'NULL').format(row=row)
+
+
+def _trigger_statements(table: str) -> List[str]:
+    return [
+        f'CREATE TRIGGER {table}_revision_insert AFTER INSERT ON {table} BEGIN '
+        f'{_OPEN_REVISION} '
+        f'UPDATE {table} SET revision = {_CURRENT_REVISION} WHERE id = NEW.id; '
+        f'DELETE FROM tombstones WHERE entity = \'{table}\' AND entity_id = NEW.id; '
+        f'END',
+        # the revision update of the trigger itself doesn't fire triggers (recursive triggers are off)
+        f'CREATE TRIGGER {table}_revision_update AFTER UPDATE ON {table} '
+        f'WHEN NEW.revision IS OLD.revision BEGIN '
+        f'{_OPEN_REVISION} '
+        f'UPDATE {table} SET revision = {_CURRENT_REVISION} WHERE id = NEW.id AND revision IS NOT {_CURRENT_REVISION}; '
+        f'END',
+        f'CREATE TRIGGER {table}_revision_delete AFTER DELETE ON {table} BEGIN '
+        f'{_OPEN_REVISION} '
+        f'INSERT INTO tombstones (entity, entity_id, revision, deleted_at, series_id) '
+        f'VALUES (\'{table}\', OLD.id, {_CURRENT_REVISION}, CAST(strftime(\'%s\', \'now\') AS INTEGER), '
+        f'{_series_of_row(table, "OLD")}) '
+        f'ON CONFLICT (entity, entity_id) DO UPDATE SET revision = excluded.revision, '
+        f'deleted_at = excluded.deleted_at, series_id = excluded.series_id; '
+        f'END',
+    ]
+
+
+def _remember_changes(connection):
+    connection.info['total_changes'] = connection.connection.dbapi_connection.total_changes
+    connection.info.pop('own_revision', None)
+
+
+def _close_revision(connection):
+    """
+    Closes the revision of a committing transaction which wrote rows, so the next transaction takes a new one, and
+    remembers it as committed by this process.
+    """
+    dbapi_connection = connection.connection.dbapi_connection
+    if dbapi_connection.total_changes != connection.info.pop('total_changes', None):
+        dbapi_connection.execute(CLOSE_REVISION)
+        (revision,) = dbapi_connection.execute('SELECT value FROM revision_counter WHERE id = 1').fetchone()
+        connection.info['own_revision'] = revision
+        with _own_revisions_lock:
+            _own_revisions.setdefault(str(connection.engine.url), set()).add(revision)
+
+
+def _forget_revision(connection):
+    # the commit failed, the revision will be used by another transaction
+    revision = connection.info.pop('own_revision', None)
+    if revision is not None:
+        with _own_revisions_lock:
+            _own_revisions.get(str(connection.engine.url), set()).discard(revision)
+
+
+def take_own_revisions(database_url: str, until: int) -> Set[int]:
+    """
+    Removes and returns the revisions up to the given one which this process committed to the database.
+    """
+    with _own_revisions_lock:
+        revisions = _own_revisions.get(database_url, set())
+        taken = {revision for revision in revisions if revision <= until}
+        revisions -= taken
+    return taken
+
+
+def drop_revision_triggers(connection, tables: List[str]) -> List[str]:
+    """
+    Drops the revision triggers of the tables for a bulk load on a DBAPI connection, the revisions of the loaded and
+    deleted rows are then set with `revise_rows` and `tombstone_rows`.
+
+    :return: Statements recreating the triggers
+    """
+    placeholders = ', '.join('?' for _ in tables)
+    triggers = connection.execute(f"SELECT name, sql FROM sqlite_master WHERE type = 'trigger' "
+                                  f"AND tbl_name IN ({placeholders})", tables).fetchall()
+    for name, _ in triggers:
+        connection.execute(f'DROP TRIGGER "{name}"')
+    return [sql for _, sql in triggers]
+
+
+def compact_tombstones(connection, retention_days: float = TOMBSTONE_RETENTION_DAYS) -> Dict:
+    """
+    Removes the tombstones older than the retention on a DBAPI connection in autocommit mode, see module
+    documentation.
+    """
+    cutoff = int(time.time() - retention_days * 86400)
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        (horizon,) = connection.execute('SELECT max(revision) FROM tombstones WHERE deleted_at < ?',
+                                        (cutoff,)).fetchone()
+        removed = 0
+        if horizon is not None:
+            removed = connection.execute('DELETE FROM tombstones WHERE revision <= ?', (horizon,)).rowcount
+            connection.execute('UPDATE revision_counter SET compacted = max(compacted, ?) WHERE id = 1', (horizon,))
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    return {'removed_tombstones': removed, 'compacted_revision': horizon}
+
+
+def _reserve_revisions(connection, table: str) -> Tuple[int, int] or None:
+    """
+    Reserves one revision per id in the id range of the table, so every row gets its own revision and sync pages
+    (which end at a revision) don't split rows with the same revision.
+
+    :return: First reserved revision and lowest id, None if the table is empty
+    """
+    low, high = connection.execute(f'SELECT min(id), max(id) FROM {table}').fetchone()
+    if low is None:
+        return None
+    (value,) = connection.execute('SELECT value FROM revision_counter WHERE id = 1').fetchone()
+    connection.execute('UPDATE revision_counter SET value = value + ?, open = 0 WHERE id = 1', (high - low + 1,))
+    return value + 1, low
+
+
+def tombstone_rows(connection, table: str):
+    """
+    Leaves a tombstone for every row of the table, before all rows are deleted without revision triggers.
+    """
+    reserved = _reserve_revisions(connection, table)
+    if reserved is not None:
+        # WHERE true disambiguates ON CONFLICT from a join constraint
+        connection.execute(f"INSERT INTO tombstones (entity, entity_id, revision, deleted_at, series_id) "
+                           f"SELECT '{table}', id, ? + id - ?, ?, {_series_of_row(table, table)} FROM {table} "
+                           f"WHERE true "
+                           f"ON CONFLICT (entity, entity_id) DO UPDATE SET revision = excluded.revision, "
+                           f"deleted_at = excluded.deleted_at, series_id = excluded.series_id",
+                           reserved + (int(time.time()),))
+
+
+def revise_rows(connection, table: str):
+    """
+    Gives every row of the table a new revision and removes the tombstones of its ids, after rows were inserted
+    without revision triggers.
+    """
+    reserved = _reserve_revisions(connection, table)
+    if reserved is not None:
+        connection.execute(f'UPDATE {table} SET revision = ? + id - ?', reserved)
+        connection.execute(f'DELETE FROM tombstones WHERE entity = ? AND entity_id IN (SELECT id FROM {table})',
+                           (table,))
+
+
+def init_revision_tracking(engine):
+    """
+    Creates the counter and tombstone tables and the triggers. Databases created before revisions existed get the
+    revision column added, their rows are numbered in id order.
+    """
+    metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(text('INSERT OR IGNORE INTO revision_counter (id, value) VALUES (1, 0)'))
+
+        inspector = inspect(connection)
+        # columns added later
+        for table, columns in ((revision_counter, ('open', 'compacted')), (tombstones, ('deleted_at', 'series_id'))):
+            existing = [column['name'] for column in inspector.get_columns(table.name)]
+            for column in columns:
+                if column not in existing:
+                    definition = 'INTEGER NOT NULL DEFAULT 0' if table is revision_counter else 'INTEGER'
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column} {definition}'))
+        connection.execute(text("UPDATE tombstones SET deleted_at = CAST(strftime('%s', 'now') AS INTEGER) "
+                                "WHERE deleted_at IS NULL"))
+
+        for table in TRACKED_TABLES:
+            if 'revision' not in [column['name'] for column in inspector.get_columns(table)]:
+                logger.info('Adding revision column to %s', table)
+                connection.execute(text(f'ALTER TABLE {table} ADD COLUMN revision INTEGER NOT NULL DEFAULT 0'))
+                connection.execute(text(f'UPDATE {table} SET revision = {_CURRENT_REVISION} + id'))
+                connection.execute(text(f'UPDATE revision_counter SET value = value + '
+                                        f'(SELECT coalesce(max(id), 0) FROM {table}) WHERE id = 1'))
+            connection.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_revision ON {table} (revision)'))
+            # replaces the triggers of earlier versions
+            for operation in ('insert', 'update', 'delete'):
+                connection.execute(text(f'DROP TRIGGER IF EXISTS {table}_revision_{operation}'))
+            for statement in _trigger_statements(table):
+                connection.execute(text(statement))
+
+    event.listen(engine, 'begin', _remember_changes)
+    event.listen(engine, 'commit', _close_revision)
+    event.listen(engine, 'rollback', _forget_revision)
+
+
+def parse_sync_position(since: str) -> List[int]:
+    """
+    Parses a sync position, a revision number or in sharded mode one revision number per shard separated by dots.
+
+    :raise ValueError: If the position is invalid
+    """
+    shard_count = len(db.engines)
+    revisions = [int(value) for value in since.split('.')] if since else [0]
+    if revisions == [0]:
+        revisions = [0] * shard_count
+    if len(revisions) != shard_count or any(revision < 0 for revision in revisions):
+        raise ValueError(f'Invalid sync position {since}')
+    return revisions
+
+
+def format_sync_position(revisions: List[int]) -> int or str:
+    if len(revisions) == 1:
+        return revisions[0]
+    return '.'.join(str(revision) for revision in revisions)
+
+
+def _serialize(row) -> Dict:
+    return {key: value.isoformat() if isinstance(value, date) else value for key, value in row.items()}
+
+
+def _changes_on_shard(tables: List[Table], since: int, limit: int or None, bind_arguments: Dict,
+                      until: int = None) -> List[Tuple]:
+    """
+    Reads the changes after the given revision from one database, each table and the tombstones are read with a range
+    scan on their revision index. At most `limit` + 1 changes per table are read, so the result contains the first
+    `limit` changes and more changes exist if it is longer.
+
+    :param limit: None for all changes
+    :param until: Last revision to read
+    :return: Sorted list of (revision, table name, row or None for deletes, id)
+    """
+    changed = []
+    for table in tables:
+        query = select(table).where(table.c.revision > since).order_by(table.c.revision)
+        if until is not None:
+            query = query.where(table.c.revision <= until)
+        if limit is not None:
+            query = query.limit(limit + 1)
+        for row in db.session.execute(query, bind_arguments=bind_arguments).mappings():
+            changed.append((row['revision'], table.name, _serialize(row), row['id']))
+
+    query = select(tombstones.c.revision, tombstones.c.entity, tombstones.c.entity_id) \
+        .where(tombstones.c.revision > since, tombstones.c.entity.in_([table.name for table in tables])) \
+        .order_by(tombstones.c.revision)
+    if until is not None:
+        query = query.where(tombstones.c.revision <= until)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    for row in db.session.execute(query, bind_arguments=bind_arguments):
+        changed.append((row.revision, row.entity, None, row.entity_id))
+
+    changed.sort(key=lambda change: change[0])
+    return changed
+
+
+def _page(tables: List[Table], since: int, until: int, limit: int, bind_arguments: Dict) -> Tuple[List[Tuple], bool]:
+    """
+    :return: Changes of the next page, which never ends within a revision (all rows of a transaction have the same
+        revision), and whether more changes exist
+    """
+    changed = _changes_on_shard(tables, since, limit, bind_arguments, until)
+    if len(changed) <= limit:
+        return changed, False
+
+    next_revision = changed[limit][0]
+    page = [change for change in changed[:limit] if change[0] < next_revision]
+    if not page:
+        # a single revision with more changes than the limit is returned completely
+        page = _changes_on_shard(tables, since, None, bind_arguments, until=next_revision)
+    return page, True
+
+
+def changes_since(since: str, limit: int) -> Dict:
+    """
+    Collects the rows changed and deleted after the given sync position.
+
+    :param since: Sync position returned by a previous call, empty or '0' for all rows
+    :param limit: Maximum number of changes per database, `has_more` is set if there are more changes
+    :return: Dict with the new sync position, the changed rows and the ids of the deleted rows per table. `reset` is
+        set if tombstones newer than the sync position have been removed, the changes are then collected from the
+        start and the client has to drop the rows it doesn't receive.
+    :raise ValueError: If the sync position is invalid
+    """
+    from models.series import Series
+    from models.entrytype import EntryType
+    from models.entry import Entry
+    from models.character import Character
+    from models.character_info import CharacterInfo
+
+    tables = [entity_type.__table__ for entity_type in (Series, EntryType, Entry, Character, CharacterInfo)]
+    revisions = parse_sync_position(since)
+    data = {table.name: [] for table in tables}
+    deleted = {table.name: [] for table in tables}
+    has_more = False
+    reset = False
+
+    committed = []
+    for index in range(len(revisions)):
+        bind_arguments = {'shard_id': db.router.shard_ids[index]} if db.sharded else {}
+        query = select(committed_revision, revision_counter.c.compacted).where(revision_counter.c.id == 1)
+        revision, compacted = db.session.execute(query, bind_arguments=bind_arguments).one()
+        committed.append(revision)
+        if 0 < revisions[index] < compacted:
+            reset = True
+    if reset:
+        revisions = [0] * len(revisions)
+
+    for index in range(len(revisions)):
+        bind_arguments = {'shard_id': db.router.shard_ids[index]} if db.sharded else {}
+        # replicated tables are only read from the primary shard
+        shard_tables = [table for table in tables
+                        if index == 0 or db.router.shards_for_table(table.name) == db.router.shard_ids]
+
+        changed, more = _page(shard_tables, revisions[index], committed[index], limit, bind_arguments)
+        has_more = has_more or more
+
+        for revision, table_name, row, id in changed:
+            if row is None:
+                deleted[table_name].append(id)
+            else:
+                data[table_name].append(row)
+        if changed:
+            revisions[index] = changed[-1][0]
+
+    return {
+        'revision': format_sync_position(revisions),
+        'has_more': has_more,
+        'reset': reset,
+        'data': data,
+        'deleted': deleted
+    }
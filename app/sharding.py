@@ -0,0 +1,239 @@
+import logging
+from typing import Dict, List, Set
+
+from sqlalchemy import inspect, select, func, delete
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.sql import Select, operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from sqlalchemy.sql.util import find_tables
+
+logger = logging.getLogger(__name__)
+
+PRIMARY_SHARD = '0'
+
+# small reference tables, written to the primary shard and replicated to all other shards (the sharded tables have
+# foreign keys to them)
+REPLICATED_TABLES = ('series', 'entrytypes')
+
+# column whose value determines the shard of a row of a sharded table. Ids of sharded tables are allocated so that
+# `id % shard_count` is the index of the shard of the row, so the referenced entry or character id determines the shard
+# as well. Tables which are neither sharded nor replicated (e.g. jobs) only exist in the primary shard.
+SHARD_KEY_COLUMNS = {
+    'entries': ('series_id', 'id'),
+    'characters': ('series_id', 'id'),
+    'characterinfo': ('id', 'entry_id', 'character_id'),
+}
+
+
+def _equality_criteria(whereclause, table_name: str, parameters: Dict = None) -> Dict[str, Set]:
+    """
+    Collects `column = value` criteria on the columns of a table of the top level AND conjunction of the where clause.
+    Criteria inside OR expressions are ignored since they don't restrict the result to their value.
+
+    :param parameters: Execution parameters, they override the values of bound parameters (e.g. for Session.get)
+    """
+    parameters = parameters or {}
+    criteria = {}
+    if whereclause is None:
+        return criteria
+
+    clauses = [whereclause]
+    while clauses:
+        clause = clauses.pop()
+        if isinstance(clause, BooleanClauseList) and clause.operator is operators.and_:
+            clauses.extend(clause.clauses)
+        elif isinstance(clause, BinaryExpression) and isinstance(clause.right, BindParameter) \
+                and hasattr(clause.left, 'name') \
+                and getattr(getattr(clause.left, 'table', None), 'name', None) == table_name:
+            value = parameters.get(clause.right.key, clause.right.effective_value)
+            if clause.operator is operators.eq and value is not None:
+                criteria.setdefault(clause.left.name, set()).add(value)
+            elif clause.operator is operators.in_op and isinstance(value, (list, tuple)) and None not in value:
+                criteria.setdefault(clause.left.name, set()).update(value)
+    return criteria
+
+
+class ShardRouter:
+    """
+    Maps rows to shards (database files) for a ShardedSession. All data of a series (entries, characters and
+    character infos) lives in the shard `series_id % shard_count`, series and entry types are replicated to all shards.
+    """
+
+    def __init__(self, shard_count: int):
+        self.shard_count = shard_count
+        self.shard_ids = [str(index) for index in range(shard_count)]
+
+    def shard_for_series(self, series_id: int) -> str:
+        return str(series_id % self.shard_count)
+
+    def shard_for_id(self, table_name: str, id: int) -> str:
+        if table_name not in SHARD_KEY_COLUMNS:
+            return PRIMARY_SHARD
+        return str(id % self.shard_count)
+
+    def check_shard_key(self, table_name: str, id: int, values: Dict):
+        """
+        Rows can't move to another shard, their id determines the shard.
+
+        :param values: New column values of the row with the given id
+        :raise ValueError: If the values would belong to another shard than the row
+        """
+        shard_id = self.shard_for_id(table_name, id)
+        for column in SHARD_KEY_COLUMNS.get(table_name, ()):
+            value = values.get(column)
+            if column == 'id' or value is None:
+                continue
+            value_shard_id = self.shard_for_series(value) if column == 'series_id' else str(value % self.shard_count)
+            if value_shard_id != shard_id:
+                raise ValueError(f'{column} {value} belongs to another shard than {table_name} {id}, moving rows '
+                                 f'between shards is not supported')
+
+    def shards_for_table(self, table_name: str) -> List[str]:
+        """
+        Shards which have to be read to get all rows of the table.
+        """
+        if table_name not in SHARD_KEY_COLUMNS:
+            return [PRIMARY_SHARD]
+        return self.shard_ids
+
+    def shards_for_criteria(self, table_name: str, whereclause, is_write: bool = False,
+                            parameters: Dict = None) -> List[str]:
+        if table_name in REPLICATED_TABLES:
+            return self.shard_ids if is_write else [PRIMARY_SHARD]
+        if table_name not in SHARD_KEY_COLUMNS:
+            return [PRIMARY_SHARD]
+
+        criteria = _equality_criteria(whereclause, table_name, parameters)
+        for column in SHARD_KEY_COLUMNS.get(table_name, ()):
+            if column in criteria:
+                if column == 'series_id':
+                    return sorted({self.shard_for_series(value) for value in criteria[column]})
+                return sorted({str(value % self.shard_count) for value in criteria[column]})
+        return self.shard_ids
+
+    # ShardedSession callbacks
+
+    def shard_chooser(self, mapper, instance, clause=None) -> str:
+        if instance is None or mapper is None:
+            return PRIMARY_SHARD
+
+        table_name = mapper.local_table.name
+        if table_name not in SHARD_KEY_COLUMNS:
+            return PRIMARY_SHARD
+        if table_name == 'characterinfo':
+            return str(instance.entry_id % self.shard_count)
+        return self.shard_for_series(instance.series_id)
+
+    def id_chooser(self, query, ident) -> List[str]:
+        table_name = query.column_descriptions[0]['entity'].__table__.name
+        return [self.shard_for_id(table_name, ident[0])]
+
+    def execute_chooser(self, orm_context) -> List[str]:
+        """
+        :raise RuntimeError: If the statement can't be routed, it has to be executed with a shard_id bind argument
+        """
+        statement = orm_context.statement
+        if isinstance(statement, Select):
+            # all tables of the FROM clause, including joined tables and the tables of subqueries
+            table_names = sorted({table.name for from_ in statement.get_final_froms() for table in find_tables(from_)})
+        else:
+            mapper = orm_context.bind_mapper
+            table = mapper.local_table if mapper is not None else getattr(statement, 'table', None)
+            table_names = [table.name] if table is not None else []
+        if not table_names:
+            raise RuntimeError(f'Statement without tables can\'t be routed to a shard: {statement}')
+
+        whereclause = getattr(statement, 'whereclause', None)
+        parameters = orm_context.parameters if isinstance(orm_context.parameters, dict) else None
+        is_write = orm_context.is_update or orm_context.is_delete
+        if len(table_names) == 1:
+            return self.shards_for_criteria(table_names[0], whereclause, is_write, parameters)
+        return self._shards_for_join(table_names, whereclause, is_write, parameters)
+
+    def _shards_for_join(self, table_names: List[str], whereclause, is_write: bool, parameters: Dict) -> List[str]:
+        """
+        Routes a statement on several tables. All rows of a series are in one shard, so a join of sharded tables is
+        routed to the shards which can have rows of all of them. Replicated tables are in every shard.
+
+        :raise RuntimeError: If sharded tables are joined with tables which only exist in the primary shard
+        """
+        sharded = [table_name for table_name in table_names if table_name in SHARD_KEY_COLUMNS]
+        primary = [table_name for table_name in table_names
+                   if table_name not in SHARD_KEY_COLUMNS and table_name not in REPLICATED_TABLES]
+        if sharded and primary:
+            raise RuntimeError(f'Tables {", ".join(sharded)} and {", ".join(primary)} are not in the same shards')
+        if not sharded:
+            return self.shard_ids if is_write and not primary else [PRIMARY_SHARD]
+
+        shard_ids = set(self.shard_ids)
+        for table_name in sharded:
+            shard_ids &= set(self.shards_for_criteria(table_name, whereclause, is_write, parameters))
+        # contradicting criteria, no shard has matching rows
+        return sorted(shard_ids) or [PRIMARY_SHARD]
+
+    # session events
+
+    def handle_before_flush(self, session, flush_context, instances):
+        """
+        Allocates ids of new rows of sharded tables, so that the id of a row identifies its shard. The ids are read
+        within a write transaction of the shard (`BEGIN IMMEDIATE`), so concurrent writers, also of other processes,
+        can't allocate the same id.
+
+        :raise ValueError: If a changed row would move to another shard
+        """
+        from database import db
+
+        for instance in session.dirty:
+            table = getattr(instance, '__table__', None)
+            if table is None or table.name not in SHARD_KEY_COLUMNS:
+                continue
+            state = inspect(instance)
+            changed = {column: getattr(instance, column) for column in SHARD_KEY_COLUMNS[table.name]
+                       if column != 'id' and state.attrs[column].history.has_changes()}
+            if changed:
+                self.check_shard_key(table.name, instance.id, changed)
+
+        next_ids = {}
+        for instance in session.new:
+            table = getattr(instance, '__table__', None)
+            if table is None or table.name not in SHARD_KEY_COLUMNS or instance.id is not None:
+                continue
+
+            shard_id = self.shard_chooser(inspect(instance).mapper, instance)
+            key = (table.name, shard_id)
+            if key not in next_ids:
+                db.begin_write_transaction({'shard_id': shard_id})
+                max_id = session.execute(select(func.max(table.c.id)), bind_arguments={'shard_id': shard_id}) \
+                    .scalar() or 0
+                next_ids[key] = max_id + 1
+            next_id = next_ids[key]
+            next_id += (int(shard_id) - next_id) % self.shard_count
+            instance.id = next_id
+            next_ids[key] = next_id + 1
+            logger.debug('Allocated id %d in shard %s for %s', next_id, shard_id, table.name)
+
+    def handle_after_flush(self, session, flush_context):
+        """
+        Replicates written rows of the replicated tables from the primary shard to all other shards, within the
+        transaction of the session.
+        """
+        replica_shards = [shard_id for shard_id in self.shard_ids if shard_id != PRIMARY_SHARD]
+        for instance in list(session.new) + list(session.dirty):
+            table = getattr(instance, '__table__', None)
+            if table is None or table.name not in REPLICATED_TABLES:
+                continue
+
+            mapper = inspect(instance).mapper
+            values = {attribute.columns[0].name: getattr(instance, attribute.key) for attribute in mapper.column_attrs}
+            statement = insert(table).values(values)
+            statement = statement.on_conflict_do_update(index_elements=[table.c.id], set_={
+                name: statement.excluded[name] for name in values if name != 'id'})
+            for shard_id in replica_shards:
+                session.execute(statement, bind_arguments={'shard_id': shard_id})
+
+        for instance in session.deleted:
+            table = getattr(instance, '__table__', None)
+            if table is None or table.name not in REPLICATED_TABLES:
+                continue
+            for shard_id in replica_shards:
+                session.execute(delete(table).where(table.c.id == instance.id), bind_arguments={'shard_id': shard_id})
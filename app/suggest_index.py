@@ -0,0 +1,173 @@
+import bisect
+import logging
+import threading
+from typing import Dict, List, Optional, Set, Tuple, Type
+
+from sqlalchemy import select
+
+import changes
+from database import db
+from models.base import RESTModel
+from models.character import Character
+from models.entry import Entry
+from models.entrytype import EntryType
+from models.series import Series
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixIndex:
+    """
+    In-memory index of the names of all entities of a type for prefix lookups. Names are kept in sorted lists of
+    `(folded name, id)` tuples, one over all entities and one per scope (for example per series), so a lookup is a
+    binary search followed by reading the matching slice.
+
+    The index is built on first use and maintained from committed changes: changed rows are re-read in one query on the
+    next lookup, a bulk delete causes a rebuild. Bulk updates are ignored since the application never changes names or
+    scopes with bulk statements (only Entry.order_in_series).
+    """
+
+    def __init__(self, entity_type: Type[RESTModel], scope_field: str = None):
+        self.entity_type = entity_type
+        self.scope_field = scope_field
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._built = False
+        # incremented whenever the index must be rebuilt, a build started before must not mark the index as built
+        self._generation = 0
+        self._pending_ids: Set[int] = set()
+        self._all: List[Tuple[str, int]] = []
+        self._scopes: Dict[int, List[Tuple[str, int]]] = {}
+        # id -> (name, scope)
+        self._entities: Dict[int, Tuple[str, Optional[int]]] = {}
+
+    @property
+    def table_name(self) -> str:
+        return self.entity_type.__tablename__
+
+    def reset(self):
+        with self._lock:
+            self._built = False
+            self._generation += 1
+            self._pending_ids = set()
+
+    def suggest(self, prefix: str, limit: int, scope: int = None) -> List[Dict]:
+        self._refresh()
+
+        key = prefix.casefold()
+        with self._lock:
+            names = self._all if scope is None else self._scopes.get(scope, [])
+            start = bisect.bisect_left(names, (key,))
+            result = []
+            for folded_name, id in names[start:start + limit]:
+                if not folded_name.startswith(key):
+                    break
+                name, entity_scope = self._entities[id]
+                result.append(self._suggestion(id, name, entity_scope))
+            return result
+
+    def handle_changes(self, committed_changes: List[changes.Change]):
+        with self._lock:
+            for change in committed_changes:
+                if change.entity != self.table_name:
+                    continue
+                if change.id is not None:
+                    self._pending_ids.add(change.id)
+                elif change.operation == changes.DELETE:
+                    logger.debug('Bulk delete on %s, rebuilding prefix index', self.table_name)
+                    self._built = False
+                    self._generation += 1
+
+    def _suggestion(self, id: int, name: str, scope: Optional[int]) -> Dict:
+        suggestion = {'id': id, 'name': name}
+        if self.scope_field:
+            suggestion[self.scope_field] = scope
+        return suggestion
+
+    def _columns(self):
+        table = self.entity_type.__table__
+        columns = [table.c.id, table.c.name]
+        if self.scope_field:
+            columns.append(table.c[self.scope_field])
+        return columns
+
+    def _refresh(self):
+        if self._built and not self._pending_ids:
+            return
+
+        with self._refresh_lock:
+            if not self._built:
+                self._build()
+            elif self._pending_ids:
+                self._update_pending()
+
+    def _build(self):
+        with self._lock:
+            generation = self._generation
+
+        rows = []
+        for bind_arguments in db.bind_arguments_for_table(self.table_name):
+            rows.extend(db.session.execute(select(*self._columns()), bind_arguments=bind_arguments))
+        logger.info('Built prefix index of %s with %d names', self.table_name, len(rows))
+        with self._lock:
+            self._all = []
+            self._scopes = {}
+            self._entities = {}
+            for row in rows:
+                self._insert(row[0], row[1], row[2] if self.scope_field else None)
+            for names in [self._all, *self._scopes.values()]:
+                names.sort()
+            self._built = generation == self._generation
+
+    def _update_pending(self):
+        with self._lock:
+            ids, self._pending_ids = self._pending_ids, set()
+
+        table = self.entity_type.__table__
+        rows = []
+        for bind_arguments in db.bind_arguments_for_table(self.table_name):
+            rows.extend(db.session.execute(select(*self._columns()).where(table.c.id.in_(ids)),
+                                           bind_arguments=bind_arguments))
+        with self._lock:
+            for id in ids:
+                self._remove(id)
+            for row in rows:
+                self._insert(row[0], row[1], row[2] if self.scope_field else None, keep_sorted=True)
+
+    def _insert(self, id: int, name: str, scope: Optional[int], keep_sorted: bool = False):
+        key = (name.casefold(), id)
+        self._entities[id] = (name, scope)
+        names_lists = [self._all]
+        if self.scope_field:
+            names_lists.append(self._scopes.setdefault(scope, []))
+        for names in names_lists:
+            if keep_sorted:
+                bisect.insort(names, key)
+            else:
+                names.append(key)
+
+    def _remove(self, id: int):
+        if id not in self._entities:
+            return
+
+        name, scope = self._entities.pop(id)
+        key = (name.casefold(), id)
+        names_lists = [self._all]
+        if self.scope_field:
+            names_lists.append(self._scopes[scope])
+        for names in names_lists:
+            position = bisect.bisect_left(names, key)
+            if position < len(names) and names[position] == key:
+                del names[position]
+
+
+series_index = PrefixIndex(Series)
+entrytype_index = PrefixIndex(EntryType)
+entry_index = PrefixIndex(Entry, 'series_id')
+character_index = PrefixIndex(Character, 'series_id')
+
+
+def init_suggest_indexes():
+    for index in (series_index, entrytype_index, entry_index, character_index):
+        index.reset()
+        changes.add_cache_listener(index.handle_changes)
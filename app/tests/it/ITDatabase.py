@@ -1,6 +1,8 @@
 import logging
 import os
 import tempfile
+import threading
+import time
 import unittest
 from datetime import date
 from uuid import uuid4
@@ -43,6 +45,7 @@ class ITDatabase(unittest.TestCase):
     def tearDownClass(cls):
         logger.info('Tearing down ITDatabase class')
         cls.db.session.close()
+        cls.db.disconnect_db()
         # cls.env_patcher.stop()
 
         os.remove(cls.tmp_db_file_path)
@@ -169,7 +172,717 @@ class ITDatabase(unittest.TestCase):
         self.assertEqual(None, entries)
 
 
+    def test_entry_search_paging(self):
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
 
+        entry1 = self._add_commit(Entry('b', date(2021, 3, 1), 1, entrytype.id, series.id))
+        entry2 = self._add_commit(Entry('a', date(2021, 1, 1), 2, entrytype.id, series.id))
+        entry3 = self._add_commit(Entry('c', date(2021, 1, 1), 3, entrytype.id, series.id))
+
+        entries, row_count = Entry.query_by_fields({'series_id': series.id}, limit=2, sort=('date', False))
+        self.assertEqual([entry2, entry3], entries)
+        self.assertEqual(3, row_count)
+
+        entries, _ = Entry.query_by_fields({'series_id': series.id}, limit=2, sort=('date', False),
+                                           after=(entry3.date, entry3.id))
+        self.assertEqual([entry1], entries)
+
+        entries, row_count = Entry.query_by_fields({'series_id': series.id}, offset=1, limit=1, sort=('name', True),
+                                                   with_count=False)
+        self.assertEqual([entry1], entries)
+        self.assertIsNone(row_count)
+
+    def test_entry_date_range(self):
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+
+        entry1 = self._add_commit(Entry('a', date(2021, 3, 1), 1, entrytype.id, series.id))
+        entry2 = self._add_commit(Entry('b', date(2021, 1, 1), 2, entrytype.id, series.id))
+        self._add_commit(Entry('c', date(2020, 1, 1), 3, entrytype.id, series.id))
+
+        entries, row_count = Entry.query_by_fields({'date_from': date(2021, 1, 1), 'date_to': date(2021, 3, 1)},
+                                                   sort=('date', True))
+        self.assertEqual([entry1, entry2], entries)
+        self.assertEqual(2, row_count)
+
+        entries, _ = Entry.query_by_fields({'series_id': series.id, 'date_from': date(2021, 2, 1)})
+        self.assertEqual([entry1], entries)
+
+    def test_entry_patch(self):
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+
+        entry1 = self._add_commit(Entry('entry1', date(2021, 1, 1), 1, entrytype.id, series.id))
+        entry2 = self._add_commit(Entry('entry2', date(2021, 2, 1), 2, entrytype.id, series.id))
+        entry3 = self._add_commit(Entry('entry3', date(2021, 3, 1), 3, entrytype.id, series.id))
+
+        patched = Entry.patch_by_id(entry2.id, {'name': 'patched', 'date': date(2022, 1, 1)})
+        self.db.session.commit()
+        self.assertEqual('patched', patched.name)
+        self.assertEqual(date(2022, 1, 1), patched.date)
+        self.assertEqual(2, patched.order_in_series)
+
+        patched = Entry.patch_by_id(entry3.id, {'order_in_series': 1})
+        self.db.session.commit()
+        self.assertEqual(1, patched.order_in_series)
+        self.assertEqual(2, entry1.order_in_series)
+        self.assertEqual(3, entry2.order_in_series)
+
+        self.assertIsNone(Entry.patch_by_id(4242, {'name': 'missing'}))
+        self.db.session.rollback()
+
+        self.assertRaises(ValueError, Entry.patch_by_id, entry1.id, {'order_in_series': 5})
+        self.db.session.rollback()
+
+        # moved entries are appended to the other series, unless a position is given, and leave no gap
+        other_series = self._add_commit(Series('other series'))
+        entry4 = self._add_commit(Entry('entry4', date(2021, 4, 1), 1, entrytype.id, other_series.id))
+        patched = Entry.patch_by_id(entry1.id, {'series_id': other_series.id})
+        self.assertIn(('entries', entry1.id, 'update', series.id), self.db.session.info['pending_changes'])
+        self.db.session.commit()
+        self.assertEqual(2, patched.order_in_series)
+        Entry.patch_by_id(entry3.id, {'series_id': other_series.id, 'order_in_series': 1})
+        self.db.session.commit()
+        self.assertEqual([1, 2, 3], [entry3.order_in_series, entry4.order_in_series, entry1.order_in_series])
+        self.assertEqual(series.id, entry2.series_id)
+        self.assertEqual(1, entry2.order_in_series)
+
+    def test_reference_cache(self):
+        from reference_cache import series_cache
+
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        entry = self._add_commit(Entry('entry', date(2021, 1, 1), 1, entrytype.id, series.id))
+
+        self.assertEqual({'id': series.id, 'name': 'series'}, entry.to_dict()['series'])
+
+        series.name = 'renamed series'
+        self.db.session.commit()
+        self.assertEqual({'id': series.id, 'name': 'renamed series'}, entry.to_dict()['series'])
+
+        EntryType.patch_by_id(entrytype.id, {'name': 'patched entrytype'})
+        self.db.session.rollback()
+        self.assertEqual({'id': entrytype.id, 'name': 'entrytype'}, entry.to_dict()['entrytype'])
+
+        EntryType.patch_by_id(entrytype.id, {'name': 'patched entrytype'})
+        self.db.session.commit()
+        self.assertEqual({'id': entrytype.id, 'name': 'patched entrytype'}, entry.to_dict()['entrytype'])
+
+        # a miss in a transaction with uncommitted changes isn't cached
+        series_cache.invalidate()
+        Series.patch_by_id(series.id, {'name': 'uncommitted series'})
+        self.assertEqual('uncommitted series', series_cache.get_dict(series.id)['name'])
+        self.db.session.rollback()
+        self.assertEqual('renamed series', series_cache.get_dict(series.id)['name'])
+
+        # callers get copies
+        series_cache.get_dict(series.id)['name'] = 'changed by caller'
+        self.assertEqual('renamed series', series_cache.get_dict(series.id)['name'])
+
+    def test_suggest_index(self):
+        from suggest_index import entry_index
+
+        series1 = self._add_commit(Series('series1'))
+        series2 = self._add_commit(Series('series2'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+
+        entry1 = self._add_commit(Entry('Dune', date(2021, 1, 1), 1, entrytype.id, series1.id))
+        entry2 = self._add_commit(Entry('Dune Messiah', date(2021, 1, 1), 2, entrytype.id, series1.id))
+        entry3 = self._add_commit(Entry('dust', date(2021, 1, 1), 1, entrytype.id, series2.id))
+
+        self.assertEqual([entry1.id, entry2.id, entry3.id], [s['id'] for s in entry_index.suggest('du', 10)])
+        self.assertEqual([entry3.id], [s['id'] for s in entry_index.suggest('DU', 10, series2.id)])
+        self.assertEqual([entry1.id], [s['id'] for s in entry_index.suggest('du', 1, series1.id)])
+
+        entry1.name = 'Children of Dune'
+        self.db.session.delete(entry3)
+        self.db.session.commit()
+        self.assertEqual(['Dune Messiah'], [s['name'] for s in entry_index.suggest('du', 10)])
+        self.assertEqual(['Children of Dune'], [s['name'] for s in entry_index.suggest('c', 10, series1.id)])
+
+    def test_change_feed(self):
+        import sqlite3
+        from change_feed import ChangeFeed, change_feed, render_events
+        from changes import Change
+        from revisions import CLOSE_REVISION
+
+        position = change_feed.position
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        entry = self._add_commit(Entry('Dune', date(2021, 1, 1), 1, entrytype.id, series.id))
+        change_feed.poll()
+
+        events, next_position, missed = change_feed.wait_after(position, 0)
+        self.assertFalse(missed)
+        self.assertEqual(next_position, events[-1][0])
+        self.assertIn(('entries', entry.id, 'update', series.id), [change for _, change in events])
+
+        # the commits of other worker processes are read from the revision indexes
+        connection = sqlite3.connect(self.tmp_db_file_path, isolation_level=None)
+        try:
+            connection.execute('UPDATE entries SET name = ? WHERE id = ?', ('Dune Messiah', entry.id))
+            connection.execute(CLOSE_REVISION)
+        finally:
+            connection.close()
+        change_feed.poll()
+        events, newer_position, _ = change_feed.wait_after(next_position, 0)
+        self.assertEqual([('entries', entry.id, 'update', series.id)], [change for _, change in events])
+        self.assertEqual((next_position[0] + 1,), newer_position)
+
+        self.assertEqual(([], newer_position, False), change_feed.wait_after(newer_position, 0))
+        # positions newer than the database have to reload
+        self.assertTrue(change_feed.wait_after((newer_position[0] + 1,), 0)[2])
+
+        # as positions older than the buffer
+        feed = ChangeFeed(buffer_size=1)
+        feed.reset()
+        self.addCleanup(feed.close)
+        position = feed.position
+        self._add_commit(Series('first'))
+        self._add_commit(Series('second'))
+        feed.poll()
+        self.assertTrue(feed.events_after(position)[2])
+        self.assertFalse(feed.events_after((position[0] + 1,))[2])
+
+        # the changes of a revision share its position, which is sent with the last one
+        chunk = render_events([((7,), Change('series', 1, 'update')), ((7,), Change('entries', 2, 'update', 1))],
+                              (7,), False, None, None)
+        self.assertEqual(1, chunk.count('id: 7'))
+        self.assertGreater(chunk.index('id: 7'), chunk.index('"entity":"series"'))
+
+    def test_sync(self):
+        from revisions import changes_since
+
+        revision = changes_since('', 1000)['revision']
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        entry1 = self._add_commit(Entry('entry1', date(2021, 1, 1), 1, entrytype.id, series.id))
+        entry2 = self._add_commit(Entry('entry2', date(2021, 1, 1), 2, entrytype.id, series.id))
+
+        result = changes_since(str(revision), 1000)
+        self.assertEqual([entry1.id, entry2.id], [row['id'] for row in result['data']['entries']])
+        self.assertEqual([series.id], [row['id'] for row in result['data']['series']])
+
+        # the order update of entry2 is a Core statement
+        revision = result['revision']
+        self.db.session.delete(entry1)
+        self.db.session.commit()
+        result = changes_since(str(revision), 1000)
+        self.assertEqual([entry1.id], result['deleted']['entries'])
+        self.assertEqual([(entry2.id, 1)], [(row['id'], row['order_in_series']) for row in result['data']['entries']])
+
+        # the delete and the order update are one transaction, pages don't split a revision
+        self.assertEqual(1, len({row['revision'] for row in result['data']['entries']}))
+        result = changes_since(str(revision), 1)
+        self.assertTrue(result['has_more'])
+        self.assertEqual(2, len(result['data']['entries']) + len(result['deleted']['entries']))
+        self.assertFalse(changes_since(str(result['revision']), 1)['has_more'])
+
+    def test_revision_per_transaction(self):
+        from revisions import changes_since, compact_tombstones
+
+        revision = changes_since('', 1000)['revision']
+        self.db.session.add_all([Series('series1'), Series('series2')])
+        self.db.session.commit()
+        result = changes_since(str(revision), 1000)
+        self.assertEqual(1, len({row['revision'] for row in result['data']['series']}))
+        self.assertEqual(2, len(result['data']['series']))
+        self.assertEqual(revision + 1, result['revision'])
+
+        # removes the tombstones of the deletes, the retention is ignored with a negative value
+        revision = result['revision']
+        self.db.session.query(Series).delete()
+        self.db.session.commit()
+        self.assertEqual(2, len(changes_since(str(revision), 1000)['deleted']['series']))
+        with self.db.raw_connection() as connection:
+            self.assertEqual(0, compact_tombstones(connection)['removed_tombstones'])
+            self.assertGreaterEqual(compact_tombstones(connection, -1)['removed_tombstones'], 2)
+
+        result = changes_since(str(revision), 1000)
+        self.assertTrue(result['reset'])
+        self.assertEqual([], result['deleted']['series'])
+        self.assertFalse(changes_since(str(result['revision']), 1000)['reset'])
+        self.assertFalse(changes_since('', 1000)['reset'])
+
+    def test_row_to_dict(self):
+        from models.character_info import CharacterInfo
+
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        entry = self._add_commit(Entry('entry', date(2021, 1, 1), 1, entrytype.id, series.id))
+        character = self._add_commit(Character('character', series.id, entry.id))
+        info = self._add_commit(CharacterInfo('info', entry.id, character.id))
+
+        # the dicts of the read only requests are equal to the ones of the entities
+        for entity in (series, entrytype, entry, character, info):
+            entity_type = type(entity)
+            query = entity_type.read_query().where(entity_type.__table__.c.id == entity.id)
+            row = self.db.session.execute(query).one()
+            self.assertEqual(entity.to_dict(), entity_type.row_to_dict(row), entity_type.__name__)
+
+        # tearDown deletes the entries first
+        self.db.session.query(CharacterInfo).delete()
+        self.db.session.query(Character).delete()
+        self.db.session.commit()
+
+    def test_entry_indexes(self):
+        from sqlalchemy import select
+        from models.base import drop_indexes
+
+        engine = self.db.engines[0]
+        with engine.begin() as connection:
+            connection.exec_driver_sql('CREATE INDEX ix_entries_series_id ON entries (series_id)')
+        drop_indexes(engine, Entry.obsolete_indexes)
+        with engine.connect() as connection:
+            names = {row[0] for row in connection.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'entries'")}
+        self.assertNotIn('ix_entries_series_id', names)
+
+        def plan(query) -> str:
+            compiled = query.compile(engine, compile_kwargs={'literal_binds': True})
+            with engine.connect() as connection:
+                return ' '.join(row[3] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN {}'.format(compiled)))
+
+        # reading order of a series and sorted pages of all entries are read in index order
+        entries = Entry.__table__
+        self.assertNotIn('TEMP B-TREE', plan(select(entries).where(entries.c.series_id == 1)
+                                             .order_by(entries.c.order_in_series, entries.c.id).limit(10)))
+        for column in (entries.c.name, entries.c.date, entries.c.order_in_series):
+            self.assertNotIn('TEMP B-TREE', plan(select(entries).order_by(column, entries.c.id).limit(10)))
+
+    def test_compiled_validation(self):
+        from marshmallow import ValidationError
+        from api.validation import compile_schema
+        from models.entry import EntrySchema, EntrySearchSchema
+
+        payloads = [
+            {'name': 'Dune', 'date': '1965-01-01', 'order_in_series': 1, 'entrytype_id': 1, 'series_id': 1},
+            {'name': 'Dune', 'date': '1965-01-01', 'order_in_series': '1', 'entrytype_id': 1.0, 'series_id': 1},
+            {'name': None, 'date': '1965-W01-1', 'order_in_series': True, 'unknown': 1},
+            {'order_in_series': 2},
+            {},
+            [],
+        ]
+        for schema in (EntrySchema(), EntrySearchSchema()):
+            compiled = compile_schema(schema)
+            self.assertTrue(compiled.compiled)
+            for payload in payloads:
+                for partial in (False, True):
+                    results = []
+                    for load in (schema.load, compiled.load):
+                        try:
+                            results.append(load(payload, partial=partial))
+                        except ValidationError as e:
+                            results.append(e.messages)
+                    self.assertEqual(results[0], results[1], payload)
+
+    def test_reorder_series_job(self):
+        from unittest import mock
+        from jobs import JobRunner
+        from models.job import Job, SUCCEEDED
+
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        entry1 = self._add_commit(Entry('b', date(2021, 1, 1), 1, entrytype.id, series.id))
+        entry2 = self._add_commit(Entry('a', date(2020, 1, 1), 2, entrytype.id, series.id))
+
+        runner = JobRunner(1, 1, tempfile.gettempdir())
+        with mock.patch.object(self.db, 'begin_write_transaction', wraps=self.db.begin_write_transaction) as begin:
+            job_id = runner.submit('reorder_series', {'series_id': series.id, 'by': 'name'}).id
+            runner.shutdown()
+        # the entries are read under the write lock of the series
+        begin.assert_any_call(self.db.bind_arguments_for_series(series.id))
+
+        self.db.session.expire_all()
+        job = self.db.session.get(Job, job_id)
+        self.assertEqual(SUCCEEDED, job.status, job.error)
+        self.assertEqual({'entries': 2}, job.to_dict()['result'])
+        self.assertEqual((2, 1), (entry1.order_in_series, entry2.order_in_series))
+
+    def test_stale_jobs(self):
+        from datetime import datetime, timedelta
+        from jobs import JobRunner, STALE_AFTER
+        from models.job import FAILED, QUEUED, Job
+
+        runner = JobRunner(1, 1, tempfile.gettempdir())
+        runner.shutdown()
+        stale = datetime.utcnow() - timedelta(seconds=STALE_AFTER + 1)
+        jobs = {
+            'own': Job('reorder_series', {}, worker=runner.worker, heartbeat_at=stale),
+            'running_worker': Job('reorder_series', {}, worker='other', heartbeat_at=datetime.utcnow()),
+            'stopped_worker': Job('reorder_series', {}, worker='stopped', heartbeat_at=stale),
+            'no_heartbeat': Job('reorder_series', {}),
+        }
+        for job in jobs.values():
+            self.db.session.add(job)
+        self.db.session.commit()
+        job_ids = {name: job.id for name, job in jobs.items()}
+
+        runner.heartbeat()
+
+        statuses = {name: self.db.session.get(Job, id, populate_existing=True).status for name, id in job_ids.items()}
+        self.assertEqual({'own': QUEUED, 'running_worker': QUEUED, 'stopped_worker': FAILED,
+                          'no_heartbeat': FAILED}, statuses)
+        self.db.session.query(Job).delete()
+        self.db.session.commit()
+
+    def test_series_counts(self):
+        from api.rest_resources import add_series_counts
+        from models.character_info import CharacterInfo
+
+        series1 = self._add_commit(Series('series1'))
+        series2 = self._add_commit(Series('series2'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        entry1 = self._add_commit(Entry('entry1', date(2021, 1, 1), 1, entrytype.id, series1.id))
+        entry2 = self._add_commit(Entry('entry2', date(2021, 1, 1), 2, entrytype.id, series1.id))
+        character = self._add_commit(Character('character', series1.id, entry1.id))
+        self._add_commit(CharacterInfo('info1', entry1.id, character.id))
+        self._add_commit(CharacterInfo('info2', entry2.id, character.id))
+
+        series_list = [series1.to_dict(), series2.to_dict()]
+        add_series_counts(series_list)
+        self.assertEqual({'entries': 2, 'characters': 1, 'infos': 2}, series_list[0]['counts'])
+        self.assertEqual({'entries': 0, 'characters': 0, 'infos': 0}, series_list[1]['counts'])
+
+        # tearDown deletes the entries first
+        self.db.session.query(CharacterInfo).delete()
+        self.db.session.query(Character).delete()
+        self.db.session.commit()
+
+    def test_snapshot_round_trip(self):
+        from models.character_info import CharacterInfo
+        from revisions import changes_since
+        from tools.snapshot import SnapshotError, TABLES, export_snapshot, import_snapshot
+
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        entry1 = self._add_commit(Entry('entry1', date(2021, 1, 1), 1, entrytype.id, series.id))
+        entry2 = self._add_commit(Entry('entry2', date(2021, 2, 1), 2, entrytype.id, series.id))
+        character = self._add_commit(Character('character', series.id, entry1.id))
+        self._add_commit(CharacterInfo('info1', entry1.id, character.id))
+        self._add_commit(CharacterInfo('info2', entry2.id, character.id))
+
+        def table_rows():
+            result = {}
+            with self.db.raw_connection() as connection:
+                for table in TABLES:
+                    cursor = connection.execute('SELECT * FROM "{}" ORDER BY id'.format(table))
+                    columns = [column[0] for column in cursor.description]
+                    result[table] = [{column: value for column, value in zip(columns, row) if column != 'revision'}
+                                     for row in cursor]
+            return result
+
+        def triggers():
+            with self.db.raw_connection() as connection:
+                return connection.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' "
+                                          "ORDER BY name").fetchall()
+
+        rows = table_rows()
+        trigger_definitions = triggers()
+        since = changes_since('', 1000)['revision']
+        snapshot_path = self.tmp_db_file_path + '.snapshot'
+        try:
+            counts = export_snapshot(self.tmp_db_file_path, snapshot_path)
+            self.assertEqual({'series': 1, 'entrytypes': 1, 'entries': 2, 'characters': 1, 'characterinfo': 2}, counts)
+
+            with self.db.raw_connection() as connection:
+                with self.assertRaises(SnapshotError):
+                    import_snapshot(connection, snapshot_path)
+                self.assertEqual(counts, import_snapshot(connection, snapshot_path, replace=True))
+
+            # a damaged column block fails the import, it is rolled back
+            with open(snapshot_path, 'r+b') as f:
+                f.seek(-16, os.SEEK_END)
+                f.write(b'\xff' * 8)
+            with self.db.raw_connection() as connection:
+                with self.assertRaises(SnapshotError):
+                    import_snapshot(connection, snapshot_path, replace=True)
+        finally:
+            os.remove(snapshot_path)
+
+        self.assertEqual(rows, table_rows())
+        self.assertEqual(trigger_definitions, triggers())
+        # every row got a new revision of its own, the replaced rows' tombstones are gone
+        changed = changes_since(str(since), 1000)
+        self.assertEqual(counts, {table: len(table_rows) for table, table_rows in changed['data'].items()})
+        self.assertEqual({table: [] for table in TABLES}, changed['deleted'])
+        self.assertEqual(7, len({row['revision'] for table_rows in changed['data'].values() for row in table_rows}))
+        # triggers work again
+        self.db.session.expire_all()
+        self._add_commit(Series('series2'))
+        self.assertEqual(1, len(changes_since(str(changed['revision']), 1000)['data']['series']))
+
+        self.db.session.query(CharacterInfo).delete()
+        self.db.session.query(Character).delete()
+        self.db.session.commit()
+
+    def test_character_relations(self):
+        import relations
+        from models.character_info import CharacterInfo
+
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        entry1 = self._add_commit(Entry('entry1', date(2021, 1, 1), 1, entrytype.id, series.id))
+        entry2 = self._add_commit(Entry('entry2', date(2021, 1, 1), 2, entrytype.id, series.id))
+        characters = [self._add_commit(Character(f'character{i}', series.id, entry1.id)) for i in range(3)]
+        for entry, character in [(entry1, 0), (entry1, 1), (entry1, 1), (entry2, 0), (entry2, 1), (entry2, 2)]:
+            self._add_commit(CharacterInfo('info', entry.id, characters[character].id))
+        a, b, c = [character.id for character in characters]
+
+        result = relations.relation_cache.get_relations(series.id)
+        self.assertEqual([([a, b], 2, entry1.id), ([a, c], 1, entry2.id), ([b, c], 1, entry2.id)],
+                         [(row['character_ids'], row['shared_entries'], row['first_entry_id'])
+                          for row in result.page(0, 10)])
+        self.assertEqual(1, relations.relation_cache.get_relations(series.id, upto=1).size)
+
+        # both implementations return the same relations
+        columns = relations.export_columns(series.id)
+        if relations.numpy is not None:
+            length = columns.prefix_length(None)
+            self.assertEqual(relations._relations_python(columns, length).page(0, 10),
+                             relations._relations_numpy(columns, length).page(0, 10))
+
+        # a committed change of the series drops its cached relations
+        self.db.session.query(CharacterInfo).filter(CharacterInfo.character_id == c).delete()
+        self.db.session.commit()
+        self.assertEqual(1, relations.relation_cache.get_relations(series.id).size)
+
+        self.db.session.query(CharacterInfo).delete()
+        self.db.session.query(Character).delete()
+        self.db.session.commit()
+
+    def test_character_sheet(self):
+        from models.character_info import CharacterInfo
+
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        entry1 = self._add_commit(Entry('entry1', date(2021, 1, 1), 1, entrytype.id, series.id))
+        entry2 = self._add_commit(Entry('entry2', date(2021, 1, 1), 2, entrytype.id, series.id))
+        character1 = self._add_commit(Character('character1', series.id, entry1.id))
+        character2 = self._add_commit(Character('character2', series.id, entry2.id))
+        self._add_commit(CharacterInfo('info1', entry1.id, character1.id))
+        self._add_commit(CharacterInfo('info2', entry2.id, character1.id))
+        self._add_commit(CharacterInfo('info3', entry2.id, character2.id))
+
+        sheet, size = CharacterInfo.query_sheet(series.id, upto=1)
+        self.assertEqual([(character1.id, ['info1'])], [(c['id'], [i['text'] for i in c['infos']]) for c in sheet])
+        self.assertEqual(1, size)
+
+        sheet, size = CharacterInfo.query_sheet(series.id)
+        self.assertEqual([(character1.id, ['info1', 'info2']), (character2.id, ['info3'])],
+                         [(c['id'], [i['text'] for i in c['infos']]) for c in sheet])
+        self.assertEqual(2, size)
+
+        sheet, size = CharacterInfo.query_sheet(series.id, offset=1, limit=1)
+        self.assertEqual([(character2.id, ['info3'])], [(c['id'], [i['text'] for i in c['infos']]) for c in sheet])
+        self.assertEqual(2, size)
+        self.assertEqual(([], 2), CharacterInfo.query_sheet(series.id, offset=2, limit=1))
+
+        # tearDown deletes the entries first
+        self.db.session.query(CharacterInfo).delete()
+        self.db.session.query(Character).delete()
+        self.db.session.commit()
+
+    def test_admission_gate(self):
+        from admission import Gate, GateFull
+
+        gate = Gate('write', 1, 1)
+        self.assertTrue(gate.acquire(0.01))
+        # the queue has room for one request, which times out
+        self.assertFalse(gate.acquire(0.01))
+
+        threading.Timer(0.05, gate.release).start()
+        self.assertTrue(gate.acquire(1))
+
+        waiter = threading.Thread(target=gate.acquire, args=(0.5,))
+        waiter.start()
+        while gate.waiting == 0:
+            time.sleep(0.001)
+        with self.assertRaises(GateFull):
+            gate.acquire(0.01)
+        gate.release()
+        waiter.join()
+        self.assertEqual((1, 0), (gate.active, gate.waiting))
+
+    def test_order_integrity(self):
+        from sqlalchemy import update
+        from tools.order_integrity import check_order_in_series, repair_order_in_series
+
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        entries = [self._add_commit(Entry(f'entry{order}', date(2021, 1, 1), order, entrytype.id, series.id))
+                   for order in range(1, 5)]
+        self.assertEqual(0, check_order_in_series()['entries'])
+
+        # a gap after the first entry and a duplicate, as direct SQL could leave them
+        table = Entry.__table__
+        self.db.session.execute(update(table).where(table.c.id == entries[1].id).values(order_in_series=3))
+        self.db.session.execute(update(table).where(table.c.id == entries[3].id).values(order_in_series=6))
+        self.db.session.commit()
+
+        result = check_order_in_series()
+        self.assertEqual((2, 1, [series.id]), (result['entries'], result['series'], result['series_ids']))
+        self.assertEqual(2, repair_order_in_series()['entries'])
+        self.assertEqual(0, check_order_in_series()['entries'])
+
+        self.db.session.expire_all()
+        self.assertEqual([(entry.id, order) for order, entry in enumerate(entries, 1)],
+                         [(entry.id, entry.order_in_series) for entry in
+                          sorted(entries, key=lambda entry: (entry.order_in_series, entry.id))])
+
+    def test_single_flight(self):
+        from coalescing import SingleFlight
+
+        single_flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            release.wait(1)
+            return len(calls)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do(('/series',), compute)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while single_flight.in_flight == 0 or next(iter(single_flight._flights.values())).followers < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(([1] * 5, 1), (results, len(calls)))
+
+        # calls after the flight and after a committed change compute again
+        self.assertEqual(2, single_flight.do(('/series',), compute))
+        single_flight.handle_changes([None])
+        self.assertEqual(3, single_flight.do(('/series',), compute))
+
+
+    def test_maintenance(self):
+        from datetime import datetime
+        from tools.maintenance import MaintenanceScheduler, claim_run, parse_window, run_maintenance
+
+        self._add_commit(Series('series'))
+        results = run_maintenance()
+        self.assertEqual(['analyze', 'tombstones', 'vacuum', 'checkpoint'], [result['task'] for result in results])
+        self.assertIn('series', results[0]['tables'])
+        self.assertTrue(all(result['size_before'] > 0 for result in results))
+        # new databases are created with incremental vacuum in WAL mode
+        self.assertNotIn('skipped', results[1])
+        self.assertNotIn('skipped', results[2])
+        # the statistics are fresh now
+        self.assertEqual([], run_maintenance(['analyze'])[0]['tables'])
+
+        scheduler = MaintenanceScheduler(parse_window('23:00-01:00'), 0, 0)
+        self.assertTrue(scheduler.due(datetime(2021, 1, 1, 0, 30)))
+        self.assertFalse(scheduler.due(datetime(2021, 1, 1, 12, 0)))
+        scheduler.last_run_date = date(2021, 1, 1)
+        self.assertFalse(scheduler.due(datetime(2021, 1, 1, 0, 30)))
+
+        # one worker per day runs the scheduled maintenance
+        engine = self.db.engines[0]
+        self.assertTrue(claim_run(engine, date(2021, 1, 1), 'worker1'))
+        self.assertFalse(claim_run(engine, date(2021, 1, 1), 'worker2'))
+        self.assertTrue(claim_run(engine, date(2021, 1, 2), 'worker2'))
+
+
+    def test_concurrent_ordering(self):
+        import random
+        from sqlalchemy import select
+        from sqlalchemy.orm.exc import ObjectDeletedError, StaleDataError
+
+        series = self._add_commit(Series('series'))
+        entrytype = self._add_commit(EntryType('entrytype'))
+        series_id, entrytype_id = series.id, entrytype.id
+        done = []
+        # any other exception, `database is locked` timeouts included
+        errors = []
+
+        def worker(seed: int):
+            generator = random.Random(seed)
+            session = self.db.session
+            try:
+                for _ in range(25):
+                    ids = session.execute(select(Entry.id).where(Entry.series_id == series_id)).scalars().all()
+                    try:
+                        operation = generator.random()
+                        if operation < 0.5 or len(ids) < 5:
+                            session.add(Entry('entry', date(2021, 1, 1), generator.randint(1, len(ids) + 1),
+                                              entrytype_id, series_id))
+                        elif operation < 0.8:
+                            session.get(Entry, generator.choice(ids)).order_in_series = \
+                                generator.randint(1, len(ids))
+                        else:
+                            session.delete(session.get(Entry, generator.choice(ids)))
+                        session.commit()
+                        done.append(operation)
+                    except (ValueError, ObjectDeletedError, StaleDataError):
+                        # positions computed from a count read before a concurrent delete, deleted entries
+                        session.rollback()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                session.remove()
+
+        # the throughput of concurrent writers is measured by benchmarks/ordering.py
+        workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(8)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertTrue(done)
+
+        orders = self.db.session.execute(select(Entry._order_in_series).where(Entry.series_id == series_id)
+                                         .order_by(Entry._order_in_series)).scalars().all()
+        self.assertEqual(list(range(1, len(orders) + 1)), orders)
+
+    def test_cache_coherence(self):
+        import sqlite3
+        import changes
+        from changes import Change
+        from coherence import cache_coherence
+        from reference_cache import series_cache
+        from revisions import CLOSE_REVISION
+        from suggest_index import series_index
+        from unittest import mock
+
+        series = self._add_commit(Series('series'))
+        cache_coherence.check()
+        # the caches already got the changes of this process at the commit
+        self._add_commit(Series('own'))
+        self.assertEqual(0, cache_coherence.check())
+        self.assertEqual('series', series_cache.get_dict(series.id)['name'])
+        self.assertEqual(1, len(series_index.suggest('seri', 10)))
+
+        # another worker process renames the series
+        connection = sqlite3.connect(self.tmp_db_file_path, isolation_level=None)
+        try:
+            connection.execute('UPDATE series SET name = ? WHERE id = ?', ('renamed', series.id))
+            # the revision is only seen once the writer closes it, as the commit of a worker process does
+            self.assertEqual(0, cache_coherence.check())
+            connection.execute(CLOSE_REVISION)
+            self.assertEqual('series', series_cache.get_dict(series.id)['name'])
+            self.assertEqual(1, cache_coherence.check())
+            # requests use fresh sessions, this one still has the series loaded
+            self.db.session.expire_all()
+            self.assertEqual('renamed', series_cache.get_dict(series.id)['name'])
+            self.assertEqual([], series_index.suggest('seri', 10))
+            self.assertEqual(0, cache_coherence.check())
+
+            connection.execute('DELETE FROM series WHERE id = ?', (series.id,))
+            connection.execute(CLOSE_REVISION)
+            with mock.patch('changes.publish_external_changes', wraps=changes.publish_external_changes) as publish:
+                self.assertEqual(1, cache_coherence.check())
+            # tombstones keep the series of the row
+            self.assertEqual([Change('series', series.id, changes.DELETE, series.id)], publish.call_args[0][0])
+            self.db.session.expunge_all()
+            self.assertIsNone(series_cache.get_dict(series.id))
+        finally:
+            connection.close()
 
 
 
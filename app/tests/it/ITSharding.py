@@ -0,0 +1,250 @@
+import logging
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from uuid import uuid4
+
+from sqlalchemy import select
+
+from models.character import Character
+from models.character_info import CharacterInfo
+from models.entry import Entry
+from models.entrytype import EntryType
+from models.series import Series
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ITSharding(unittest.TestCase):
+    tmp_db_file_path = None
+    db = None
+    app = None
+    client = None
+    env_patcher = None
+
+    @classmethod
+    def setUpClass(cls):
+        logger.info('Setting up ITSharding class')
+
+        cls.tmp_db_file_path = os.path.join(tempfile.gettempdir(), '{}-{}-{{shard}}.db'.format(cls.__name__, uuid4()))
+        db_connection_string = 'sqlite+pysqlite:///{}'.format(cls.tmp_db_file_path)
+
+        cls.env_patcher = mock.patch.dict(os.environ, {'DB_CONNECTION_STRING': db_connection_string,
+                                                       'DB_SHARD_COUNT': '2'})
+        cls.env_patcher.start()
+
+        from webapp import create_app
+        cls.app = create_app()
+        cls.client = cls.app.test_client()
+
+        from database import db
+        cls.db = db
+
+    @classmethod
+    def tearDownClass(cls):
+        logger.info('Tearing down ITSharding class')
+        cls.db.disconnect_db()
+        cls.env_patcher.stop()
+
+        for shard_id in ('0', '1'):
+            os.remove(cls.tmp_db_file_path.format(shard=shard_id))
+
+    def setUp(self):
+        self.series_ids = [self._post('/rest/series', {'name': name}) for name in ('Odd', 'Even')]
+        self.entrytype_id = self._post('/rest/entrytypes', {'name': 'Book'})
+
+    def tearDown(self):
+        with self.app.app_context():
+            for table in (CharacterInfo.__table__, Character.__table__, Entry.__table__):
+                for bind_arguments in self.db.bind_arguments_for_table(table.name):
+                    self.db.session.execute(table.delete(), bind_arguments=bind_arguments)
+            self.db.session.commit()
+            for entity_type in (Series, EntryType):
+                for entity in self.db.session.query(entity_type).all():
+                    self.db.session.delete(entity)
+            self.db.session.commit()
+
+    def _post(self, path, body):
+        response = self.client.post(path, json=body)
+        self.assertEqual(201, response.status_code, response.get_data(as_text=True))
+        name = path.rstrip('/').rsplit('/', 1)[1]
+        items = self.client.get('/rest/{}?name={}'.format(name, body['name'])).get_json()['data']
+        return max(item['id'] for item in items)
+
+    def _entry(self, series_id, order_in_series, name=None):
+        return self._post('/rest/entries', {'name': name or 'Entry {} {}'.format(series_id, order_in_series),
+                                            'date': '2020-01-01', 'order_in_series': order_in_series,
+                                            'entrytype_id': self.entrytype_id, 'series_id': series_id})
+
+    def _shard_rows(self, table, shard_id):
+        with self.app.app_context():
+            return self.db.session.execute(select(table.c.id), bind_arguments={'shard_id': shard_id}).scalars().all()
+
+    def test_replication(self):
+        for shard_id in ('0', '1'):
+            self.assertEqual(sorted(self.series_ids), sorted(self._shard_rows(Series.__table__, shard_id)))
+            self.assertEqual([self.entrytype_id], self._shard_rows(EntryType.__table__, shard_id))
+
+        response = self.client.patch('/rest/entrytypes/{}'.format(self.entrytype_id), json={'name': 'Novel'})
+        self.assertEqual(200, response.status_code)
+        with self.app.app_context():
+            for shard_id in ('0', '1'):
+                name = self.db.session.execute(select(EntryType.__table__.c.name),
+                                               bind_arguments={'shard_id': shard_id}).scalar()
+                self.assertEqual('Novel', name)
+
+    def test_id_allocation(self):
+        for series_id in self.series_ids:
+            for order_in_series in (1, 2, 3):
+                self._entry(series_id, order_in_series)
+
+        for shard_id in ('0', '1'):
+            ids = self._shard_rows(Entry.__table__, shard_id)
+            self.assertEqual(3, len(ids))
+            self.assertTrue(all(str(id % 2) == shard_id for id in ids))
+
+    def test_concurrent_id_allocation(self):
+        series_id = self.series_ids[0]
+        entry_id = self._entry(series_id, 1)
+        barrier = threading.Barrier(4)
+        errors = []
+
+        def insert(index):
+            with self.app.app_context():
+                try:
+                    barrier.wait()
+                    for number in range(5):
+                        self.db.session.add(Character('Thread {} {}'.format(index, number), series_id, entry_id))
+                        self.db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+                    self.db.session.rollback()
+
+        threads = [threading.Thread(target=insert, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        ids = self._shard_rows(Character.__table__, str(series_id % 2))
+        self.assertEqual(20, len(set(ids)))
+
+    def test_reads(self):
+        for series_id in self.series_ids:
+            self._entry(series_id, 1, 'Dune {}'.format(series_id))
+
+        # routed to the shard of the series
+        for series_id in self.series_ids:
+            data = self.client.get('/rest/series/{}/entries'.format(series_id)).get_json()['data']
+            self.assertEqual(['Dune {}'.format(series_id)], [entry['name'] for entry in data])
+
+        # scatter read over both shards
+        response = self.client.get('/rest/entries?sort=name')
+        self.assertEqual(200, response.status_code)
+        body = response.get_json()
+        self.assertEqual(2, body['size'])
+        self.assertEqual(sorted('Dune {}'.format(series_id) for series_id in self.series_ids),
+                         [entry['name'] for entry in body['data']])
+
+        entry = body['data'][0]
+        self.assertEqual(entry, self.client.get('/rest/entries/{}'.format(entry['id'])).get_json())
+
+    def test_execute_chooser(self):
+        from types import SimpleNamespace
+        from sqlalchemy import func, literal
+        from models.job import Job
+        from sharding import PRIMARY_SHARD
+
+        router = self.db.router
+
+        def route(statement):
+            return router.execute_chooser(SimpleNamespace(statement=statement, bind_mapper=None, parameters={},
+                                                          is_update=False, is_delete=False))
+
+        series, entries, infos = Series.__table__, Entry.__table__, CharacterInfo.__table__
+        joined = select(func.count(infos.c.id)).join_from(infos, entries, infos.c.entry_id == entries.c.id)
+        # joins are routed by the criteria on each of their tables
+        self.assertEqual([router.shard_for_series(self.series_ids[1])],
+                         route(joined.where(entries.c.series_id == self.series_ids[1])))
+        self.assertEqual(router.shard_ids, route(joined))
+        self.assertEqual([router.shard_for_series(self.series_ids[1])],
+                         route(select(entries.c.id).join_from(entries, series, entries.c.series_id == series.c.id)
+                               .where(entries.c.series_id == self.series_ids[1])))
+        self.assertEqual([PRIMARY_SHARD], route(select(series.c.id, Job.__table__.c.id)))
+
+        # statements which can't be routed need a shard_id bind argument
+        self.assertRaises(RuntimeError, route, select(infos.c.id, Job.__table__.c.id))
+        self.assertRaises(RuntimeError, route, select(literal(1)))
+        self.assertEqual([1], self.db.session.execute(select(literal(1)),
+                                                      bind_arguments={'shard_id': PRIMARY_SHARD}).scalars().all())
+
+    def test_snapshot_commands(self):
+        runner = self.app.test_cli_runner()
+        snapshot_path = self.tmp_db_file_path + '.snapshot'
+        for args in (['export-snapshot', snapshot_path], ['import-snapshot', __file__]):
+            result = runner.invoke(args=args)
+            self.assertEqual(1, result.exit_code, result.output)
+            self.assertIn('not supported in sharded mode', result.output)
+        self.assertFalse(os.path.exists(snapshot_path))
+
+    def test_cross_shard_move_rejected(self):
+        entry_id = self._entry(self.series_ids[0], 1)
+        other_series_id = self.series_ids[1]
+
+        response = self.client.patch('/rest/entries/{}'.format(entry_id), json={'series_id': other_series_id})
+        self.assertEqual(400, response.status_code)
+
+        response = self.client.put('/rest/entries/{}'.format(entry_id), json={
+            'name': 'Moved', 'date': '2020-01-01', 'order_in_series': 1, 'entrytype_id': self.entrytype_id,
+            'series_id': other_series_id})
+        self.assertEqual(400, response.status_code)
+
+        entry = self.client.get('/rest/entries/{}'.format(entry_id)).get_json()
+        self.assertEqual(self.series_ids[0], entry['series']['id'])
+
+    def test_generate_data(self):
+        from change_feed import change_feed
+        from tools.datagen import generate_data, generate_dataset
+        from tools.order_integrity import check_order_in_series
+
+        position = change_feed.position
+        with self.app.app_context():
+            counts = generate_data(4, 5, 3, 2, batch_size=7)
+            self.assertEqual({'series': 4, 'entries': 20, 'characters': 12, 'characterinfo': 24}, counts)
+            # gapless order_in_series starting at 1 in every series
+            self.assertEqual(0, check_order_in_series()['entries'])
+
+        for table in (Entry.__table__, Character.__table__, CharacterInfo.__table__):
+            ids = {shard_id: self._shard_rows(table, shard_id) for shard_id in ('0', '1')}
+            self.assertEqual(counts[table.name], sum(len(shard_ids) for shard_ids in ids.values()))
+            for shard_id, shard_ids in ids.items():
+                self.assertTrue(all(str(id % 2) == shard_id for id in shard_ids), table.name)
+        self.assertEqual(self._shard_rows(Series.__table__, '0'), self._shard_rows(Series.__table__, '1'))
+        self.assertEqual(self._shard_rows(EntryType.__table__, '0'), self._shard_rows(EntryType.__table__, '1'))
+
+        # the rows of a series are found through the router
+        series = self.client.get('/rest/series?limit=100').get_json()['data']
+        self.assertEqual(6, len(series))
+        for item in series:
+            if item['id'] not in self.series_ids:
+                self.assertEqual(5, self.client.get('/rest/series/{}/entries'.format(item['id'])).get_json()['size'])
+
+        # the loaded rows are published to the change feed, with a revision per shard
+        change_feed.poll()
+        events, next_position, _ = change_feed.wait_after(position, 0)
+        self.assertEqual(2, len(next_position))
+        self.assertEqual({'entrytypes', 'series', 'entries', 'characters', 'characterinfo'},
+                         {change.entity for _, change in events})
+        self.assertEqual(counts['entries'], len({change.id for _, change in events if change.entity == 'entries'}))
+
+        # the bulk load restores the durability setting of the connections
+        with self.db.raw_connection('0') as first, self.db.raw_connection('1') as second:
+            for connection in (first, second):
+                connection.execute('PRAGMA synchronous=NORMAL')
+            generate_dataset([first, second], 1, 1, 1, 1, seed=7)
+            self.assertEqual([1, 1], [connection.execute('PRAGMA synchronous').fetchone()[0]
+                                      for connection in (first, second)])
@@ -0,0 +1,390 @@
+import logging
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from uuid import uuid4
+
+from models.entry import Entry
+from models.entrytype import EntryType
+from models.series import Series
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ITWebapp(unittest.TestCase):
+    tmp_db_file_path = None
+    db = None
+    app = None
+    client = None
+    env_patcher = None
+
+    @classmethod
+    def setUpClass(cls):
+        logger.info('Setting up ITWebapp class')
+
+        cls.tmp_db_file_path = os.path.join(tempfile.gettempdir(), '{}-{}.db'.format(cls.__name__, uuid4()))
+        db_connection_string = 'sqlite+pysqlite:///{}'.format(cls.tmp_db_file_path)
+
+        cls.env_patcher = mock.patch.dict(os.environ, {'DB_CONNECTION_STRING': db_connection_string})
+        cls.env_patcher.start()
+
+        from webapp import create_app
+        cls.app = create_app()
+        cls.client = cls.app.test_client()
+
+        from database import db
+        cls.db = db
+
+    @classmethod
+    def tearDownClass(cls):
+        logger.info('Tearing down ITWebapp class')
+        cls.db.disconnect_db()
+        cls.env_patcher.stop()
+
+        os.remove(cls.tmp_db_file_path)
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.db.session.query(Entry).delete()
+            self.db.session.query(Series).delete()
+            self.db.session.query(EntryType).delete()
+            self.db.session.commit()
+
+    def _post(self, path, body):
+        response = self.client.post(path, json=body)
+        self.assertEqual(201, response.status_code, response.get_data(as_text=True))
+
+    def _get(self, path):
+        response = self.client.get(path)
+        self.assertEqual(200, response.status_code, response.get_data(as_text=True))
+        return response.get_json()
+
+    def _batch(self, *sub_requests):
+        response = self.client.post('/rest/batch', json={'requests': [
+            dict(zip(('method', 'path', 'body'), sub_request)) for sub_request in sub_requests]})
+        self.assertEqual(200, response.status_code, response.get_data(as_text=True))
+        return response.get_json()['responses']
+
+    def test_batch_mixed(self):
+        self._post('/rest/series', {'name': 'Batch'})
+        series = self._get('/rest/series')['data'][0]
+
+        results = self._batch(('POST', '/rest/entrytypes', {'name': 'Book'}),
+                              ('GET', '/rest/series/{}'.format(series['id'])),
+                              ('GET', '/rest/series/{}'.format(series['id'] + 1000)),
+                              ('GET', '/rest/entrytypes'))
+
+        self.assertEqual([201, 200, 404, 200], [result['status'] for result in results])
+        self.assertEqual('Batch', results[1]['body']['name'])
+        # the write of the batch is visible to the sub-requests after it
+        self.assertIn('Book', [entry_type['name'] for entry_type in results[3]['body']['data']])
+
+    def test_batch_read_snapshot(self):
+        self._post('/rest/series', {'name': 'Before'})
+
+        from api import batch
+        run_sub_request = batch._run_sub_request
+        external_writes = []
+
+        def write_between(*args):
+            result = run_sub_request(*args)
+            if not external_writes:
+                # a writer outside the batch, fails at once in rollback journal mode while the snapshot is held
+                connection = sqlite3.connect(self.tmp_db_file_path, timeout=0)
+                try:
+                    with connection:
+                        connection.execute("INSERT INTO series (name) VALUES ('Between')")
+                    external_writes.append(True)
+                except sqlite3.OperationalError:
+                    external_writes.append(False)
+                finally:
+                    connection.close()
+            return result
+
+        with mock.patch.object(batch, '_run_sub_request', write_between):
+            results = self._batch(('GET', '/rest/series'), ('GET', '/rest/series'))
+
+        self.assertEqual(results[0]['body'], results[1]['body'])
+        self.assertEqual(['Before'], [series['name'] for series in results[1]['body']['data']])
+        if external_writes[0]:
+            self.assertEqual(2, self._get('/rest/series')['size'])
+
+    def test_batch_admission(self):
+        controller = self.app.extensions['admission_control']
+
+        from api import batch
+        run_sub_request = batch._run_sub_request
+        active = []
+
+        def record_slots(*args):
+            active.append((controller.reads.active, controller.writes.active))
+            result = run_sub_request(*args)
+            active.append((controller.reads.active, controller.writes.active))
+            return result
+
+        with mock.patch.object(batch, '_run_sub_request', record_slots):
+            self._batch(('GET', '/rest/series'), ('GET', '/rest/entrytypes'))
+            # one read slot for the whole batch
+            self.assertEqual([(1, 0)] * 4, active)
+            self.assertEqual((0, 0), (controller.reads.active, controller.writes.active))
+
+            active.clear()
+            self._batch(('GET', '/rest/series'), ('POST', '/rest/series', {'name': 'Slot'}))
+            self.assertEqual([(0, 1)] * 4, active)
+            self.assertEqual((0, 0), (controller.reads.active, controller.writes.active))
+
+    def test_coalescing(self):
+        from api.rest_resources import SeriesRESTResource
+        from coalescing import single_flight
+
+        controller = self.app.extensions['admission_control']
+        self._post('/rest/series', {'name': 'Coalesced'})
+        computed = []
+        release = threading.Event()
+
+        def wait(entities):
+            computed.append(len(entities))
+            release.wait(5)
+
+        def get(responses):
+            responses.append(self.app.test_client().get('/rest/series?with=wait'))
+
+        def wait_for_followers(count):
+            while not single_flight._flights \
+                    or max(flight.followers for flight in single_flight._flights.values()) < count:
+                threading.Event().wait(0.01)
+
+        with mock.patch.dict(SeriesRESTResource.expansions, {'wait': wait}):
+            responses = []
+            threads = [threading.Thread(target=get, args=(responses,)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            wait_for_followers(3)
+            # the followers released their read slots
+            self.assertEqual(1, controller.reads.active)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual([1], computed)
+            self.assertEqual([200] * 4, [response.status_code for response in responses])
+            self.assertEqual(1, len({response.get_data() for response in responses}))
+            self.assertEqual(4, len({id(response) for response in responses}))
+            self.assertEqual(0, controller.reads.active)
+
+            # a request after a commit doesn't join the computation started before it
+            release.clear()
+            before, after = [], []
+            thread = threading.Thread(target=get, args=(before,))
+            thread.start()
+            while not computed[1:]:
+                threading.Event().wait(0.01)
+            self._post('/rest/series', {'name': 'Committed'})
+            second = threading.Thread(target=get, args=(after,))
+            second.start()
+            while not computed[2:]:
+                threading.Event().wait(0.01)
+            release.set()
+            thread.join()
+            second.join()
+
+            self.assertEqual(3, len(computed))
+            self.assertIn('Committed', [series['name'] for series in after[0].get_json()['data']])
+
+        # sub-requests of batches run on their own
+        with mock.patch.object(single_flight, 'do', wraps=single_flight.do) as do:
+            self.assertEqual([200], [response['status'] for response in self._batch(('GET', '/rest/series'))])
+            do.assert_not_called()
+
+    def test_compiled_schema_cache(self):
+        from api.validation import compile_schema
+        from models.entry import EntrySearchSchema
+
+        # the search resources create a schema instance per request
+        self.assertIs(compile_schema(EntrySearchSchema()), compile_schema(EntrySearchSchema()))
+        self.assertIsNot(compile_schema(EntrySearchSchema()), compile_schema(EntrySearchSchema(exclude=['name'])))
+
+    @staticmethod
+    def _read_until(connection, marker: bytes) -> bytes:
+        data = b''
+        while marker not in data:
+            chunk = connection.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_feed_server(self):
+        from change_feed import change_feed
+        from feed_server import FeedServer
+        from revisions import CLOSE_REVISION
+
+        server = FeedServer(change_feed, '127.0.0.1', 0, heartbeat=0.2)
+        server.start()
+        connections = []
+        try:
+            threads = threading.active_count()
+            for _ in range(20):
+                connection = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+                connection.sendall(b'GET /rest/changes/stream?entity=series HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                connections.append(connection)
+            for connection in connections:
+                head = self._read_until(connection, b'retry: 3000')
+                self.assertTrue(head.startswith(b'HTTP/1.1 200 OK'), head)
+                self.assertIn(b'Content-Type: text/event-stream', head)
+            # all streams are served by the thread of the server
+            self.assertEqual(threads, threading.active_count())
+
+            self._post('/rest/series', {'name': 'Streamed'})
+            for connection in connections:
+                self.assertIn(b'"entity":"series"', self._read_until(connection, b'"entity":"series"'))
+
+            # commits of other worker processes are found by the poller
+            writer = sqlite3.connect(self.tmp_db_file_path, isolation_level=None)
+            try:
+                writer.execute("INSERT INTO series (name) VALUES ('Other worker')")
+                series_id = writer.execute('SELECT last_insert_rowid()').fetchone()[0]
+                writer.execute(CLOSE_REVISION)
+            finally:
+                writer.close()
+            marker = '"id":{}'.format(series_id).encode()
+            self.assertIn(marker, self._read_until(connections[0], marker))
+
+            # keep-alive comments on the idle streams
+            self.assertIn(b': keep-alive', self._read_until(connections[0], b': keep-alive'))
+
+            connection = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+            connections.append(connection)
+            connection.sendall(b'GET /rest/changes/stream?entity=unknown HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            self.assertTrue(self._read_until(connection, b'}').startswith(b'HTTP/1.1 400 Bad Request'))
+        finally:
+            for connection in connections:
+                connection.close()
+            server.stop()
+
+    def test_slow_query_log(self):
+        import json
+        from sqlalchemy import event
+        from sqlalchemy.exc import OperationalError
+        from profiling import SlowQueryLog
+
+        self._post('/rest/series', {'name': 'Slow'})
+        for threshold_ms, logged in ((1000000, False), (0, True)):
+            slow_query_log = SlowQueryLog(threshold_ms)
+            for engine in self.db.engines:
+                slow_query_log.install(engine)
+            try:
+                if not logged:
+                    with self.assertNoLogs('slow_queries'):
+                        self._get('/rest/series')
+                    continue
+                with self.assertLogs('slow_queries', logging.WARNING) as logs:
+                    # failing statements leave nothing behind on their connection
+                    with self.db.engines[0].connect() as connection:
+                        info = dict(connection.info)
+                        self.assertRaises(OperationalError, connection.exec_driver_sql, 'SELECT * FROM missing')
+                        self.assertEqual(info, dict(connection.info))
+                    self._get('/rest/series')
+            finally:
+                for engine in self.db.engines:
+                    event.remove(engine, 'before_cursor_execute', slow_query_log.before_cursor_execute)
+                    event.remove(engine, 'after_cursor_execute', slow_query_log.after_cursor_execute)
+
+            records = [json.loads(record.getMessage()) for record in logs.records]
+            select = next(record for record in records if 'FROM series' in record['statement'])
+            self.assertEqual('GET seriesrestresource', select['endpoint'])
+            self.assertGreaterEqual(select['duration_ms'], 0)
+            self.assertTrue(select['plan'])
+
+    def test_request_profiling(self):
+        import pstats
+        import sys
+        from flask import Flask, g, jsonify
+        from profiling import PROFILE_HEADER, RequestProfiler, init_request_profiling
+
+        app = Flask(__name__)
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        init_request_profiling(app, RequestProfiler(output_dir.name, token='secret'))
+
+        @app.route('/probe')
+        def probe():
+            return jsonify(profiled='profiler' in g)
+
+        @app.route('/fail')
+        def fail():
+            raise RuntimeError('failed')
+
+        with app.test_client() as client:
+            for headers in ({}, {PROFILE_HEADER: 'wrong'}):
+                response = client.get('/probe', headers=headers)
+                self.assertFalse(response.get_json()['profiled'])
+                self.assertNotIn('X-Profile-File', response.headers)
+
+            response = client.get('/probe', headers={PROFILE_HEADER: 'secret'})
+            self.assertTrue(response.get_json()['profiled'])
+            self.assertNotIn('profiler', g)
+            self.assertIsNone(sys.getprofile())
+            profile_path = os.path.join(output_dir.name, response.headers['X-Profile-File'])
+            self.assertGreater(pstats.Stats(profile_path).total_calls, 0)
+
+            # the profiler is stopped for failed requests as well
+            response = client.get('/fail', headers={PROFILE_HEADER: 'secret'})
+            self.assertEqual(500, response.status_code)
+            self.assertIn('X-Profile-File', response.headers)
+            self.assertIsNone(sys.getprofile())
+
+    def test_build_static(self):
+        import json
+        from tools.static_build import MANIFEST_FILE, build_static
+
+        self._post('/rest/entrytypes', {'name': 'Static'})
+        entrytype_id = self._get('/rest/entrytypes')['data'][0]['id']
+        for name in ('Static 1', 'Static 2'):
+            self._post('/rest/series', {'name': name})
+        series_ids = [series['id'] for series in self._get('/rest/series')['data']]
+        for series_id in series_ids:
+            self._post('/rest/entries', {'name': 'Entry', 'date': '2021-01-01', 'order_in_series': 1,
+                                         'entrytype_id': entrytype_id, 'series_id': series_id})
+        changed_id, deleted_id = series_ids
+
+        def files_of(series_id):
+            with open(os.path.join(output_dir, MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+            paths = [os.path.join(output_dir, manifest['files'][url][key])
+                     for url in manifest['series'][str(series_id)]['urls'] for key in ('file', 'gzip_file')]
+            return {path: os.stat(path).st_mtime_ns for path in paths}
+
+        with tempfile.TemporaryDirectory() as output_dir, self.app.app_context():
+            stats = build_static(output_dir)
+            self.assertEqual((2, 2, 0), (stats['series'], stats['rendered_series'], stats['removed']))
+            unchanged = files_of(deleted_id)
+
+            # nothing changed, nothing is rendered
+            stats = build_static(output_dir)
+            self.assertEqual((0, 0, 0), (stats['rendered_series'], stats['written'], stats['removed']))
+
+            # only the series of a changed entry is rendered again
+            entry_id = self._get(f'/rest/series/{changed_id}/entries')['data'][0]['id']
+            response = self.client.patch(f'/rest/entries/{entry_id}', json={'name': 'Changed'})
+            self.assertEqual(200, response.status_code, response.get_data(as_text=True))
+            stats = build_static(output_dir)
+            self.assertEqual(1, stats['rendered_series'])
+            self.assertEqual(unchanged, files_of(deleted_id))
+            with open(os.path.join(output_dir, f'rest/series/{changed_id}/entries.json')) as f:
+                self.assertEqual('Changed', json.load(f)['data'][0]['name'])
+
+            # the files of a deleted series are removed
+            entry_id = self._get(f'/rest/series/{deleted_id}/entries')['data'][0]['id']
+            for path in (f'/rest/entries/{entry_id}', f'/rest/series/{deleted_id}'):
+                response = self.client.delete(path)
+                self.assertEqual(204, response.status_code, response.get_data(as_text=True))
+            stats = build_static(output_dir)
+            self.assertEqual((1, 0), (stats['series'], stats['rendered_series']))
+            self.assertGreater(stats['removed'], 0)
+            self.assertFalse(any(os.path.exists(path) for path in unchanged))
@@ -0,0 +1,264 @@
+"""
+Synthetic dataset generator for benchmarks and tests at production scale. Rows are generated with a fixed seed and
+written with `executemany` in large transactions directly on the DBAPI connections (one per shard), ids are assigned by
+the generator so nothing has to be read back.
+
+Example (run from the app directory):
+
+    DB_CONNECTION_STRING=sqlite:///bench.db python manage.py generate-data \\
+        --series 2000 --entries-per-series 50 --characters-per-series 250 --infos-per-character 20
+"""
+import logging
+import random
+import time
+from contextlib import ExitStack
+from datetime import date, timedelta
+from typing import Iterator, List, Sequence, Tuple
+
+import click
+
+from revisions import CLOSE_REVISION
+
+logger = logging.getLogger(__name__)
+
+ENTRY_TYPES = ['Book', 'Episode', 'Movie', 'Short Story', 'Comic', 'Game']
+# relative frequency of the entry types as main type of a series
+ENTRY_TYPE_WEIGHTS = [40, 30, 10, 8, 8, 4]
+
+SYLLABLES = ['ka', 'el', 'ri', 'an', 'dor', 'mi', 'th', 'ra', 'vel', 'or', 'is', 'ha', 'dri', 'ro', 'yce', 'lia',
+             'mar', 'en', 'gal', 'sa', 'tor', 'ny', 'bel', 'us', 'fen', 'wy', 'la', 'quin', 'zo', 'ar', 'ith', 'ca']
+TITLE_ADJECTIVES = ['Broken', 'Silent', 'Last', 'Golden', 'Hidden', 'Burning', 'Forgotten', 'Shattered', 'Crimson',
+                    'Endless', 'Fallen', 'Iron', 'Lost', 'Second', 'Winter', 'Wandering', 'Bitter', 'Ancient']
+TITLE_NOUNS = ['Crown', 'Empire', 'Blade', 'Storm', 'Throne', 'Heir', 'Shadow', 'Oath', 'Road', 'City', 'Tower',
+               'Kingdom', 'Song', 'Fire', 'Sea', 'Gate', 'Night', 'Return', 'Legacy', 'Path', 'War', 'Moon']
+INFO_WORDS = ['friend', 'of', 'the', 'enemy', 'thief', 'knight', 'captain', 'leader', 'guild', 'betrays', 'saves',
+              'daughter', 'son', 'heir', 'lost', 'found', 'former', 'member', 'order', 'rival', 'mentor', 'travels',
+              'to', 'with', 'against', 'kingdom', 'city', 'dies', 'returns', 'secretly', 'works', 'for', 'a', 'an',
+              'swordmaster', 'mage', 'spy', 'merchant', 'soldier', 'queen', 'king', 'prince', 'sister', 'brother',
+              'revealed', 'as', 'true', 'name', 'is', 'hides', 'in', 'north', 'south', 'loves', 'hates', 'and']
+
+
+class NameGenerator:
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        # a small set of frequent names makes name searches return realistic result sizes
+        self.common_names = [self._name() for _ in range(200)]
+
+    def _name(self) -> str:
+        syllable_count = self.rng.choices([2, 3, 4], [50, 40, 10])[0]
+        return ''.join(self.rng.choice(SYLLABLES) for _ in range(syllable_count)).capitalize()
+
+    def character_name(self) -> str:
+        if self.rng.random() < 0.3:
+            return self.rng.choice(self.common_names)
+        if self.rng.random() < 0.5:
+            return '{} {}'.format(self._name(), self._name())
+        return self._name()
+
+    def title(self) -> str:
+        pattern = self.rng.random()
+        if pattern < 0.4:
+            return 'The {} {}'.format(self.rng.choice(TITLE_ADJECTIVES), self.rng.choice(TITLE_NOUNS))
+        if pattern < 0.7:
+            return '{} of {}'.format(self.rng.choice(TITLE_NOUNS), self._name())
+        if pattern < 0.9:
+            return '{} {}'.format(self._name(), self.rng.choice(TITLE_NOUNS))
+        return self._name()
+
+    def info_text(self) -> str:
+        # word counts are roughly log-normal: mostly short notes, some long ones
+        word_count = max(2, min(40, int(self.rng.lognormvariate(2.0, 0.6))))
+        text = ' '.join(self.rng.choice(INFO_WORDS) for _ in range(word_count))
+        return text[:240].capitalize()
+
+
+def _next_id(cursor, table: str, shard_index: int = 0, shard_count: int = 1) -> int:
+    """
+    :return: Next free id of the table in the shard, ids of sharded tables are allocated like the shard router does
+        (`id % shard_count` is the index of the shard)
+    """
+    next_id = (cursor.execute('SELECT max(id) FROM {}'.format(table)).fetchone()[0] or 0) + 1
+    return next_id + (shard_index - next_id) % shard_count
+
+
+def _ensure_entry_types(cursors: List) -> List[int]:
+    ids = []
+    for name in ENTRY_TYPES:
+        row = cursors[0].execute('SELECT id FROM entrytypes WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            cursors[0].execute('INSERT INTO entrytypes (name) VALUES (?)', (name,))
+            row = (cursors[0].lastrowid,)
+        ids.append(row[0])
+        # replicated to all shards
+        for cursor in cursors[1:]:
+            cursor.execute('INSERT OR IGNORE INTO entrytypes (id, name) VALUES (?, ?)', (row[0], name))
+    for cursor in cursors:
+        cursor.execute(CLOSE_REVISION)
+    return ids
+
+
+def _batched(rows: Iterator[Tuple], batch_size: int) -> Iterator[List[Tuple]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert_chunk(cursor, series_rows: List[Tuple], entry_rows: List[Tuple], character_rows: List[Tuple],
+                  info_rows: List[Tuple], batch_size: int):
+    cursor.execute('BEGIN')
+    try:
+        cursor.executemany('INSERT INTO series (id, name) VALUES (?, ?)', series_rows)
+        for batch in _batched(iter(entry_rows), batch_size):
+            cursor.executemany('INSERT INTO entries (id, name, date, order_in_series, entrytype_id, series_id) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', batch)
+        for batch in _batched(iter(character_rows), batch_size):
+            cursor.executemany('INSERT INTO characters (id, name, series_id, occurs_first_in_entry_id) '
+                               'VALUES (?, ?, ?, ?)', batch)
+        for batch in _batched(iter(info_rows), batch_size):
+            cursor.executemany('INSERT INTO characterinfo (id, text, entry_id, character_id) VALUES (?, ?, ?, ?)',
+                               batch)
+        # all rows of the chunk have one revision
+        cursor.execute(CLOSE_REVISION)
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+
+
+def generate_dataset(connections: Sequence, series_count: int, entries_per_series: int, characters_per_series: int,
+                     infos_per_character: int, seed: int = 42, batch_size: int = 50000) -> dict:
+    """
+    Appends a synthetic dataset to the databases of the given DBAPI (sqlite3) connections, one per shard in the order
+    of the shard indexes (a single one if not sharded). Series and entry types are written to every shard, the rows of
+    a series to the shard of the series. Every new series gets `entries_per_series` entries with a gapless
+    order_in_series starting at 1.
+
+    The rows are written without the session, use `generate_data` to also notify the caches of this process.
+
+    :return: Number of inserted rows per table
+    """
+    rng = random.Random(seed)
+    names = NameGenerator(rng)
+    shard_count = len(connections)
+    cursors = [connection.cursor() for connection in connections]
+    # restored afterwards, the connections may be pooled connections of the app
+    synchronous = [cursor.execute('PRAGMA synchronous').fetchone()[0] for cursor in cursors]
+    for cursor in cursors:
+        cursor.execute('PRAGMA synchronous=OFF')
+
+    try:
+        entrytype_ids = _ensure_entry_types(cursors)
+        series_id = _next_id(cursors[0], 'series')
+        entry_ids = [_next_id(cursor, 'entries', index, shard_count) for index, cursor in enumerate(cursors)]
+        character_ids = [_next_id(cursor, 'characters', index, shard_count) for index, cursor in enumerate(cursors)]
+        info_ids = [_next_id(cursor, 'characterinfo', index, shard_count) for index, cursor in enumerate(cursors)]
+
+        existing_series_names = {row[0] for row in cursors[0].execute('SELECT name FROM series')}
+        counts = {'series': 0, 'entries': 0, 'characters': 0, 'characterinfo': 0}
+
+        # series are generated in chunks so the character info rows of a chunk fit in a few batches
+        series_per_chunk = max(1, batch_size // max(1, characters_per_series * max(1, infos_per_character)))
+        remaining = series_count
+        while remaining > 0:
+            chunk = min(series_per_chunk, remaining)
+            remaining -= chunk
+
+            series_rows = []
+            # per shard
+            entry_rows, character_rows, info_rows = [[] for _ in cursors], [[] for _ in cursors], [[] for _ in cursors]
+            for _ in range(chunk):
+                name = names.title()
+                while name in existing_series_names:
+                    name = '{} {}'.format(name, rng.randint(2, 99))
+                existing_series_names.add(name)
+                series_rows.append((series_id, name))
+                shard = series_id % shard_count
+
+                main_type = rng.choices(entrytype_ids, ENTRY_TYPE_WEIGHTS)[0]
+                entry_date = date(rng.randint(1950, 2015), rng.randint(1, 12), 1)
+                series_entry_ids = []
+                for order in range(1, entries_per_series + 1):
+                    entrytype_id = main_type if rng.random() < 0.9 else rng.choice(entrytype_ids)
+                    entry_rows[shard].append((entry_ids[shard], names.title(), entry_date.isoformat(), order,
+                                              entrytype_id, series_id))
+                    series_entry_ids.append(entry_ids[shard])
+                    entry_date += timedelta(days=rng.randint(30, 800))
+                    entry_ids[shard] += shard_count
+
+                for _ in range(characters_per_series):
+                    # most characters are introduced early in a series
+                    first_order = min(rng.randint(0, entries_per_series - 1), rng.randint(0, entries_per_series - 1))
+                    character_id = character_ids[shard]
+                    character_rows[shard].append((character_id, names.character_name(), series_id,
+                                                  series_entry_ids[first_order]))
+                    for _ in range(infos_per_character):
+                        info_order = rng.randint(first_order, entries_per_series - 1)
+                        info_rows[shard].append((info_ids[shard], names.info_text(), series_entry_ids[info_order],
+                                                 character_id))
+                        info_ids[shard] += shard_count
+                    character_ids[shard] += shard_count
+                series_id += 1
+
+            for index, cursor in enumerate(cursors):
+                _insert_chunk(cursor, series_rows, entry_rows[index], character_rows[index], info_rows[index],
+                              batch_size)
+
+            counts['series'] += len(series_rows)
+            counts['entries'] += sum(len(rows) for rows in entry_rows)
+            counts['characters'] += sum(len(rows) for rows in character_rows)
+            counts['characterinfo'] += sum(len(rows) for rows in info_rows)
+            logger.info('Generated %d of %d series', series_count - remaining, series_count)
+    finally:
+        for cursor, value in zip(cursors, synchronous):
+            cursor.execute(f'PRAGMA synchronous={int(value)}')
+    return counts
+
+
+def generate_data(series_count: int, entries_per_series: int, characters_per_series: int, infos_per_character: int,
+                  seed: int = 42, batch_size: int = 50000) -> dict:
+    """
+    Appends a synthetic dataset to the connected databases (see `generate_dataset`) and publishes the bulk changes of
+    the tables to the caches of this process. Other processes and the change feed see the rows by their revisions (see
+    `coherence`).
+
+    :return: Number of inserted rows per table
+    """
+    import changes
+    from database import db
+
+    shard_ids = db.router.shard_ids if db.sharded else [None]
+    with ExitStack() as stack:
+        connections = [stack.enter_context(db.raw_connection(shard_id)) for shard_id in shard_ids]
+        counts = generate_dataset(connections, series_count, entries_per_series, characters_per_series,
+                                  infos_per_character, seed, batch_size)
+
+    for table in ['entrytypes'] + list(counts):
+        changes.record_change(db.session, table, None, changes.INSERT)
+    db.session.commit()
+    return counts
+
+
+@click.command('generate-data')
+@click.option('--series', 'series_count', type=click.IntRange(min=0), default=100, help='Number of series.')
+@click.option('--entries-per-series', type=click.IntRange(min=1), default=20, help='Number of entries per series.')
+@click.option('--characters-per-series', type=click.IntRange(min=0), default=50,
+              help='Number of characters per series.')
+@click.option('--infos-per-character', type=click.IntRange(min=0), default=5,
+              help='Number of character infos per character.')
+@click.option('--seed', type=int, default=42, help='Random seed, the same seed generates the same dataset.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=50000, help='Rows per executemany call.')
+def generate_data_command(series_count: int, entries_per_series: int, characters_per_series: int,
+                          infos_per_character: int, seed: int, batch_size: int):
+    """Fill the database with a synthetic dataset."""
+    start = time.perf_counter()
+    counts = generate_data(series_count, entries_per_series, characters_per_series, infos_per_character, seed,
+                           batch_size)
+
+    click.echo('Inserted {} in {:.1f}s'.format(
+        ', '.join('{} {}'.format(count, table) for table, count in counts.items()), time.perf_counter() - start))
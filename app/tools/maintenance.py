@@ -0,0 +1,324 @@
+"""
+Database maintenance: refreshing planner statistics, returning free pages to the file system and checkpointing the
+WAL. Runs on every database (all shards in sharded mode), as CLI command (`maintain-db`) or in the app process during
+a low-traffic window:
+
+    MAINTENANCE_WINDOW=03:00-05:00      daily window (local time) to run all tasks in, no scheduled runs if unset
+    MAINTENANCE_IDLE_SECONDS=60         only start if no request arrived for this long
+    MAINTENANCE_VACUUM_PAGES=0          free pages released per run, 0 for all
+    MAINTENANCE_TOMBSTONE_DAYS=30       days the tombstones of deleted rows are kept for sync clients
+    DB_WAL=0                            keep the rollback journal instead of switching database files to WAL mode
+
+New databases are created with `auto_vacuum=INCREMENTAL` and database files are switched to WAL mode at start (see
+`prepare_database`). Of several worker processes sharing the database only one runs the scheduled maintenance of a day,
+the first which claims the day in the `maintenance_runs` row.
+
+Tasks:
+    analyze     `ANALYZE` of the tables whose row count differs from the statistics by STALE_FACTOR or more (all
+                tables with `--full-analyze`). SQLite before 3.46 only considers the tables queried by the current
+                connection in `PRAGMA optimize`, which on a maintenance connection are none.
+    vacuum      `PRAGMA incremental_vacuum`, needs `auto_vacuum=INCREMENTAL`. Existing databases are converted once with
+                `maintain-db --enable-incremental-vacuum`, which rewrites the whole file (`VACUUM`).
+    tombstones  Removes the tombstones of rows deleted before the retention (see `revisions.compact_tombstones`), before
+                vacuum so the freed pages are released.
+    checkpoint  `PRAGMA wal_checkpoint(TRUNCATE)` in WAL mode.
+
+File sizes (database and WAL file) before and after and the duration of each task are logged and returned.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from datetime import time as day_time
+from typing import Dict, List, Sequence, Tuple
+
+import click
+from flask import Flask
+
+logger = logging.getLogger(__name__)
+
+TASKS = ('analyze', 'tombstones', 'vacuum', 'checkpoint')
+# statistics are stale if the row count grew or shrank by this factor since the last ANALYZE
+STALE_FACTOR = 2
+AUTO_VACUUM_INCREMENTAL = 2
+# seconds between checks of the scheduler
+SCHEDULER_INTERVAL = 60
+
+
+@contextmanager
+def _connection(engine):
+    """
+    DBAPI connection of the engine in autocommit mode, see `ScopedDBConnection.raw_connection`.
+    """
+    raw_connection = engine.raw_connection()
+    connection = raw_connection.connection
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        yield connection
+    finally:
+        connection.isolation_level = isolation_level
+        raw_connection.close()
+
+
+def _file_sizes(engine) -> Tuple[int or None, int or None]:
+    """
+    :return: Size of the database file and of its WAL file in bytes, None for in-memory databases and missing files
+    """
+    path = engine.url.database
+    if not path or path == ':memory:':
+        return None, None
+    sizes = []
+    for file_path in (path, path + '-wal'):
+        sizes.append(os.path.getsize(file_path) if os.path.exists(file_path) else None)
+    return sizes[0], sizes[1]
+
+
+def _stale_tables(connection) -> List[str]:
+    statistics = {}
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        for table, stat in connection.execute('SELECT tbl, stat FROM sqlite_stat1'):
+            statistics[table] = int(stat.split()[0])
+
+    stale = []
+    for (table,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                       "AND name NOT LIKE 'sqlite_%'").fetchall():
+        (row_count,) = connection.execute(f'SELECT count(*) FROM "{table}"').fetchone()
+        analyzed = statistics.get(table)
+        if analyzed is None:
+            # empty tables get no statistics
+            if row_count > 0:
+                stale.append(table)
+        elif max(row_count, 1) >= analyzed * STALE_FACTOR or max(row_count, 1) * STALE_FACTOR <= analyzed:
+            stale.append(table)
+    return stale
+
+
+def analyze(connection, full: bool = False) -> Dict:
+    if full:
+        connection.execute('ANALYZE')
+        return {'tables': 'all'}
+
+    tables = _stale_tables(connection)
+    for table in tables:
+        connection.execute(f'ANALYZE "{table}"')
+    return {'tables': tables}
+
+
+def vacuum(connection, pages: int = 0) -> Dict:
+    (free_pages,) = connection.execute('PRAGMA freelist_count').fetchone()
+    (auto_vacuum,) = connection.execute('PRAGMA auto_vacuum').fetchone()
+    if auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+        return {'skipped': 'auto_vacuum is not INCREMENTAL', 'free_pages': free_pages}
+    if free_pages == 0:
+        return {'free_pages': 0, 'released_pages': 0}
+
+    # incremental_vacuum releases one page per step of the statement, execute only steps pragmas without result
+    # columns once, executescript runs it to completion
+    connection.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+    (remaining,) = connection.execute('PRAGMA freelist_count').fetchone()
+    return {'free_pages': free_pages, 'released_pages': free_pages - remaining}
+
+
+def checkpoint(connection) -> Dict:
+    (journal_mode,) = connection.execute('PRAGMA journal_mode').fetchone()
+    if journal_mode.lower() != 'wal':
+        return {'skipped': f'journal_mode is {journal_mode}'}
+
+    busy, wal_pages, checkpointed_pages = connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    return {'busy': bool(busy), 'wal_pages': wal_pages, 'checkpointed_pages': checkpointed_pages}
+
+
+def enable_incremental_vacuum(connection) -> Dict:
+    (auto_vacuum,) = connection.execute('PRAGMA auto_vacuum').fetchone()
+    if auto_vacuum == AUTO_VACUUM_INCREMENTAL:
+        return {'skipped': 'auto_vacuum is already INCREMENTAL'}
+
+    connection.execute(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+    # changing auto_vacuum of a database with tables only takes effect with a VACUUM
+    connection.execute('VACUUM')
+    return {}
+
+
+def prepare_database(engine):
+    """
+    Prepares an SQLite database for the maintenance tasks, must be called before the tables are created: a new (empty)
+    database gets `auto_vacuum=INCREMENTAL`, which can't be changed later without rewriting the file, and database
+    files are switched to WAL mode (persistent), so readers don't block the writer and the checkpoint task has work.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    with _connection(engine) as connection:
+        (objects,) = connection.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        if objects == 0:
+            connection.execute(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+            # writes the setting to the header of the file, instant on an empty database
+            connection.execute('VACUUM')
+
+        path = engine.url.database
+        if path and path != ':memory:' and os.getenv('DB_WAL', '1').lower() not in ('0', 'false', 'no', 'off'):
+            (journal_mode,) = connection.execute('PRAGMA journal_mode = WAL').fetchone()
+            logger.debug('Journal mode of %s: %s', path, journal_mode)
+
+
+def claim_run(engine, day: date, worker: str) -> bool:
+    """
+    Claims the scheduled maintenance of the day for the worker, in a single row table of the database.
+
+    :return: False if another worker already claimed the day
+    """
+    with _connection(engine) as connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS maintenance_runs '
+                           '(id INTEGER PRIMARY KEY CHECK (id = 1), run_date TEXT, worker TEXT)')
+        connection.execute('INSERT OR IGNORE INTO maintenance_runs (id) VALUES (1)')
+        # a single statement, atomic across processes
+        claimed = connection.execute('UPDATE maintenance_runs SET run_date = ?, worker = ? '
+                                     'WHERE id = 1 AND (run_date IS NULL OR run_date < ?)',
+                                     (day.isoformat(), worker, day.isoformat())).rowcount
+    return claimed == 1
+
+
+def run_maintenance(tasks: Sequence[str] = TASKS, full_analyze: bool = False, vacuum_pages: int = 0,
+                    convert: bool = False, tombstone_days: float = None) -> List[Dict]:
+    """
+    Runs the tasks on every database, see module documentation.
+
+    :param convert: Enable incremental vacuum on databases without it first (rewrites the whole database)
+    :param tombstone_days: Retention of tombstones, MAINTENANCE_TOMBSTONE_DAYS if not given
+    :return: Result per database and task with file sizes in bytes and duration
+    """
+    from database import db
+    from revisions import TOMBSTONE_RETENTION_DAYS, compact_tombstones
+
+    if tombstone_days is None:
+        tombstone_days = float(os.getenv('MAINTENANCE_TOMBSTONE_DAYS', TOMBSTONE_RETENTION_DAYS))
+    task_functions = {
+        'analyze': lambda connection: analyze(connection, full_analyze),
+        'tombstones': lambda connection: compact_tombstones(connection, tombstone_days),
+        'vacuum': lambda connection: vacuum(connection, vacuum_pages),
+        'checkpoint': checkpoint
+    }
+    if convert:
+        tasks = ['enable_incremental_vacuum'] + list(tasks)
+        task_functions['enable_incremental_vacuum'] = enable_incremental_vacuum
+
+    results = []
+    for engine in db.engines:
+        database = engine.url.database or ':memory:'
+        with _connection(engine) as connection:
+            for task in tasks:
+                size_before, wal_size_before = _file_sizes(engine)
+                start = time.perf_counter()
+                result = task_functions[task](connection)
+                seconds = time.perf_counter() - start
+                size_after, wal_size_after = _file_sizes(engine)
+
+                logger.info('Maintenance %s of %s in %.2fs: size %s -> %s bytes, WAL %s -> %s bytes %s', task,
+                            database, seconds, size_before, size_after, wal_size_before, wal_size_after, result)
+                results.append(dict(result, database=database, task=task, seconds=round(seconds, 3),
+                                    size_before=size_before, size_after=size_after,
+                                    wal_size_before=wal_size_before, wal_size_after=wal_size_after))
+    return results
+
+
+def parse_window(window: str) -> Tuple[day_time, day_time]:
+    """
+    :param window: `HH:MM-HH:MM`, may wrap around midnight
+    :raise ValueError: If the window is malformed
+    """
+    start, _, end = window.partition('-')
+    return day_time.fromisoformat(start.strip()), day_time.fromisoformat(end.strip())
+
+
+class MaintenanceScheduler:
+    """
+    Runs all maintenance tasks once a day within the window, after the app was idle for a while.
+    """
+
+    def __init__(self, window: Tuple[day_time, day_time], idle_seconds: float, vacuum_pages: int):
+        self.window = window
+        self.idle_seconds = idle_seconds
+        self.vacuum_pages = vacuum_pages
+        self.worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.last_request = time.monotonic()
+        self.last_run_date = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='maintenance', daemon=True)
+
+    def in_window(self, now: datetime) -> bool:
+        start, end = self.window
+        if start <= end:
+            return start <= now.time() < end
+        return now.time() >= start or now.time() < end
+
+    def due(self, now: datetime) -> bool:
+        return self.in_window(now) and self.last_run_date != now.date() \
+            and time.monotonic() - self.last_request >= self.idle_seconds
+
+    def before_request(self):
+        self.last_request = time.monotonic()
+
+    def _loop(self):
+        from database import db
+
+        while not self._stop.wait(SCHEDULER_INTERVAL):
+            now = datetime.now()
+            if not self.due(now):
+                continue
+            self.last_run_date = now.date()
+            try:
+                if not claim_run(db.engines[0], now.date(), self.worker):
+                    logger.info('Maintenance of %s already run by another worker', now.date())
+                    continue
+                run_maintenance(vacuum_pages=self.vacuum_pages)
+            except Exception as e:
+                logger.error('Scheduled maintenance failed: %s', e)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+maintenance_scheduler: MaintenanceScheduler or None = None
+
+
+def init_maintenance_scheduler(app: Flask):
+    global maintenance_scheduler
+    if maintenance_scheduler is not None:
+        maintenance_scheduler.stop()
+        maintenance_scheduler = None
+
+    window = os.getenv('MAINTENANCE_WINDOW')
+    if not window:
+        logger.info('No maintenance window set, database maintenance only runs with maintain-db')
+        return
+
+    maintenance_scheduler = MaintenanceScheduler(parse_window(window),
+                                                 float(os.getenv('MAINTENANCE_IDLE_SECONDS', '60')),
+                                                 int(os.getenv('MAINTENANCE_VACUUM_PAGES', '0')))
+    logger.info('Database maintenance scheduled daily between %s and %s', *maintenance_scheduler.window)
+    app.before_request(maintenance_scheduler.before_request)
+    maintenance_scheduler.start()
+
+
+@click.command('maintain-db')
+@click.option('--task', 'tasks', type=click.Choice(TASKS), multiple=True, help='Task to run (default: all).')
+@click.option('--full-analyze', is_flag=True, help='Analyze all tables, not only the ones with stale statistics.')
+@click.option('--vacuum-pages', type=int, default=0, show_default=True, help='Free pages to release, 0 for all.')
+@click.option('--enable-incremental-vacuum', 'convert', is_flag=True,
+              help='Switch databases to auto_vacuum=INCREMENTAL first (rewrites the whole database).')
+def maintain_db_command(tasks: Tuple[str], full_analyze: bool, vacuum_pages: int, convert: bool):
+    """Refresh planner statistics, release free pages and checkpoint the WAL of the databases."""
+    for result in run_maintenance(tasks or TASKS, full_analyze, vacuum_pages, convert):
+        details = {key: value for key, value in result.items()
+                   if key not in ('database', 'task', 'seconds', 'size_before', 'size_after', 'wal_size_before',
+                                  'wal_size_after')}
+        click.echo('{database} {task}: {seconds:.2f}s, {size_before} -> {size_after} bytes, '
+                   'WAL {wal_size_before} -> {wal_size_after} bytes'.format(**result)
+                   + (' {}'.format(details) if details else ''))
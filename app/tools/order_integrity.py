@@ -0,0 +1,129 @@
+"""
+Check and repair of the gapless order_in_series invariant of the entries (1..n per series without duplicates, see
+`Entry.order_in_series`). The invariant is only enforced by the ORM, direct SQL or concurrent writers can break it.
+
+Both run set based in the database: the expected position of every entry is its `ROW_NUMBER()` within its series
+ordered by order_in_series and id, so the current order is kept and duplicates are ordered by id. The repair is a
+single `UPDATE ... FROM` of the entries whose position differs, no rows are loaded into Python.
+"""
+import logging
+import sqlite3
+import time
+from typing import Dict, List
+
+import click
+from sqlalchemy import func, select, text
+from sqlalchemy.sql.functions import count
+
+import changes
+from database import db
+from models.entry import Entry
+
+logger = logging.getLogger(__name__)
+
+# series ids listed in the check result
+SAMPLE_SIZE = 20
+
+
+def _numbered_entries():
+    entries = Entry.__table__
+    return select(entries.c.id, entries.c.series_id, entries.c.order_in_series,
+                  func.row_number().over(partition_by=entries.c.series_id,
+                                         order_by=(entries.c.order_in_series, entries.c.id)).label('expected')) \
+        .subquery('numbered')
+
+
+def _violations(bind_arguments: Dict) -> Dict[int, int]:
+    """
+    :return: Number of misplaced entries per series
+    """
+    numbered = _numbered_entries()
+    query = select(numbered.c.series_id, count()) \
+        .where(numbered.c.order_in_series != numbered.c.expected) \
+        .group_by(numbered.c.series_id)
+    return dict(db.session.execute(query, bind_arguments=bind_arguments).all())
+
+
+def _repair_statement():
+    # SQLAlchemy 1.4 can't compile UPDATE ... FROM for SQLite, which supports it since 3.33
+    if sqlite3.sqlite_version_info < (3, 33):
+        raise RuntimeError(f'Repairing requires SQLite 3.33 or newer, not {sqlite3.sqlite_version}')
+
+    dialect = db.session.get_bind().dialect
+    numbered = _numbered_entries().element.compile(dialect=dialect)
+    return text(f'UPDATE entries SET order_in_series = numbered.expected FROM ({numbered}) AS numbered '
+                f'WHERE entries.id = numbered.id AND numbered.order_in_series != numbered.expected')
+
+
+def _result(violations: Dict[int, int]) -> Dict:
+    return {
+        'entries': sum(violations.values()),
+        'series': len(violations),
+        'series_ids': sorted(violations)[:SAMPLE_SIZE]
+    }
+
+
+def check_order_in_series() -> Dict:
+    """
+    :return: Number of misplaced entries, number of affected series and the first SAMPLE_SIZE affected series ids
+    """
+    violations = {}
+    for bind_arguments in db.bind_arguments_for_table(Entry.__tablename__):
+        violations.update(_violations(bind_arguments))
+    if violations:
+        logger.warning('order_in_series of %d entries in %d series is out of place', sum(violations.values()),
+                       len(violations))
+    return _result(violations)
+
+
+def repair_order_in_series() -> Dict:
+    """
+    Renumbers the misplaced entries of all series with one `UPDATE ... FROM` per database, in a transaction which
+    holds the write lock from the check on.
+
+    :return: Number of repaired entries and series, see check_order_in_series
+    """
+    entries = Entry.__table__
+    repaired = {}
+    for bind_arguments in db.bind_arguments_for_table(Entry.__tablename__):
+        try:
+            db.begin_write_transaction(bind_arguments)
+            violations = _violations(bind_arguments)
+            if violations:
+                db.session.execute(_repair_statement(), bind_arguments=bind_arguments)
+                for series_id in violations:
+                    changes.record_change(db.session, entries.name, None, changes.UPDATE, series_id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        repaired.update(violations)
+
+    if repaired:
+        logger.info('Repaired order_in_series of %d entries in %d series', sum(repaired.values()), len(repaired))
+    return _result(repaired)
+
+
+def _format_result(result: Dict) -> str:
+    series_ids: List[int] = result['series_ids']
+    summary = '{} entries in {} series'.format(result['entries'], result['series'])
+    if series_ids:
+        summary += ' (series {}{})'.format(', '.join(str(id) for id in series_ids),
+                                           ', ...' if result['series'] > len(series_ids) else '')
+    return summary
+
+
+@click.command('check-order')
+@click.option('--repair', is_flag=True, help='Renumber the misplaced entries.')
+def check_order_command(repair: bool):
+    """Check (and repair) the gapless order_in_series of the entries of all series."""
+    start = time.perf_counter()
+    if repair:
+        click.echo('Repaired {} in {:.1f}s'.format(_format_result(repair_order_in_series()),
+                                                  time.perf_counter() - start))
+        return
+
+    result = check_order_in_series()
+    click.echo('Misplaced: {} in {:.1f}s'.format(_format_result(result), time.perf_counter() - start))
+    if result['entries']:
+        raise SystemExit(1)
@@ -0,0 +1,305 @@
+"""
+Compact binary snapshots of the entity tables, for seeding staging or benchmark databases.
+
+File format (version 1, all integers little endian):
+
+    magic `CSSNAP`, uint16 version
+    per row group: uint32 header length, JSON header {"table", "columns", "encodings", "rows"},
+                   per column: uint32 length, zlib compressed column data
+    uint32 0 as end marker
+
+Integer columns are stored as delta encoded int64 arrays, all other columns as JSON arrays.
+
+Export reads from a copy made with SQLite's online backup API (one short read transaction) so the live service isn't
+blocked while the snapshot is encoded. Import drops the secondary indexes and the revision triggers of the tables,
+bulk inserts all rows in one transaction and recreates them afterwards. The imported (and replaced) rows get their
+revisions (and tombstones) with one statement per table instead of the per row triggers.
+"""
+import json
+import logging
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from array import array
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+
+import click
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'CSSNAP'
+VERSION = 1
+ROW_GROUP_SIZE = 65536
+
+# parents before children, so rows can be inserted in this order
+TABLES = ['series', 'entrytypes', 'entries', 'characters', 'characterinfo']
+
+INT_DELTA = 'int-delta'
+JSON = 'json'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def require_single_database():
+    """
+    :raise SnapshotError: In sharded mode, a snapshot covers a single database
+    """
+    from database import db
+
+    if db.sharded:
+        raise SnapshotError('Snapshots are not supported in sharded mode')
+
+
+def _encode_column(values: List) -> Tuple[str, bytes]:
+    if all(type(value) is int for value in values):
+        deltas = array('q')
+        previous = 0
+        for value in values:
+            deltas.append(value - previous)
+            previous = value
+        if sys.byteorder == 'big':
+            deltas.byteswap()
+        return INT_DELTA, deltas.tobytes()
+    return JSON, json.dumps(values, separators=(',', ':')).encode()
+
+
+def _decode_column(encoding: str, data: bytes) -> List:
+    if encoding == INT_DELTA:
+        deltas = array('q')
+        deltas.frombytes(data)
+        if sys.byteorder == 'big':
+            deltas.byteswap()
+        values = []
+        previous = 0
+        for delta in deltas:
+            previous += delta
+            values.append(previous)
+        return values
+    if encoding == JSON:
+        return json.loads(data)
+    raise SnapshotError('Unknown column encoding {}'.format(encoding))
+
+
+def _write_block(f: BinaryIO, data: bytes):
+    f.write(struct.pack('<I', len(data)))
+    f.write(data)
+
+
+def _read_block(f: BinaryIO) -> bytes:
+    length_data = f.read(4)
+    if len(length_data) != 4:
+        raise SnapshotError('Unexpected end of snapshot file')
+    length, = struct.unpack('<I', length_data)
+    data = f.read(length)
+    if len(data) != length:
+        raise SnapshotError('Unexpected end of snapshot file')
+    return data
+
+
+def _table_columns(connection: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in connection.execute('PRAGMA table_info("{}")'.format(table))]
+
+
+def write_snapshot(connection: sqlite3.Connection, f: BinaryIO) -> Dict[str, int]:
+    f.write(MAGIC)
+    f.write(struct.pack('<H', VERSION))
+
+    counts = {}
+    for table in TABLES:
+        columns = _table_columns(connection, table)
+        quoted_columns = ', '.join('"{}"'.format(column) for column in columns)
+        cursor = connection.execute('SELECT {} FROM "{}" ORDER BY id'.format(quoted_columns, table))
+        counts[table] = 0
+        while True:
+            rows = cursor.fetchmany(ROW_GROUP_SIZE)
+            if not rows:
+                break
+
+            encoded_columns = [_encode_column(list(values)) for values in zip(*rows)]
+            header = {
+                'table': table,
+                'columns': columns,
+                'encodings': [encoding for encoding, _ in encoded_columns],
+                'rows': len(rows)
+            }
+            _write_block(f, json.dumps(header).encode())
+            for _, data in encoded_columns:
+                _write_block(f, zlib.compress(data, 6))
+            counts[table] += len(rows)
+
+    f.write(struct.pack('<I', 0))
+    return counts
+
+
+def read_snapshot(f: BinaryIO) -> Iterator[Tuple[str, List[str], List[Tuple]]]:
+    """
+    Yields tuples of table name, column names and rows for every row group of the snapshot.
+
+    :raise SnapshotError: If the snapshot file is invalid
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise SnapshotError('Not a snapshot file')
+    version_data = f.read(2)
+    if len(version_data) != 2:
+        raise SnapshotError('Unexpected end of snapshot file')
+    version, = struct.unpack('<H', version_data)
+    if version > VERSION:
+        raise SnapshotError('Unsupported snapshot version {} (supported up to {})'.format(version, VERSION))
+
+    while True:
+        header_data = _read_block(f)
+        if not header_data:
+            return
+
+        try:
+            header = json.loads(header_data)
+            columns = [_decode_column(encoding, zlib.decompress(_read_block(f))) for encoding in header['encodings']]
+            corrupt = any(len(values) != header['rows'] for values in columns)
+            table, column_names = header['table'], header['columns']
+        except (zlib.error, ValueError, KeyError, TypeError) as e:
+            raise SnapshotError('Corrupt snapshot file: {}'.format(e))
+        if corrupt:
+            raise SnapshotError('Corrupt row group of table {}'.format(table))
+        yield table, column_names, list(zip(*columns))
+
+
+def export_snapshot(database_path: str, snapshot_path: str) -> Dict[str, int]:
+    source = sqlite3.connect(database_path)
+    with tempfile.TemporaryDirectory() as directory:
+        copy_path = os.path.join(directory, 'snapshot.db')
+        copy = sqlite3.connect(copy_path)
+        try:
+            start = time.perf_counter()
+            # copying all pages in one step reads the database in a single, short read transaction
+            source.backup(copy, pages=-1)
+            source.close()
+            logger.info('Copied database in %.2fs', time.perf_counter() - start)
+
+            with open(snapshot_path, 'wb') as f:
+                return write_snapshot(copy, f)
+        finally:
+            copy.close()
+
+
+def import_snapshot(connection: sqlite3.Connection, snapshot_path: str, replace: bool = False) -> Dict[str, int]:
+    """
+    Imports a snapshot into the given connection (autocommit mode). The tables must exist and be empty unless
+    `replace` is set, in which case their rows are deleted first.
+
+    :raise SnapshotError: If a table isn't empty and `replace` isn't set or if the snapshot file is invalid
+    """
+    from revisions import drop_revision_triggers, revise_rows, tombstone_rows
+
+    for table in TABLES:
+        if connection.execute('SELECT 1 FROM "{}" LIMIT 1'.format(table)).fetchone() and not replace:
+            raise SnapshotError('Table {} is not empty, use --replace to overwrite the data'.format(table))
+
+    placeholders = ', '.join('?' for _ in TABLES)
+    indexes = connection.execute('SELECT name, sql FROM sqlite_master WHERE type = \'index\' AND sql IS NOT NULL '
+                                 'AND tbl_name IN ({})'.format(placeholders), TABLES).fetchall()
+
+    (synchronous,) = connection.execute('PRAGMA synchronous').fetchone()
+    connection.execute('PRAGMA foreign_keys=OFF')
+    connection.execute('PRAGMA synchronous=OFF')
+    counts = {table: 0 for table in TABLES}
+    try:
+        connection.execute('BEGIN')
+        triggers = drop_revision_triggers(connection, TABLES)
+        if replace:
+            for table in reversed(TABLES):
+                tombstone_rows(connection, table)
+                connection.execute('DELETE FROM "{}"'.format(table))
+        for name, _ in indexes:
+            connection.execute('DROP INDEX "{}"'.format(name))
+
+        with open(snapshot_path, 'rb') as f:
+            for table, columns, rows in read_snapshot(f):
+                if table not in counts:
+                    raise SnapshotError('Unknown table {} in snapshot'.format(table))
+                quoted_columns = ', '.join('"{}"'.format(column) for column in columns)
+                values = ', '.join('?' for _ in columns)
+                try:
+                    connection.executemany('INSERT INTO "{}" ({}) VALUES ({})'.format(table, quoted_columns, values),
+                                           rows)
+                except sqlite3.Error as e:
+                    raise SnapshotError('Could not import the rows of table {}: {}'.format(table, e))
+                counts[table] += len(rows)
+
+        start = time.perf_counter()
+        for _, sql in indexes:
+            connection.execute(sql)
+        logger.info('Recreated %d indexes in %.2fs', len(indexes), time.perf_counter() - start)
+
+        for table in TABLES:
+            revise_rows(connection, table)
+        for sql in triggers:
+            connection.execute(sql)
+
+        violations = connection.execute('PRAGMA foreign_key_check').fetchall()
+        if violations:
+            raise SnapshotError('Snapshot violates foreign key constraints: {}'.format(violations[:10]))
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.execute(f'PRAGMA synchronous={int(synchronous)}')
+        connection.execute('PRAGMA foreign_keys=ON')
+
+    connection.execute('ANALYZE')
+    return counts
+
+
+def sqlite_database_path(engine) -> str:
+    """
+    :raise ValueError: If the engine isn't connected to an SQLite database file
+    """
+    if engine.dialect.name != 'sqlite' or not engine.url.database or engine.url.database == ':memory:':
+        raise ValueError('Snapshots can only be exported from SQLite database files')
+    return engine.url.database
+
+
+def _format_counts(counts: Dict[str, int]) -> str:
+    return ', '.join('{} {}'.format(count, table) for table, count in counts.items())
+
+
+@click.command('export-snapshot')
+@click.argument('snapshot_path', type=click.Path(dir_okay=False, writable=True))
+def export_snapshot_command(snapshot_path: str):
+    """Export all entity tables to a snapshot file."""
+    from database import db
+
+    try:
+        require_single_database()
+        database_path = sqlite_database_path(db.session.get_bind())
+    except (SnapshotError, ValueError) as e:
+        raise click.ClickException(str(e))
+
+    start = time.perf_counter()
+    counts = export_snapshot(database_path, snapshot_path)
+    click.echo('Exported {} to {} ({} bytes) in {:.1f}s'.format(_format_counts(counts), snapshot_path,
+                                                               os.path.getsize(snapshot_path),
+                                                               time.perf_counter() - start))
+
+
+@click.command('import-snapshot')
+@click.argument('snapshot_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--replace', is_flag=True, help='Delete the existing rows of the tables before importing.')
+def import_snapshot_command(snapshot_path: str, replace: bool):
+    """Import a snapshot file into the entity tables."""
+    from database import db
+
+    start = time.perf_counter()
+    try:
+        require_single_database()
+        with db.raw_connection() as connection:
+            counts = import_snapshot(connection, snapshot_path, replace)
+    except SnapshotError as e:
+        raise click.ClickException(str(e))
+    click.echo('Imported {} in {:.1f}s'.format(_format_counts(counts), time.perf_counter() - start))
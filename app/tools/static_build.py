@@ -0,0 +1,268 @@
+"""
+Static build of the cacheable read-only responses, for serving anonymous browsing from a plain static file server.
+
+Every response is rendered by the application itself (so the files are byte for byte what the API returns) and
+written as `.json` and pre-compressed `.json.gz` file. `manifest.json` maps each URL to its files, sizes and ETag:
+
+    {"version": 1, "built_at": "...", "fingerprint": "...",
+     "files": {"/rest/series/1/entries": {"file": "rest/series/1/entries.json", "gzip_file": "...json.gz",
+                                          "bytes": 1234, "gzip_bytes": 321, "etag": "<sha1>"}, ...},
+     "series": {"1": {"fingerprint": "...", "urls": ["/rest/series/1", ...]}, ...}}
+
+Builds are incremental: the responses of a series are only rendered again if its fingerprint (revisions and row counts
+of the series and its entries, characters and character infos) changed since the last build. Changes of the entry
+types, which are embedded in the entries, render everything again.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import click
+from flask import current_app
+from sqlalchemy import func, select
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+class StaticBuildError(Exception):
+    pass
+
+
+def _fingerprints() -> Tuple[str, Dict[int, str]]:
+    """
+    :return: Fingerprint of the data shared by all series and fingerprint per series id
+    """
+    from database import db
+    from models.character import Character
+    from models.character_info import CharacterInfo
+    from models.entry import Entry
+    from models.entrytype import EntryType
+    from models.series import Series
+
+    series = Series.__table__
+    entrytypes = EntryType.__table__
+    entries = Entry.__table__
+    characters = Character.__table__
+    infos = CharacterInfo.__table__
+
+    def aggregate(query, table_name: str) -> Dict:
+        # (count, max revision) per series, summed over the shards
+        stats = {}
+        for bind_arguments in db.bind_arguments_for_table(table_name):
+            for series_id, row_count, revision in db.session.execute(query, bind_arguments=bind_arguments):
+                previous_count, previous_revision = stats.get(series_id, (0, 0))
+                stats[series_id] = (previous_count + row_count, max(previous_revision, revision or 0))
+        return stats
+
+    entry_stats = aggregate(select(entries.c.series_id, func.count(), func.max(entries.c.revision))
+                            .group_by(entries.c.series_id), entries.name)
+    character_stats = aggregate(select(characters.c.series_id, func.count(), func.max(characters.c.revision))
+                                .group_by(characters.c.series_id), characters.name)
+    info_stats = aggregate(select(entries.c.series_id, func.count(), func.max(infos.c.revision))
+                           .join_from(infos, entries, infos.c.entry_id == entries.c.id)
+                           .group_by(entries.c.series_id), infos.name)
+
+    entrytype_count, entrytype_revision = db.session.execute(
+        select(func.count(), func.max(entrytypes.c.revision))).one()
+    shared = f'{entrytype_count}:{entrytype_revision or 0}'
+
+    fingerprints = {}
+    for series_id, revision in db.session.execute(select(series.c.id, series.c.revision)):
+        parts = [revision] + [value for stats in (entry_stats, character_stats, info_stats)
+                              for value in stats.get(series_id, (0, 0))]
+        fingerprints[series_id] = ':'.join(str(part) for part in parts)
+    return shared, fingerprints
+
+
+def _file_name(url: str) -> str:
+    """
+    File of an URL relative to the output directory, e.g. `/rest/series/1/sheet?upto=2` -> `rest/series/1/sheet/upto-2`
+    (without extension).
+    """
+    path, _, query = url.partition('?')
+    path = path.strip('/')
+    if query:
+        path += '/' + query.replace('=', '-').replace('&', '.')
+    return path
+
+
+class StaticBuilder:
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.client = current_app.test_client()
+        # manifest entries of the previous and of this build, by URL
+        self.previous_files: Dict[str, Dict] = {}
+        self.files: Dict[str, Dict] = {}
+        self.written = 0
+
+    def _write(self, relative_path: str, data: bytes):
+        path = os.path.join(self.output_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def render(self, url: str) -> Dict:
+        """
+        Renders the response of the URL to its files, files whose content didn't change are left untouched.
+
+        :return: Parsed response body
+        :raise StaticBuildError: If the response isn't successful
+        """
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise StaticBuildError(f'GET {url} returned {response.status_code}: {response.get_data(as_text=True)}')
+
+        data = response.get_data()
+        etag = hashlib.sha1(data).hexdigest()
+        file_name = _file_name(url)
+        entry = {
+            'file': file_name + '.json',
+            'gzip_file': file_name + '.json.gz',
+            'bytes': len(data),
+            'etag': etag
+        }
+
+        previous = self.previous_files.get(url)
+        if previous is not None and previous['etag'] == etag and \
+                os.path.exists(os.path.join(self.output_dir, previous['gzip_file'])):
+            entry['gzip_bytes'] = previous['gzip_bytes']
+        else:
+            # mtime 0, so the same content is compressed to the same bytes
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            entry['gzip_bytes'] = len(compressed)
+            self._write(entry['file'], data)
+            self._write(entry['gzip_file'], compressed)
+            self.written += 1
+
+        self.files[url] = entry
+        return response.json
+
+    def render_pages(self, url: str) -> List[Dict]:
+        """
+        Renders all pages of a list URL, the first page under the URL itself and the following ones with `offset`.
+
+        :return: Rows of all pages
+        """
+        from database import LIMIT
+
+        body = self.render(url)
+        rows = list(body['data'])
+        offset = LIMIT
+        separator = '&' if '?' in url else '?'
+        while body['size'] is not None and offset < body['size']:
+            body = self.render(f'{url}{separator}offset={offset}')
+            rows.extend(body['data'])
+            offset += LIMIT
+        return rows
+
+    def render_series(self, series_id: int) -> List[str]:
+        """
+        :return: Rendered URLs of the series
+        """
+        rendered = len(self.files)
+        self.render(f'/rest/series/{series_id}')
+        entries = self.render_pages(f'/rest/series/{series_id}/entries')
+        self.render_pages(f'/rest/series/{series_id}/characters')
+        self.render_pages(f'/rest/series/{series_id}/sheet')
+        # spoiler free sheet per entry
+        for order in sorted({entry['order_in_series'] for entry in entries}):
+            self.render_pages(f'/rest/series/{series_id}/sheet?upto={order}')
+        return list(self.files)[rendered:]
+
+    def build(self, force: bool = False) -> Dict:
+        manifest_path = os.path.join(self.output_dir, MANIFEST_FILE)
+        previous = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                previous = json.load(f)
+            if previous.get('version') != MANIFEST_VERSION:
+                logger.info('Manifest version changed, rebuilding everything')
+                previous = {}
+        self.previous_files = previous.get('files', {})
+        previous_series = previous.get('series', {})
+
+        shared_fingerprint, fingerprints = _fingerprints()
+        if force or previous.get('fingerprint') != shared_fingerprint:
+            previous_series = {}
+
+        self.render_pages('/rest/series')
+        self.render_pages('/rest/entrytypes')
+
+        series_manifest = {}
+        rendered_series = 0
+        for series_id, fingerprint in sorted(fingerprints.items()):
+            old = previous_series.get(str(series_id))
+            if old is not None and old['fingerprint'] == fingerprint \
+                    and all(url in self.previous_files for url in old['urls']):
+                for url in old['urls']:
+                    self.files[url] = self.previous_files[url]
+                series_manifest[str(series_id)] = old
+                continue
+
+            series_manifest[str(series_id)] = {'fingerprint': fingerprint, 'urls': self.render_series(series_id)}
+            rendered_series += 1
+
+        # files of deleted series and pages which don't exist anymore
+        removed = 0
+        for url, entry in self.previous_files.items():
+            if url not in self.files:
+                for file_name in (entry['file'], entry['gzip_file']):
+                    path = os.path.join(self.output_dir, file_name)
+                    if os.path.exists(path):
+                        os.remove(path)
+                removed += 1
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'built_at': datetime.utcnow().isoformat(),
+            'fingerprint': shared_fingerprint,
+            'files': self.files,
+            'series': series_manifest
+        }
+        self._write(MANIFEST_FILE, json.dumps(manifest, indent=1, sort_keys=True).encode())
+
+        return {'series': len(fingerprints), 'rendered_series': rendered_series, 'urls': len(self.files),
+                'written': self.written, 'removed': removed}
+
+
+def build_static(output_dir: str, force: bool = False) -> Dict:
+    """
+    Renders the static files to the output directory, see module documentation. Must run in an application context.
+
+    :param force: Render all series, also the unchanged ones
+    :return: Build statistics
+    :raise StaticBuildError: If a response can't be rendered
+    """
+    from database import db
+
+    # all responses of the build are rendered from one snapshot of the data
+    db.begin_read_snapshot()
+    try:
+        return StaticBuilder(output_dir).build(force)
+    finally:
+        db.session.rollback()
+
+
+@click.command('build-static')
+@click.argument('output_dir', type=click.Path(file_okay=False, writable=True))
+@click.option('--force', is_flag=True, help='Render all series, not only the ones changed since the last build.')
+def build_static_command(output_dir: str, force: bool):
+    """Render the cacheable read-only responses to static pre-compressed JSON files."""
+    start = time.perf_counter()
+    try:
+        stats = build_static(output_dir, force)
+    except StaticBuildError as e:
+        raise click.ClickException(str(e))
+    click.echo('Rendered {rendered_series} of {series} series, {urls} URLs ({written} files written, {removed} removed)'
+               .format(**stats) + ' in {:.1f}s'.format(time.perf_counter() - start))
@@ -21,39 +21,90 @@ def create_app():
     app = Flask(__name__)
     app.config['SECRET_KEY'] = os.urandom(16)
 
+    shard_count = int(os.getenv('DB_SHARD_COUNT', '1'))
+
     from database import db
-    db.connect_db(db_connection_string)
+    db.connect_db(db_connection_string, shard_count)
+
+    from admission import init_admission_control
+    init_admission_control(app)
+
+    from coherence import init_coherence_checks
+    init_coherence_checks(app)
+
+    from coalescing import init_request_coalescing
+    init_request_coalescing()
+
+    from profiling import init_request_profiling, init_slow_query_log
+    init_slow_query_log(db.engines)
+    init_request_profiling(app)
 
     @app.teardown_appcontext
     def shutdown_session(exception=None):
         db.session.remove()
 
+    from tools.datagen import generate_data_command
+    from tools.snapshot import export_snapshot_command, import_snapshot_command
+    from tools.static_build import build_static_command
+    from tools.order_integrity import check_order_command
+    from tools.maintenance import maintain_db_command
+    app.cli.add_command(generate_data_command)
+    app.cli.add_command(export_snapshot_command)
+    app.cli.add_command(import_snapshot_command)
+    app.cli.add_command(build_static_command)
+    app.cli.add_command(check_order_command)
+    app.cli.add_command(maintain_db_command)
+
     api = Api(app, '/rest')
 
-    from database import generate_test_data
-    app.add_url_rule('/rest/generate_test_data', view_func=generate_test_data)
+    from feed_server import init_feed_server
+    init_feed_server(app)
 
     from api.rest_resources import SeriesRESTResource, SeriesSearchRESTResource, SeriesEntriesRESTResource, \
-        SeriesCharactersRESTResource
+        SeriesCharactersRESTResource, SeriesSuggestRESTResource, SeriesRelationsRESTResource, SeriesSheetRESTResource
     api.add_resource(SeriesRESTResource, '/series', '/series/', '/series/<int:id>')
     api.add_resource(SeriesSearchRESTResource, '/series/search')
+    api.add_resource(SeriesSuggestRESTResource, '/series/suggest')
     api.add_resource(SeriesEntriesRESTResource, '/series/<int:id>/entries')
     api.add_resource(SeriesCharactersRESTResource, '/series/<int:id>/characters')
+    api.add_resource(SeriesRelationsRESTResource, '/series/<int:id>/relations')
+    api.add_resource(SeriesSheetRESTResource, '/series/<int:id>/sheet')
 
-    from api.rest_resources import EntryTypeRESTResource, EntryTypeEntriesRESTResource
+    from api.rest_resources import EntryTypeRESTResource, EntryTypeEntriesRESTResource, EntryTypeSuggestRESTResource
     api.add_resource(EntryTypeRESTResource, '/entrytypes', '/entrytypes/', '/entrytypes/<int:id>')
     api.add_resource(EntryTypeSearchRESTResource, '/entrytypes/search')
+    api.add_resource(EntryTypeSuggestRESTResource, '/entrytypes/suggest')
     api.add_resource(EntryTypeEntriesRESTResource, '/entrytypes/<int:id>/entries')
 
-    from api.rest_resources import EntryRESTResource, EntrySearchRESTResource
+    from api.rest_resources import EntryRESTResource, EntrySearchRESTResource, EntrySuggestRESTResource
     api.add_resource(EntryRESTResource, '/entries', '/entries/', '/entries/<int:id>')
     api.add_resource(EntrySearchRESTResource, '/entries/search')
+    api.add_resource(EntrySuggestRESTResource, '/entries/suggest')
 
-    from api.rest_resources import CharacterRESTResource
-    api.add_resource(CharacterRESTResource, '/characters', '/characters/')
+    from api.rest_resources import CharacterRESTResource, CharacterSuggestRESTResource
+    api.add_resource(CharacterRESTResource, '/characters', '/characters/', '/characters/<int:id>')
     api.add_resource(CharacterSearchRESTResource, '/characters/search')
+    api.add_resource(CharacterSuggestRESTResource, '/characters/suggest')
 
     from api.rest_resources import CharacterInfoRESTResource
-    api.add_resource(CharacterInfoRESTResource, '/characterinfo', '/characterinfo/')
+    api.add_resource(CharacterInfoRESTResource, '/characterinfo', '/characterinfo/', '/characterinfo/<int:id>')
+
+    from api.rest_resources import SyncRESTResource
+    api.add_resource(SyncRESTResource, '/sync')
+
+    from api.rest_resources import BatchRESTResource
+    api.add_resource(BatchRESTResource, '/batch')
+
+    from api.rest_resources import OrderIntegrityRESTResource
+    api.add_resource(OrderIntegrityRESTResource, '/admin/order_in_series')
+
+    from jobs import init_job_runner
+    init_job_runner()
+
+    from tools.maintenance import init_maintenance_scheduler
+    init_maintenance_scheduler(app)
+
+    from api.rest_resources import JobRESTResource
+    api.add_resource(JobRESTResource, '/jobs', '/jobs/', '/jobs/<int:id>')
 
     return app